@@ -0,0 +1,305 @@
+"""Latency/throughput benchmark for the server routes.
+
+Seeds a synthetic database per size, then drives /check/<key>, /activate,
+/extend, /list and /stats at each concurrency level, either through
+Flask's test client or through a local gunicorn, and writes p50/p95/p99
+latency and requests/sec to a JSON report:
+
+    python bench.py --sizes 1000 100000 1000000 --concurrency 1 8 32
+    python bench.py --mode gunicorn --workers 4 --output after.json
+    python bench.py --sizes 1000 --compare before.json
+
+Every size runs in a fresh process so each server import sees only its
+own database.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROUTES = ['check', 'activate', 'extend', 'list', 'stats']
+SEED_CHUNK = 10000
+
+
+def seed(backend, path, size):
+    """Write `size` synthetic keys, a tenth of them bound to a device"""
+    from store import open_store
+    store = open_store(backend, path)
+    now = datetime.now()
+    for start in range(0, size, SEED_CHUNK):
+        items = []
+        for i in range(start, min(start + SEED_CHUNK, size)):
+            bound = i % 10 == 0
+            items.append((f'BENCH-{i:08d}', {
+                'status': 'active',
+                'activated': now.isoformat(),
+                'expiry': (now + timedelta(days=30 + i % 365)).isoformat(),
+                'months': 1,
+                'registered_device': f'device-{i}' if bound else None,
+                'registered_path': f'/apps/{i}' if bound else None,
+                'registered_hash': f'hash-{i}' if bound else None,
+                'first_use': now.isoformat() if bound else None
+            }))
+        store.put_many(items)
+
+
+def request_for(route, size, rng):
+    """(method, path, json body) for one request against a seeded database"""
+    i = rng.randrange(size)
+    key = f'BENCH-{i:08d}'
+    if route == 'check':
+        return 'POST', f'/check/{key}', {
+            'device_id': f'device-{i}', 'file_path': f'/apps/{i}', 'file_hash': f'hash-{i}'
+        }
+    if route == 'activate':
+        return 'POST', '/activate', {'key': f'NEW-{rng.getrandbits(64):016x}', 'months': 1}
+    if route == 'extend':
+        return 'POST', '/extend', {'key': key, 'months': 1}
+    if route == 'list':
+        return 'GET', f'/list?limit=100&cursor={key}', None
+    return 'GET', '/stats', None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def drive(make_call, route, size, concurrency, requests_count):
+    """Send `requests_count` requests from `concurrency` threads, return the summary"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = [requests_count // concurrency + (1 if t < requests_count % concurrency else 0)
+                  for t in range(concurrency)]
+
+    def run(thread_id, count):
+        call = make_call()
+        rng = random.Random(thread_id)
+        local = []
+        failed = 0
+        for _ in range(count):
+            method, path, body = request_for(route, size, rng)
+            started = time.perf_counter()
+            status = call(method, path, body)
+            local.append(time.perf_counter() - started)
+            if status >= 500:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, range(concurrency), per_thread))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'route': route,
+        'size': size,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None
+    }
+
+
+def client_caller():
+    import server
+
+    def make_call():
+        client = server.app.test_client()
+
+        def call(method, path, body):
+            if method == 'GET':
+                return client.get(path).status_code
+            return client.post(path, json=body).status_code
+        return call
+    return make_call
+
+
+def gunicorn_caller(port):
+    import requests
+
+    def make_call():
+        session = requests.Session()
+        base = f'http://127.0.0.1:{port}'
+
+        def call(method, path, body):
+            try:
+                if method == 'GET':
+                    return session.get(base + path, timeout=60).status_code
+                return session.post(base + path, json=body, timeout=60).status_code
+            except requests.RequestException:
+                return 599
+        return call
+    return make_call
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(workers, port, env, directory):
+    """gunicorn in `directory`, so anything it writes lands there and not in the repo"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'server:app', '-w', str(workers),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning',
+         '-c', os.path.join(repo, 'gunicorn.conf.py'), '--pythonpath', repo],
+        cwd=directory, env=env
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def run_size(args, size, queue):
+    """Benchmark one database size in a fresh process"""
+    directory = tempfile.mkdtemp(prefix='bench-')
+    path = os.path.join(directory, 'database.db' if args.backend == 'sqlite' else 'database.json')
+    try:
+        started = time.perf_counter()
+        seed(args.backend, path, size)
+        seed_seconds = round(time.perf_counter() - started, 2)
+
+        os.environ.update({'DB_BACKEND': args.backend, 'DB_PATH': path, 'SCHEDULER': 'off',
+                           'RATE_LIMIT_IP': '0', 'RATE_LIMIT_DEVICE': '0', 'RATE_LIMIT_KEY': '0',
+                           # The server's other files go with the database, removed after the run
+                           'EVENT_LOG_DIR': os.path.join(directory, 'events'),
+                           'PROFILE_DIR': os.path.join(directory, 'profiles'),
+                           'SLOW_REQUEST_LOG': os.path.join(directory, 'slow_requests.ndjson'),
+                           'RATE_LIMIT_PATH': os.path.join(directory, 'ratelimit.db')})
+        process = None
+        if args.mode == 'gunicorn':
+            port = free_port()
+            process = start_gunicorn(args.workers, port, dict(os.environ), directory)
+            make_call = gunicorn_caller(port)
+        else:
+            make_call = client_caller()
+
+        results = []
+        try:
+            for route in args.routes:
+                for concurrency in args.concurrency:
+                    result = drive(make_call, route, size, concurrency, args.requests)
+                    result['seed_seconds'] = seed_seconds
+                    print(f"{size:>9} {route:<9} c={concurrency:<3} "
+                          f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+                          f"p99={result['p99_ms']}ms rps={result['rps']}", flush=True)
+                    results.append(result)
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+        queue.put(results)
+    except BaseException as e:
+        queue.put({'error': repr(e)})
+        raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline_path):
+    """Print p95 and rps changes against an earlier report"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(r['route'], r['size'], r['concurrency']): r for r in baseline['results']}
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('revision')}):")
+    for result in report['results']:
+        old = before.get((result['route'], result['size'], result['concurrency']))
+        if not old or not old['p95_ms'] or not old['rps']:
+            continue
+        p95 = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+        rps = (result['rps'] - old['rps']) / old['rps'] * 100
+        flag = '  ⚠️' if p95 > 20 or rps < -20 else ''
+        print(f"{result['size']:>9} {result['route']:<9} c={result['concurrency']:<3} "
+              f"p95 {p95:+.1f}%  rps {rps:+.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--routes', nargs='+', default=ROUTES, choices=ROUTES)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per route and concurrency')
+    parser.add_argument('--mode', default='client', choices=['client', 'gunicorn'])
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'json', 'journal'])
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--compare', help='earlier report to compare against')
+    args = parser.parse_args()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'mode': args.mode,
+            'workers': args.workers if args.mode == 'gunicorn' else None,
+            'backend': args.backend,
+            'requests': args.requests
+        },
+        'results': []
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for size in args.sizes:
+        queue = context.Queue()
+        process = context.Process(target=run_size, args=(args, size, queue))
+        process.start()
+        results = queue.get()
+        process.join()
+        if isinstance(results, dict):
+            print(f"❌ size {size} failed: {results['error']}")
+            sys.exit(1)
+        report['results'].extend(results)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Report written to {args.output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""Shared Bloom filter over the activation keys, for rejecting unknown keys.
+
+Much of the /check traffic is for keys that were never activated (typos,
+cracked clients, scanners). The filter answers "definitely not a key"
+from a few bits in a memory-mapped file (``<DB_PATH>.bloom``) that every
+gunicorn worker shares, so those requests never reach the index or the
+store. A "maybe" still goes through the normal lookup.
+
+Sized from the environment:
+
+    BLOOM_CAPACITY=100000   keys the filter is sized for
+    BLOOM_FP_RATE=0.01      false-positive rate at that many keys
+
+Bits are only ever set: a key deleted when it moves to another shard
+stays a false positive until the next rebuild. Writers set bits
+under an flock on ``<path>.lock`` after the store commits; once more keys
+than the capacity were added, the filter is rebuilt from the store at
+twice the size and swapped in with os.replace, and the old file is
+flagged retired so other workers remap. Like the key index, the file is
+kept as a snapshot for the next boot, which maps it as it is when the
+store is still at the version it recorded and no write was left half
+done; otherwise it is rebuilt once per boot (per gunicorn master, told
+apart by the random BOOT_ID it hands its workers). It is also rebuilt
+with the periodic stats reconcile.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import secrets
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+
+BLOOM_FILTER = os.environ.get('BLOOM_FILTER', 'on')
+BLOOM_CAPACITY = int(os.environ.get('BLOOM_CAPACITY', 100000))
+BLOOM_FP_RATE = float(os.environ.get('BLOOM_FP_RATE', 0.01))
+# Same in every worker of one gunicorn master (set in gunicorn.conf.py), new
+# on each start; a process started without it is a boot of its own
+BOOT_ID = int(os.environ.get('BOOT_ID') or secrets.randbits(63))
+
+MAGIC = b'AKBF'
+FORMAT = 2
+
+# magic, format, bits, hashes, capacity, added, retired, boot id, hash key,
+# writes in flight, store version and modified time the filter reflects
+HEADER = struct.Struct('<4sIQIQQIQ16siqq')
+HEADER_SIZE = 128
+HEADER_FIELDS = ('magic', 'format', 'bits', 'hashes', 'capacity', 'added', 'retired', 'boot',
+                 'hash_key', 'pending', 'version', 'modified')
+
+
+def sizing(capacity, fp_rate):
+    """(bits, hashes) for `capacity` keys at `fp_rate` false positives"""
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+    # Whole bytes, at least one
+    bits = max(8, (bits + 7) // 8 * 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def _positions(hash_key, key, bits, hashes):
+    digest = hashlib.blake2b(key.encode(), digest_size=16, key=hash_key).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    # Kirsch-Mitzenmacher: k positions from two hashes
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class BloomFilter:
+    """Memory-mapped bit array of every key the store holds"""
+
+    def __init__(self, path, source, version=None, capacity=BLOOM_CAPACITY, fp_rate=BLOOM_FP_RATE):
+        self.path = path
+        self.lock_path = path + '.lock'
+        # Callable returning (key, record) pairs, used to (re)build the filter
+        self.source = source
+        # Callable returning the store's (version, modified), to trust a snapshot
+        self.version = version
+        # How ensure() found the filter: 'built', 'snapshot' or 'shared'
+        self.loaded = None
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rejected = 0
+        self.passed = 0
+        # Counted by the caller when a key that passed turns out to be unknown
+        self.false_positives = 0
+        # (mmap, bits, hashes, hash key), replaced as one when the file is swapped
+        self._table = None
+        self._thread_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_thread_lock)
+
+    def _reset_thread_lock(self):
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        """Map the current filter file, None if there is none"""
+        try:
+            with open(self.path, 'r+b') as f:
+                mapping = mmap.mmap(f.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(mapping) < HEADER_SIZE:
+            return None
+        header = self._header((mapping,))
+        magic, fmt, bits, hashes, hash_key = (header[name] for name in (
+            'magic', 'format', 'bits', 'hashes', 'hash_key'))
+        if magic != MAGIC or fmt != FORMAT or len(mapping) != HEADER_SIZE + bits // 8:
+            return None
+        return mapping, bits, hashes, hash_key
+
+    def _current(self):
+        table = self._table
+        if table is None or HEADER.unpack_from(table[0], 0)[6]:
+            # Not mapped yet, or another process swapped in a new file
+            table = self._table = self._open()
+        return table
+
+    def might_contain(self, key):
+        """False only if the key is certainly not in the store"""
+        table = self._current()
+        if table is None:
+            return True
+        mapping, bits, hashes, hash_key = table
+        for position in _positions(hash_key, key, bits, hashes):
+            if not mapping[HEADER_SIZE + (position >> 3)] & (1 << (position & 7)):
+                self.rejected += 1
+                return False
+        self.passed += 1
+        return True
+
+    @staticmethod
+    def _set(table, key):
+        """Set the key's bits, True if any was new"""
+        mapping, bits, hashes, hash_key = table
+        added = False
+        for position in _positions(hash_key, key, bits, hashes):
+            offset = HEADER_SIZE + (position >> 3)
+            mask = 1 << (position & 7)
+            byte = mapping[offset]
+            if not byte & mask:
+                mapping[offset] = byte | mask
+                added = True
+        return added
+
+    @staticmethod
+    def _header(table):
+        return dict(zip(HEADER_FIELDS, HEADER.unpack_from(table[0], 0)))
+
+    @staticmethod
+    def _update_header(table, header):
+        HEADER.pack_into(table[0], 0, *[header[name] for name in HEADER_FIELDS])
+
+    def begin_write(self):
+        """Count a store write in flight until its add_many()"""
+        with self._locked():
+            table = self._current()
+            if table is not None:
+                header = self._header(table)
+                header['pending'] += 1
+                self._update_header(table, header)
+
+    def add_many(self, keys, version=None):
+        """Add keys the store just committed
+
+        ``version`` is the store's (version, modified) after the commit; it
+        ends the write counted by begin_write().
+        """
+        keys = list(keys)
+        with self._locked():
+            table = self._current()
+            if table is None:
+                return
+            header = self._header(table)
+            header['added'] += sum(self._set(table, key) for key in keys)
+            if version is not None:
+                header['pending'] = max(0, header['pending'] - 1)
+                if tuple(version) > (header['version'], header['modified']):
+                    header['version'], header['modified'] = version
+            self._update_header(table, header)
+            if header['added'] > header['capacity']:
+                # Past its capacity the false-positive rate climbs: resize
+                self._build(header['capacity'] * 2, header['pending'])
+
+    def ensure(self):
+        """Map the filter, building it unless this boot or a usable snapshot has one"""
+        with self._locked():
+            table = self._current()
+            header = self._header(table) if table is not None else None
+            sibling = header is not None and header['boot'] == BOOT_ID
+            # Whoever wrote the file, it is only reused while it matches the store
+            current = header is not None and header['pending'] == 0 and self.version is not None \
+                and tuple(self.version()) == (header['version'], header['modified'])
+            if current and sibling:
+                # A sibling worker of this boot (gunicorn master) got here first
+                self.loaded = 'shared'
+            elif current:
+                header['boot'] = BOOT_ID
+                self._update_header(table, header)
+                self.loaded = 'snapshot'
+            else:
+                # A sibling's writes may still be in flight; a past boot's are dead
+                self._build(pending=header['pending'] if sibling else 0)
+                self.loaded = 'built'
+
+    def rebuild(self):
+        with self._locked():
+            table = self._current()
+            self._build(pending=self._header(table)['pending'] if table is not None else 0)
+
+    def _build(self, capacity=None, pending=0):
+        """Write a fresh filter from the store and swap it in (caller holds the lock)
+
+        ``pending`` carries over the writes in flight; a boot-time build drops
+        the count left behind by writers that died.
+        """
+        # Read first: a write landing before items() only makes the snapshot look stale
+        version = tuple(self.version()) if self.version is not None else (0, 0)
+        keys = [key for key, _ in self.source()]
+        capacity = max(capacity or self.capacity, self.capacity)
+        while len(keys) > capacity / 2:
+            capacity *= 2
+        bits, hashes = sizing(capacity, self.fp_rate)
+        old = self._current()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.bloom-', dir=directory)
+        try:
+            with os.fdopen(fd, 'r+b') as f:
+                f.truncate(HEADER_SIZE + bits // 8)
+                mapping = mmap.mmap(f.fileno(), 0)
+            table = (mapping, bits, hashes, secrets.token_bytes(16))
+            added = sum(self._set(table, key) for key in keys)
+            HEADER.pack_into(mapping, 0, MAGIC, FORMAT, bits, hashes, capacity, added, 0,
+                             BOOT_ID, table[3], pending, *version)
+            mapping.flush()
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if old is not None:
+            header = self._header(old)
+            header['retired'] = 1
+            self._update_header(old, header)
+        self._table = table
+
+    def info(self):
+        table = self._current()
+        if table is None:
+            return {'keys': 0, 'capacity': 0, 'bits': 0, 'hashes': 0, 'fill_ratio': 0.0,
+                    'estimated_fp_rate': 0.0, 'rejected': self.rejected, 'passed': self.passed,
+                    'false_positives': self.false_positives, 'loaded': self.loaded}
+        mapping, bits, hashes, _ = table
+        capacity, added = HEADER.unpack_from(mapping, 0)[4:6]
+        set_bits = sum(bin(byte).count('1') for byte in mapping[HEADER_SIZE:])
+        fill = set_bits / bits
+        return {
+            'keys': added,
+            'capacity': capacity,
+            'bits': bits,
+            'hashes': hashes,
+            'fill_ratio': round(fill, 4),
+            'estimated_fp_rate': round(fill ** hashes, 6),
+            'rejected': self.rejected,
+            'passed': self.passed,
+            'false_positives': self.false_positives,
+            'loaded': self.loaded
+        }
+
+
+class BloomStore:
+    """Store wrapper adding every key written to the filter"""
+
+    def __init__(self, store, bloom):
+        self.store = store
+        self.bloom = bloom
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def put_many(self, items):
+        items = list(items)
+        # A crash before add_many() leaves the write counted, so the next
+        # boot rebuilds instead of trusting a filter that may miss the keys
+        self.bloom.begin_write()
+        self.store.put_many(items)
+        self.bloom.add_many((key for key, _ in items), self.store.version())
+
+    def insert_many(self, items):
+        self.bloom.begin_write()
+        inserted = self.store.insert_many(items)
+        self.bloom.add_many(inserted, self.store.version())
+        return inserted
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def modify_many(self, ops):
+        # Existing keys only: nothing to add, but the snapshot's version follows
+        self.bloom.begin_write()
+        records = self.store.modify_many(ops)
+        self.bloom.add_many((), self.store.version())
+        return records
+
+    def delete_many(self, keys):
+        # Bits cannot be cleared: a deleted key is a false positive until the next rebuild
+        self.bloom.begin_write()
+        deleted = self.store.delete_many(keys)
+        self.bloom.add_many((), self.store.version())
+        return deleted
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def bloom_from_env(store):
+    """(store wrapped to maintain the filter, BloomFilter), or (store, None) if BLOOM_FILTER=off"""
+    if BLOOM_FILTER == 'off':
+        return store, None
+    path = os.environ.get('BLOOM_PATH', store.path + '.bloom')
+    bloom = BloomFilter(path, store.items, store.version)
+    return BloomStore(store, bloom), bloom
@@ -1,11 +1,19 @@
-import telebot
+import asyncio
+import io
+import random
+from collections import OrderedDict
+from telebot.async_telebot import AsyncTeleBot
 from telebot import types
-import requests
+import aiohttp
 import json
 from datetime import datetime
 import time
 import logging
 import os
+import re
+
+import serializer
+from record import compute_stats, effective_status
 
 # إعداد التسجيل (logging)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -15,43 +23,124 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get('BOT_TOKEN', "8023858119:AAHcuoFVKwKgArs3cc6dnaEGY7XpN5Q6Vog")
 DEVELOPER_ID = os.environ.get('DEVELOPER_ID', "5981205477")
 SERVER_URL = os.environ.get('SERVER_URL', "https://server5-3.onrender.com")
+BULK_CHUNK = int(os.environ.get('BULK_CHUNK', 500))
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 30))
+# عدد الطلبات المتزامنة للسيرفر وإعدادات الاتصال وإعادة المحاولة
+SERVER_CONCURRENCY = int(os.environ.get('SERVER_CONCURRENCY', 4))
+SERVER_TIMEOUT = float(os.environ.get('SERVER_TIMEOUT', 120))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 20))
+# عدد ردود GET المحفوظة مع ETag لإعادة استخدامها عند رد 304
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 64))
+# ping دوري لـ /healthz يبقي السيرفر مستيقظاً (الخطة المجانية تنام بعد 15 دقيقة خمول)، 0 لتعطيله
+KEEPWARM_INTERVAL = float(os.environ.get('KEEPWARM_INTERVAL', 600))
+KEEPWARM_RETRY = float(os.environ.get('KEEPWARM_RETRY', 15))
+# نسخة محلية من المفاتيح تُحدَّث من /changes بالفروقات فقط، تُعرض منها القائمة والإحصائيات والفحص
+MIRROR_PATH = os.environ.get('MIRROR_PATH', 'bot_mirror.json')
+MIRROR_MAX_AGE = float(os.environ.get('MIRROR_MAX_AGE', 30))
+# رمز مسارات /admin في السيرفر (تحليل الأداء والطلبات البطيئة)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
-bot = telebot.TeleBot(BOT_TOKEN)
+bot = AsyncTeleBot(BOT_TOKEN)
 user_data = {}
+next_steps = {}
+# المهام الجارية في الخلفية: الحلقة تحتفظ بالمهام بمرجع ضعيف فقط
+background_tasks = set()
+
+_session = None
+_server_slots = None
+# endpoint -> (etag, body) لطلبات GET
+_response_cache = OrderedDict()
+# حالة السيرفر كما رآها آخر ping: ready = None قبل أول فحص
+server_health = {'ready': None, 'checked': None, 'latency': None}
+# keys: مفتاح -> سجل (status, expiry, activated, resume, months, registered)
+# synced = None يعني أن النسخة تحتاج مزامنة قبل استخدامها
+mirror = {'version': 0, 'modified': 0, 'keys': {}, 'synced': None}
+_mirror_lock = None
+
+def get_session():
+    """جلسة HTTP واحدة مع اتصالات keep-alive مشتركة بين كل الطلبات"""
+    global _session, _server_slots
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=SERVER_CONCURRENCY, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=SERVER_TIMEOUT),
+            json_serialize=lambda obj: serializer.dumps(obj).decode()
+        )
+        _server_slots = asyncio.Semaphore(SERVER_CONCURRENCY)
+    return _session
+
+def cache_response(endpoint, etag, body):
+    """حفظ رد GET مع ETag الخاص به (LRU محدود الحجم)"""
+    if not etag or RESPONSE_CACHE_SIZE <= 0:
+        return
+    _response_cache[endpoint] = (etag, body)
+    _response_cache.move_to_end(endpoint)
+    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+def retry_delay(attempt):
+    """تأخير أسي مع عشوائية (full jitter) بين المحاولات"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
 
-def server_request(method, endpoint, data=None, max_retries=3):
-    """دالة محسنة مع إعادة المحاولة ومعالجة الأخطاء"""
+async def server_request(method, endpoint, data=None, max_retries=3, schema=None):
+    """دالة محسنة مع إعادة المحاولة ومعالجة الأخطاء (غير متزامنة)
+
+    schema: مخطط من serializer.py للتحقق من شكل الرد أثناء فك الترميز
+    """
+    session = get_session()
     for attempt in range(max_retries):
         try:
             url = f"{SERVER_URL}/{endpoint}"
             logger.info(f"محاولة {attempt + 1}/{max_retries}: {method} {url}")
             
-            if method == "GET":
-                response = requests.get(url, timeout=120)  # زيادة المهلة إلى 120 ثانية
-            else:
-                response = requests.post(url, json=data, timeout=120)
+            async with _server_slots:
+                cached = _response_cache.get(endpoint) if method == "GET" else None
+                headers = {}
+                if endpoint.startswith("admin/") and ADMIN_TOKEN:
+                    headers['X-Admin-Token'] = ADMIN_TOKEN
+                if method == "GET":
+                    # السيرفر يرد 304 بدون جسم إذا لم تتغير البيانات منذ آخر طلب
+                    if cached:
+                        headers['If-None-Match'] = cached[0]
+                    response = await session.get(url, headers=headers)
+                else:
+                    response = await session.post(url, json=data, headers=headers)
+                async with response:
+                    status = response.status
+                    if status == 304 and cached:
+                        _response_cache.move_to_end(endpoint)
+                        body = cached[1]
+                    elif status == 200:
+                        body = await response.read()
+                        if method == "GET":
+                            cache_response(endpoint, response.headers.get('ETag'), body)
+                    if status == 200 or (status == 304 and cached):
+                        if schema is not None:
+                            return schema.decode(body)
+                        return serializer.loads(body)
             
-            if response.status_code == 200:
-                return response.json()
-            elif attempt < max_retries - 1:
-                logger.warning(f"إعادة محاولة {attempt + 1}/{max_retries} بعد 5 ثواني...")
-                time.sleep(5)
+            if attempt < max_retries - 1:
+                delay = retry_delay(attempt)
+                logger.warning(f"إعادة محاولة {attempt + 1}/{max_retries} بعد {delay:.1f} ثانية...")
+                await asyncio.sleep(delay)
                 continue
             else:
-                logger.error(f"فشل بعد {max_retries} محاولات. Status code: {response.status_code}")
-                return {"error": f"http_error_{response.status_code}"}
+                logger.error(f"فشل بعد {max_retries} محاولات. Status code: {status}")
+                return {"error": f"http_error_{status}"}
                 
-        except requests.exceptions.Timeout:
+        except asyncio.TimeoutError:
             logger.error(f"⏰ مهلة الاتصال انتهت (محاولة {attempt + 1}/{max_retries})")
             if attempt < max_retries - 1:
-                time.sleep(5)
+                await asyncio.sleep(retry_delay(attempt))
                 continue
             return {"error": "timeout"}
             
-        except requests.exceptions.ConnectionError:
+        except aiohttp.ClientConnectionError:
             logger.error(f"🔌 خطأ في الاتصال (محاولة {attempt + 1}/{max_retries})")
             if attempt < max_retries - 1:
-                time.sleep(5)
+                await asyncio.sleep(retry_delay(attempt))
                 continue
             return {"error": "connection"}
             
@@ -61,12 +150,152 @@ def server_request(method, endpoint, data=None, max_retries=3):
     
     return {"error": "max_retries_exceeded"}
 
+async def server_download(endpoint, data):
+    """طلب POST يعيد ملفاً (CSV/NDJSON) يُقرأ على دفعات: (الملف، الترويسات) أو None عند الفشل
+
+    بدون إعادة محاولة: إعادة طلب التوليد تنشئ دفعة مفاتيح ثانية
+    """
+    session = get_session()
+    url = f"{SERVER_URL}/{endpoint}"
+    logger.info(f"POST {url}")
+    try:
+        async with _server_slots:
+            async with session.post(url, json=data) as response:
+                if response.status != 200:
+                    logger.error(f"فشل التحميل. Status code: {response.status}")
+                    return None
+                document = io.BytesIO()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    document.write(chunk)
+                document.seek(0)
+                return document, response.headers
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.error(f"❌ فشل التحميل: {e!r}")
+        return None
+
+async def ping_server():
+    """طلب /healthz خفيف: يوقظ السيرفر إن كان نائماً ويسجل جاهزيته"""
+    started = time.monotonic()
+    try:
+        async with get_session().get(f"{SERVER_URL}/healthz") as response:
+            ready = response.status == 200
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        ready = False
+    server_health.update(ready=ready, checked=time.time(), latency=time.monotonic() - started)
+    return ready
+
+async def keep_warm():
+    """ping كل KEEPWARM_INTERVAL، وكل KEEPWARM_RETRY ثانية ما دام السيرفر لا يرد"""
+    while True:
+        was_ready = server_health['ready']
+        ready = await ping_server()
+        if ready and not was_ready:
+            logger.info(f"🟢 السيرفر جاهز ({server_health['latency']:.1f} ثانية)")
+        elif not ready:
+            logger.warning("🟡 السيرفر لا يرد على /healthz، إعادة الفحص قريباً")
+        await asyncio.sleep(KEEPWARM_INTERVAL if ready else KEEPWARM_RETRY)
+
+def server_status_line():
+    """سطر حالة السيرفر لرسالة البداية"""
+    if server_health['ready']:
+        return f"🟢 السيرفر جاهز ({server_health['latency']:.1f} ثانية)"
+    if server_health['ready'] is False:
+        return "🟡 السيرفر يستيقظ، قد تتأخر أول عملية"
+    return "⚪ حالة السيرفر غير معروفة بعد"
+
+def load_mirror():
+    """تحميل آخر نسخة محفوظة على القرص، ما لم تكن لسيرفر آخر"""
+    try:
+        with open(MIRROR_PATH, 'rb') as f:
+            saved = serializer.loads(f.read())
+    except (OSError, ValueError):
+        return
+    if saved.get('server') != SERVER_URL:
+        return
+    fields = saved['fields']
+    mirror.update(
+        version=saved['version'], modified=saved['modified'], synced=None,
+        keys={key: dict(zip(fields, row)) for key, row in saved['keys'].items()}
+    )
+    logger.info(f"📂 النسخة المحلية: {len(mirror['keys'])} مفتاح (إصدار {mirror['version']})")
+
+def save_mirror(fields):
+    """حفظ النسخة على القرص (كتابة ذرية عبر ملف مؤقت)"""
+    data = {
+        'server': SERVER_URL,
+        'version': mirror['version'],
+        'modified': mirror['modified'],
+        'fields': fields,
+        'keys': {key: [record.get(field) for field in fields] for key, record in mirror['keys'].items()}
+    }
+    tmp_path = MIRROR_PATH + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(serializer.dumps(data, pretty=False))
+        os.replace(tmp_path, MIRROR_PATH)
+    except OSError as e:
+        logger.warning(f"⚠️ تعذر حفظ النسخة المحلية: {e}")
+
+def mark_mirror_stale():
+    """بعد أي تعديل من البوت: المزامنة التالية تجلب التغيير فوراً"""
+    mirror['synced'] = None
+
+async def sync_mirror():
+    """جلب التغييرات منذ آخر إصدار، True إذا كانت النسخة المحلية صالحة للاستخدام"""
+    global _mirror_lock
+    if _mirror_lock is None:
+        _mirror_lock = asyncio.Lock()
+    async with _mirror_lock:
+        if mirror['synced'] is not None and time.monotonic() - mirror['synced'] < MIRROR_MAX_AGE:
+            return True
+        result = await server_request("GET", f"changes?since={mirror['version']}")
+        if not result or result.get("error"):
+            return False
+        fields = result['fields']
+        records = {key: dict(zip(fields, row)) for key, row in result['keys'].items() if row is not None}
+        if result['snapshot']:
+            # السيرفر لم يعد يحتفظ بالتغييرات منذ إصدارنا: نسخة كاملة
+            mirror['keys'] = records
+        else:
+            mirror['keys'].update(records)
+            # صف فارغ = مفتاح حُذف (نُقل إلى شارد آخر)
+            for key, row in result['keys'].items():
+                if row is None:
+                    mirror['keys'].pop(key, None)
+        mirror.update(version=result['version'], modified=result['modified'], synced=time.monotonic())
+        if result['keys'] or result['snapshot']:
+            save_mirror(fields)
+        return True
+
+def mirror_lookup(key):
+    """سجل المفتاح من النسخة المحلية بحالته الفعلية الآن، None إن لم يوجد"""
+    record = mirror['keys'].get(key)
+    if record is None:
+        return None
+    return dict(record, status=effective_status(record))
+
+def run_in_background(coro):
+    """تشغيل مهمة في الخلفية مع الاحتفاظ بمرجع لها حتى تنتهي"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def ask(chat_id, text, handler, *args):
+    """إرسال سؤال وتسجيل الدالة التي ستعالج الرد التالي في هذه المحادثة"""
+    await bot.send_message(chat_id, text)
+    next_steps[chat_id] = (handler, args)
+
 @bot.message_handler(commands=['start', 'بدء'])
-def send_welcome(message):
+async def send_welcome(message):
     if str(message.chat.id) != DEVELOPER_ID:
-        bot.reply_to(message, "⛔ هذا البوت للمطور فقط")
+        await bot.reply_to(message, "⛔ هذا البوت للمطور فقط")
         return
     
+    if not server_health['ready']:
+        # إيقاظ السيرفر في الخلفية بينما يقرأ المطور القائمة
+        run_in_background(ping_server())
+    
     markup = types.InlineKeyboardMarkup(row_width=2)
     btn1 = types.InlineKeyboardButton("🔑 تفعيل", callback_data="activate")
     btn2 = types.InlineKeyboardButton("⛔ إيقاف", callback_data="deactivate")
@@ -76,13 +305,18 @@ def send_welcome(message):
     btn6 = types.InlineKeyboardButton("▶️ استئناف", callback_data="resume")
     btn7 = types.InlineKeyboardButton("📊 إحصائيات", callback_data="stats")
     btn8 = types.InlineKeyboardButton("📋 قائمة", callback_data="list")
-    markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7, btn8)
+    btn9 = types.InlineKeyboardButton("📦 عمليات جماعية", callback_data="bulk")
+    btn10 = types.InlineKeyboardButton("🔬 تحليل الأداء", callback_data="profile")
+    btn11 = types.InlineKeyboardButton("🐢 الطلبات البطيئة", callback_data="slow")
+    btn12 = types.InlineKeyboardButton("🎲 توليد مفاتيح", callback_data="generate")
+    markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7, btn8, btn9, btn10, btn11, btn12)
     
     welcome = f"""
 🔥 بوت تفعيل أشرف
 ━━━━━━━━━━━━━━━━
 👨‍💻 المطور: @AShrf_771117678
 🌐 السيرفر: {SERVER_URL}
+{server_status_line()}
 ━━━━━━━━━━━━━━━━
 
 📌 الأوامر:
@@ -94,13 +328,21 @@ def send_welcome(message):
 /استئناف KEY
 /إحصائيات
 /قائمة
+/generate العدد المدة [csv|ndjson]
 """
-    bot.send_message(message.chat.id, welcome, reply_markup=markup)
+    await bot.send_message(message.chat.id, welcome, reply_markup=markup)
+
+# الأوامر (/start، /generate ...) تذهب إلى معالجاتها ولا تُعتبر رداً على السؤال المعلق
+@bot.message_handler(func=lambda message: message.chat.id in next_steps
+                     and not (message.text or '').startswith('/'))
+async def handle_next_step(message):
+    handler, args = next_steps.pop(message.chat.id)
+    await handler(message, *args)
 
 @bot.callback_query_handler(func=lambda call: True)
-def handle_buttons(call):
+async def handle_buttons(call):
     if str(call.message.chat.id) != DEVELOPER_ID:
-        bot.answer_callback_query(call.id, "⛔ غير مصرح")
+        await bot.answer_callback_query(call.id, "⛔ غير مصرح")
         return
     
     chat_id = call.message.chat.id
@@ -116,7 +358,7 @@ def handle_buttons(call):
             types.InlineKeyboardButton("دائم", callback_data="months_0"),
             types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
         )
-        bot.send_message(chat_id, "🔑 اختر مدة التفعيل:", reply_markup=markup)
+        await bot.send_message(chat_id, "🔑 اختر مدة التفعيل:", reply_markup=markup)
     
     elif call.data.startswith("months_"):
         months = call.data.replace("months_", "")
@@ -124,16 +366,13 @@ def handle_buttons(call):
             months_text = "دائم"
         else:
             months_text = f"{months} أشهر"
-        msg = bot.send_message(chat_id, f"📝 أرسل المفتاح لتفعيله لمدة {months_text}")
-        bot.register_next_step_handler(msg, process_activation, months)
+        await ask(chat_id, f"📝 أرسل المفتاح لتفعيله لمدة {months_text}", process_activation, months)
     
     elif call.data == "deactivate":
-        msg = bot.send_message(chat_id, "⛔ أرسل المفتاح للإيقاف")
-        bot.register_next_step_handler(msg, process_deactivation)
+        await ask(chat_id, "⛔ أرسل المفتاح للإيقاف", process_deactivation)
     
     elif call.data == "check":
-        msg = bot.send_message(chat_id, "🔍 أرسل المفتاح للتحقق")
-        bot.register_next_step_handler(msg, process_check)
+        await ask(chat_id, "🔍 أرسل المفتاح للتحقق", process_check)
     
     elif call.data == "extend":
         markup = types.InlineKeyboardMarkup(row_width=3)
@@ -144,12 +383,11 @@ def handle_buttons(call):
             types.InlineKeyboardButton("12 شهر", callback_data="extend_12"),
             types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
         )
-        bot.send_message(chat_id, "➕ اختر مدة التمديد:", reply_markup=markup)
+        await bot.send_message(chat_id, "➕ اختر مدة التمديد:", reply_markup=markup)
     
     elif call.data.startswith("extend_"):
         months = call.data.replace("extend_", "")
-        msg = bot.send_message(chat_id, f"📝 أرسل المفتاح لتمديده {months} أشهر")
-        bot.register_next_step_handler(msg, process_extend, months)
+        await ask(chat_id, f"📝 أرسل المفتاح لتمديده {months} أشهر", process_extend, months)
     
     elif call.data == "suspend":
         markup = types.InlineKeyboardMarkup(row_width=3)
@@ -163,62 +401,282 @@ def handle_buttons(call):
             types.InlineKeyboardButton("أسبوع", callback_data="suspend_168"),
             types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
         )
-        bot.send_message(chat_id, "⏸️ اختر مدة التعليق:", reply_markup=markup)
+        await bot.send_message(chat_id, "⏸️ اختر مدة التعليق:", reply_markup=markup)
     
     elif call.data.startswith("suspend_"):
         hours = call.data.replace("suspend_", "")
-        msg = bot.send_message(chat_id, f"📝 أرسل المفتاح لتعليقه {hours} ساعة")
-        bot.register_next_step_handler(msg, process_suspend, hours)
+        await ask(chat_id, f"📝 أرسل المفتاح لتعليقه {hours} ساعة", process_suspend, hours)
     
     elif call.data == "resume":
-        msg = bot.send_message(chat_id, "▶️ أرسل المفتاح للاستئناف")
-        bot.register_next_step_handler(msg, process_resume)
+        await ask(chat_id, "▶️ أرسل المفتاح للاستئناف", process_resume)
     
     elif call.data == "stats":
-        result = server_request("GET", "stats")
-        if result and not result.get("error"):
-            stats = result
+        if await sync_mirror():
+            stats = compute_stats(mirror['keys'].values())
             msg = f"""
 📊 إحصائيات النظام
 ━━━━━━━━━━━━━━━━
-🔑 إجمالي المفاتيح: {stats.get('total_keys', 0)}
-✅ نشط: {stats.get('active_keys', 0)}
-⏸️ معلق: {stats.get('suspended_keys', 0)}
-⛔ موقوف: {stats.get('inactive_keys', 0)}
+🔑 إجمالي المفاتيح: {stats['total_keys']}
+✅ نشط: {stats['active_keys']}
+⏸️ معلق: {stats['suspended_keys']}
+⛔ موقوف: {stats['inactive_keys']}
 ━━━━━━━━━━━━━━━━
 👨‍💻 المطور: @AShrf_771117678
 """
         else:
             msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية وحاول مرة أخرى"
-        bot.send_message(chat_id, msg)
+        await bot.send_message(chat_id, msg)
     
     elif call.data == "list":
-        result = server_request("GET", "list")
-        if result and not result.get("error"):
-            keys = result.get('keys', [])
-            if not keys:
-                bot.send_message(chat_id, "📋 لا يوجد عملاء حالياً")
-            else:
-                msg = "📋 قائمة العملاء\n━━━━━━━━━━━━━━━━\n"
-                for k in keys:
-                    icon = "✅" if k['status'] == 'active' else "⏸️" if k['status'] == 'suspended' else "⛔"
-                    expiry = k['expiry'].replace('T', ' ')[:16] if k['expiry'] != 'permanent' else 'دائم'
-                    registered = "🔒" if k.get('registered') else "🆓"
-                    msg += f"{icon} {registered} `{k['key']}` - {expiry}\n"
-                bot.send_message(chat_id, msg, parse_mode="Markdown")
-        else:
-            bot.send_message(chat_id, "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية وحاول مرة أخرى")
+        user_data[chat_id] = {'list_pages': [None]}
+        await show_list_page(chat_id)
+    
+    elif call.data in ("list_next", "list_prev"):
+        state = user_data.setdefault(chat_id, {'list_pages': [None]})
+        pages = state.setdefault('list_pages', [None])
+        if call.data == "list_next" and state.get('list_next'):
+            pages.append(state['list_next'])
+        elif call.data == "list_prev" and len(pages) > 1:
+            pages.pop()
+        await show_list_page(chat_id, call.message.message_id)
+    
+    elif call.data == "bulk":
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(
+            types.InlineKeyboardButton("🔑 تفعيل جماعي", callback_data="bulk_activate"),
+            types.InlineKeyboardButton("➕ تمديد جماعي", callback_data="bulk_extend"),
+            types.InlineKeyboardButton("⏸️ تعليق جماعي", callback_data="bulk_suspend"),
+            types.InlineKeyboardButton("⛔ إيقاف جماعي", callback_data="bulk_deactivate"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
+        )
+        await bot.send_message(chat_id, "📦 اختر العملية الجماعية:", reply_markup=markup)
+    
+    elif call.data == "bulk_activate":
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("1 شهر", callback_data="bmonths_1"),
+            types.InlineKeyboardButton("3 شهور", callback_data="bmonths_3"),
+            types.InlineKeyboardButton("6 شهور", callback_data="bmonths_6"),
+            types.InlineKeyboardButton("12 شهر", callback_data="bmonths_12"),
+            types.InlineKeyboardButton("24 شهر", callback_data="bmonths_24"),
+            types.InlineKeyboardButton("دائم", callback_data="bmonths_0"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="bulk")
+        )
+        await bot.send_message(chat_id, "🔑 اختر مدة التفعيل الجماعي:", reply_markup=markup)
+    
+    elif call.data == "bulk_extend":
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("1 شهر", callback_data="bextend_1"),
+            types.InlineKeyboardButton("3 شهور", callback_data="bextend_3"),
+            types.InlineKeyboardButton("6 شهور", callback_data="bextend_6"),
+            types.InlineKeyboardButton("12 شهر", callback_data="bextend_12"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="bulk")
+        )
+        await bot.send_message(chat_id, "➕ اختر مدة التمديد الجماعي:", reply_markup=markup)
+    
+    elif call.data == "bulk_suspend":
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("1 ساعة", callback_data="bsuspend_1"),
+            types.InlineKeyboardButton("6 ساعات", callback_data="bsuspend_6"),
+            types.InlineKeyboardButton("24 ساعة", callback_data="bsuspend_24"),
+            types.InlineKeyboardButton("48 ساعة", callback_data="bsuspend_48"),
+            types.InlineKeyboardButton("أسبوع", callback_data="bsuspend_168"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="bulk")
+        )
+        await bot.send_message(chat_id, "⏸️ اختر مدة التعليق الجماعي:", reply_markup=markup)
+    
+    elif call.data.startswith("bmonths_"):
+        months = call.data.replace("bmonths_", "")
+        await ask(chat_id, "📝 ألصق المفاتيح للتفعيل (مفتاح في كل سطر)", process_bulk, "activate", "months", months)
+    
+    elif call.data.startswith("bextend_"):
+        months = call.data.replace("bextend_", "")
+        await ask(chat_id, f"📝 ألصق المفاتيح لتمديدها {months} أشهر (مفتاح في كل سطر)", process_bulk, "extend", "months", months)
+    
+    elif call.data.startswith("bsuspend_"):
+        hours = call.data.replace("bsuspend_", "")
+        await ask(chat_id, f"📝 ألصق المفاتيح لتعليقها {hours} ساعة (مفتاح في كل سطر)", process_bulk, "suspend", "hours", hours)
+    
+    elif call.data == "bulk_deactivate":
+        await ask(chat_id, "📝 ألصق المفاتيح للإيقاف (مفتاح في كل سطر)", process_bulk, "deactivate", None, None)
+    
+    elif call.data == "profile":
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("10 ثوان", callback_data="profile_10"),
+            types.InlineKeyboardButton("30 ثانية", callback_data="profile_30"),
+            types.InlineKeyboardButton("60 ثانية", callback_data="profile_60"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
+        )
+        await bot.send_message(chat_id, "🔬 اختر مدة تحليل الأداء:", reply_markup=markup)
+    
+    elif call.data.startswith("profile_"):
+        seconds = int(call.data.replace("profile_", ""))
+        # التحليل يستغرق عدة ثوان: لا ننتظره هنا حتى لا يتعطل الرد على الزر
+        run_in_background(run_profile(chat_id, seconds))
+    
+    elif call.data == "slow":
+        await show_slow_requests(chat_id)
+    
+    elif call.data == "generate":
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("10", callback_data="gcount_10"),
+            types.InlineKeyboardButton("100", callback_data="gcount_100"),
+            types.InlineKeyboardButton("1000", callback_data="gcount_1000"),
+            types.InlineKeyboardButton("10000", callback_data="gcount_10000"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="back")
+        )
+        await bot.send_message(chat_id, "🎲 اختر عدد المفاتيح:", reply_markup=markup)
+    
+    elif call.data.startswith("gcount_"):
+        count = call.data.replace("gcount_", "")
+        markup = types.InlineKeyboardMarkup(row_width=3)
+        markup.add(
+            types.InlineKeyboardButton("1 شهر", callback_data=f"gmonths_{count}_1"),
+            types.InlineKeyboardButton("3 شهور", callback_data=f"gmonths_{count}_3"),
+            types.InlineKeyboardButton("6 شهور", callback_data=f"gmonths_{count}_6"),
+            types.InlineKeyboardButton("12 شهر", callback_data=f"gmonths_{count}_12"),
+            types.InlineKeyboardButton("دائم", callback_data=f"gmonths_{count}_0"),
+            types.InlineKeyboardButton("🔙 رجوع", callback_data="generate")
+        )
+        await bot.send_message(chat_id, f"🎲 اختر مدة تفعيل {count} مفتاح:", reply_markup=markup)
+    
+    elif call.data.startswith("gmonths_"):
+        _, count, months = call.data.split("_")
+        # التوليد والرفع قد يستغرقان عدة ثوان: لا ننتظرهما هنا حتى لا يتعطل الرد على الزر
+        run_in_background(generate_keys(chat_id, int(count), int(months)))
     
     elif call.data == "back":
-        send_welcome(call.message)
+        await send_welcome(call.message)
+    
+    await bot.answer_callback_query(call.id)
+
+@bot.message_handler(commands=['generate'])
+async def generate_command(message):
+    """/generate العدد المدة [csv|ndjson]"""
+    if str(message.chat.id) != DEVELOPER_ID:
+        await bot.reply_to(message, "⛔ هذا البوت للمطور فقط")
+        return
+    args = message.text.split()[1:]
+    try:
+        count = int(args[0])
+        months = int(args[1]) if len(args) > 1 else 1
+    except (IndexError, ValueError):
+        await bot.reply_to(message, "📝 الاستخدام: /generate العدد المدة [csv|ndjson]\nمثال: /generate 1000 3 (المدة 0 = دائم)")
+        return
+    fmt = args[2].lower() if len(args) > 2 else "csv"
+    await generate_keys(message.chat.id, count, months, fmt)
+
+async def generate_keys(chat_id, count, months, fmt="csv"):
+    """توليد المفاتيح في السيرفر ورفعها كملف بدلاً من إغراق المحادثة"""
+    await bot.send_message(chat_id, f"⏳ جاري توليد {count} مفتاح...")
+    result = await server_download("generate", {"count": count, "months": months, "format": fmt})
+    mark_mirror_stale()
+    if result is None:
+        await bot.send_message(chat_id, "❌ فشل توليد المفاتيح (تحقق من العدد والصيغة أو أعد المحاولة بعد 30 ثانية)")
+        return
+    document, headers = result
+    generated = int(headers.get('X-Generated-Count', 0))
+    duration = "دائم" if months == 0 else f"{months} أشهر"
+    caption = f"🎲 تم توليد {generated} مفتاح\n📅 المدة: {duration}"
+    if generated < count:
+        caption += f"\n⚠️ المطلوب {count}"
+    filename = re.search(r'filename="([^"]+)"', headers.get('Content-Disposition', ''))
+    await bot.send_document(chat_id, document, caption=caption,
+                            visible_file_name=filename.group(1) if filename else f"keys.{fmt}")
+
+async def run_profile(chat_id, seconds):
+    """تشغيل المحلل في السيرفر ثم إرسال المكدسات المجمعة كملف (صيغة flamegraph)"""
+    started = await server_request("POST", "admin/profile", {"seconds": seconds})
+    if not started or started.get("error"):
+        await bot.send_message(chat_id, "❌ تعذر بدء التحليل (تأكد من ADMIN_TOKEN في البوت والسيرفر)")
+        return
+    await bot.send_message(chat_id, f"⏳ جاري تحليل الأداء لمدة {seconds} ثانية...")
+    # العمال يكتبون نتائجهم بعد انتهاء المدة
+    await asyncio.sleep(max(0, started['until'] - time.time()) + 2)
+    result = await server_request("GET", "admin/profile")
+    if not result or result.get("error") or result.get("run") != started['run']:
+        await bot.send_message(chat_id, "❌ تعذر جلب نتيجة التحليل")
+        return
+    if not result['samples']:
+        await bot.send_message(chat_id, "📭 لم تصل طلبات للسيرفر أثناء التحليل")
+        return
+    
+    # أكثر الدوال ظهوراً في أعلى المكدس (حيث يُصرف الوقت فعلاً)
+    leaves = {}
+    for line in result['collapsed'].splitlines():
+        stack, _, count = line.rpartition(' ')
+        leaf = stack.rsplit(';', 1)[-1]
+        leaves[leaf] = leaves.get(leaf, 0) + int(count)
+    top = sorted(leaves.items(), key=lambda item: item[1], reverse=True)[:5]
+    caption = f"🔬 تحليل الأداء {result['run']}\n━━━━━━━━━━━━━━━━\n📈 العينات: {result['samples']} من {result['workers']} عامل\n"
+    caption += "\n".join(f"{count * 100 // result['samples']}% {leaf}" for leaf, count in top)
+    document = io.BytesIO(result['collapsed'].encode())
+    await bot.send_document(chat_id, document, caption=caption[:1000],
+                            visible_file_name=f"profile-{result['run']}.collapsed.txt")
+
+async def show_slow_requests(chat_id):
+    """عرض آخر الطلبات البطيئة مع توزيع وقتها على المراحل"""
+    result = await server_request("GET", "admin/slow?limit=10")
+    if not result or result.get("error"):
+        await bot.send_message(chat_id, "❌ تعذر جلب الطلبات البطيئة (تأكد من ADMIN_TOKEN في البوت والسيرفر)")
+        return
+    if not result['requests']:
+        await bot.send_message(chat_id, f"✅ لا توجد طلبات أبطأ من {result['threshold_ms']:g} ms")
+        return
+    msg = f"🐢 الطلبات البطيئة (أكثر من {result['threshold_ms']:g} ms)\n━━━━━━━━━━━━━━━━"
+    for item in result['requests']:
+        when = datetime.fromtimestamp(item['ts'] / 1000).strftime('%H:%M:%S')
+        phases = " ".join(f"{name}={ms:g}" for name, ms in item['phases'].items())
+        msg += f"\n{when} {item['method']} {item['path']} → {item['status']} في {item['ms']:g} ms\n   {phases} other={item['other_ms']:g}"
+    await bot.send_message(chat_id, msg[:4000])
+
+async def show_list_page(chat_id, message_id=None):
+    """عرض صفحة من قائمة العملاء مع أزرار التالي/السابق"""
+    state = user_data.setdefault(chat_id, {'list_pages': [None]})
+    pages = state.setdefault('list_pages', [None])
+    if not await sync_mirror():
+        await bot.send_message(chat_id, "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية وحاول مرة أخرى")
+        return
+    
+    # نفس ترتيب /list في السيرفر: المؤشر هو آخر مفتاح في الصفحة السابقة
+    keys = sorted(key for key in mirror['keys'] if pages[-1] is None or key > pages[-1])
+    if not keys and len(pages) == 1:
+        await bot.send_message(chat_id, "📋 لا يوجد عملاء حالياً")
+        return
     
-    bot.answer_callback_query(call.id)
+    page = keys[:LIST_PAGE_SIZE]
+    state['list_next'] = page[-1] if len(keys) > LIST_PAGE_SIZE else None
+    msg = f"📋 قائمة العملاء - صفحة {len(pages)}\n━━━━━━━━━━━━━━━━\n"
+    for key in page:
+        k = mirror['keys'][key]
+        icon = {'active': "✅", 'suspended': "⏸️", 'expired': "⌛"}.get(k['status'], "⛔")
+        expiry = k['expiry'].replace('T', ' ')[:16] if k['expiry'] != 'permanent' else 'دائم'
+        registered = "🔒" if k.get('registered') else "🆓"
+        msg += f"{icon} {registered} `{key}` - {expiry}\n"
+    
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    if len(pages) > 1:
+        buttons.append(types.InlineKeyboardButton("⬅️ السابق", callback_data="list_prev"))
+    if state['list_next']:
+        buttons.append(types.InlineKeyboardButton("التالي ➡️", callback_data="list_next"))
+    markup.add(*buttons)
+    
+    if message_id:
+        await bot.edit_message_text(msg, chat_id, message_id, parse_mode="Markdown", reply_markup=markup)
+    else:
+        await bot.send_message(chat_id, msg, parse_mode="Markdown", reply_markup=markup)
 
-def process_activation(message, months):
+async def process_activation(message, months):
     if str(message.chat.id) != DEVELOPER_ID:
         return
     key = message.text.strip().upper()
-    result = server_request("POST", "activate", {"key": key, "months": int(months)})
+    result = await server_request("POST", "activate", {"key": key, "months": int(months)})
+    mark_mirror_stale()
     if result and not result.get("error"):
         if months == "0":
             msg = f"✅ تم تفعيل المفتاح\n🔑 {key}\n📅 دائم"
@@ -227,22 +685,27 @@ def process_activation(message, months):
             msg = f"✅ تم تفعيل المفتاح\n🔑 {key}\n⏰ المدة: {months} أشهر\n📅 ينتهي: {expiry}"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
 
-def process_deactivation(message):
+async def process_deactivation(message):
     if str(message.chat.id) != DEVELOPER_ID:
         return
     key = message.text.strip().upper()
-    result = server_request("POST", "deactivate", {"key": key})
+    result = await server_request("POST", "deactivate", {"key": key})
+    mark_mirror_stale()
     if result and not result.get("error"):
         msg = f"⛔ تم إيقاف المفتاح\n🔑 {key}"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
 
-def process_check(message):
+async def process_check(message):
     key = message.text.strip().upper()
-    result = server_request("GET", f"check/{key}")
+    if await sync_mirror():
+        record = mirror_lookup(key)
+        result = dict(record, found=True) if record else {'found': False}
+    else:
+        result = await server_request("POST", f"check/{key}", {}, schema=serializer.CHECK_RESPONSE)
     if result and not result.get("error") and result.get('found'):
         status = result.get('status', 'unknown')
         expiry = result.get('expiry', '')
@@ -251,48 +714,103 @@ def process_check(message):
         if resume and status == 'suspended':
             expiry_text = f"معلق حتى {resume.replace('T', ' ')[:16]}"
         registered = "🔒 (مقفل)" if result.get('registered') else "🆓 (مفتوح)"
-        status_icon = {'active': '✅ نشط', 'suspended': '⏸️ معلق', 'inactive': '⛔ موقوف'}.get(status, status)
+        status_icon = {'active': '✅ نشط', 'suspended': '⏸️ معلق', 'inactive': '⛔ موقوف', 'expired': '⌛ منتهي'}.get(status, status)
         msg = f"🔍 معلومات المفتاح\n━━━━━━━━━━━━━━━━\n🔑 المفتاح: {key}\n📊 الحالة: {status_icon}\n📅 الانتهاء: {expiry_text}\n🔐 الحماية: {registered}"
     elif result and result.get('found') is False:
         msg = f"❌ المفتاح {key} غير موجود"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
 
-def process_extend(message, months):
+async def process_extend(message, months):
     if str(message.chat.id) != DEVELOPER_ID:
         return
     key = message.text.strip().upper()
-    result = server_request("POST", "extend", {"key": key, "months": int(months)})
+    result = await server_request("POST", "extend", {"key": key, "months": int(months)})
+    mark_mirror_stale()
     if result and not result.get("error"):
         expiry = result.get('expiry', '').replace('T', ' ')[:16] if 'T' in result.get('expiry', '') else result.get('expiry', '')
         msg = f"➕ تم تمديد المفتاح\n🔑 {key}\n⏰ إضافة: {months} أشهر\n📅 ينتهي: {expiry}"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
 
-def process_suspend(message, hours):
+async def process_suspend(message, hours):
     if str(message.chat.id) != DEVELOPER_ID:
         return
     key = message.text.strip().upper()
-    result = server_request("POST", "suspend", {"key": key, "hours": int(hours)})
+    result = await server_request("POST", "suspend", {"key": key, "hours": int(hours)})
+    mark_mirror_stale()
     if result and not result.get("error"):
         resume = result.get('resume', '').replace('T', ' ')[:16]
         msg = f"⏸️ تم تعليق المفتاح\n🔑 {key}\n⏰ المدة: {hours} ساعة\n📅 يستأنف: {resume}"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
 
-def process_resume(message):
+async def process_resume(message):
     if str(message.chat.id) != DEVELOPER_ID:
         return
     key = message.text.strip().upper()
-    result = server_request("POST", "resume", {"key": key})
+    result = await server_request("POST", "resume", {"key": key})
+    mark_mirror_stale()
     if result and not result.get("error"):
         msg = f"▶️ تم استئناف المفتاح\n🔑 {key}"
     else:
         msg = "❌ السيرفر يستجيب ببطء، انتظر 30 ثانية ثم أعد المحاولة"
-    bot.reply_to(message, msg)
+    await bot.reply_to(message, msg)
+
+def parse_keys(text):
+    """استخراج المفاتيح من نص ملصوق (أسطر أو مسافات أو فواصل)"""
+    keys = []
+    seen = set()
+    for key in re.split(r'[\s,;]+', text or ''):
+        key = key.strip().upper()
+        if key and key not in seen:
+            seen.add(key)
+            keys.append(key)
+    return keys
+
+async def process_bulk(message, action, field, value):
+    if str(message.chat.id) != DEVELOPER_ID:
+        return
+    keys = parse_keys(message.text)
+    if not keys:
+        await bot.reply_to(message, "❌ لم يتم العثور على مفاتيح")
+        return
+    
+    chunks = [keys[i:i + BULK_CHUNK] for i in range(0, len(keys), BULK_CHUNK)]
+    
+    async def send_chunk(chunk):
+        data = {"keys": chunk}
+        if field:
+            data[field] = int(value)
+        return chunk, await server_request("POST", f"batch/{action}", data)
+    
+    # الدفعات تُرسل بالتوازي، والحد الأقصى للتزامن يضبطه SERVER_CONCURRENCY
+    succeeded = []
+    failed = []
+    results = await asyncio.gather(*(send_chunk(chunk) for chunk in chunks))
+    mark_mirror_stale()
+    for chunk, result in results:
+        if result and not result.get("error"):
+            for item in result.get('results', []):
+                (succeeded if item.get('success') else failed).append(item['key'])
+        else:
+            failed.extend(chunk)
+    
+    titles = {
+        'activate': '🔑 تفعيل جماعي',
+        'extend': '➕ تمديد جماعي',
+        'suspend': '⏸️ تعليق جماعي',
+        'deactivate': '⛔ إيقاف جماعي'
+    }
+    msg = f"{titles[action]}\n━━━━━━━━━━━━━━━━\n✅ نجح: {len(succeeded)}\n❌ فشل: {len(failed)}"
+    if failed:
+        shown = "\n".join(failed[:50])
+        more = f"\n... و {len(failed) - 50} أخرى" if len(failed) > 50 else ""
+        msg += f"\n━━━━━━━━━━━━━━━━\n{shown}{more}"
+    await bot.reply_to(message, msg)
 
 if __name__ == "__main__":
     print("✅ بوت أشرف - جميع الأوامر مفعلة")
@@ -300,12 +818,11 @@ if __name__ == "__main__":
     print(f"🌐 السيرفر: {SERVER_URL}")
     print("🔄 بدء تشغيل البوت مع نظام إعادة الاتصال التلقائي...")
     
-    # نظام إعادة الاتصال التلقائي
-    while True:
-        try:
-            bot.polling(none_stop=True, interval=0, timeout=30)
-        except Exception as e:
-            logger.error(f"❌ خطأ في الاتصال: {e}")
-            logger.info("🔄 إعادة الاتصال بعد 10 ثواني...")
-            time.sleep(10)
-            continue
\ No newline at end of file
+    async def main():
+        load_mirror()
+        if KEEPWARM_INTERVAL > 0:
+            run_in_background(keep_warm())
+        # نظام إعادة الاتصال التلقائي (infinity_polling يعيد الاتصال عند الأخطاء)
+        await bot.infinity_polling(timeout=30)
+    
+    asyncio.run(main())
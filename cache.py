@@ -0,0 +1,135 @@
+"""In-process LRU cache of activation records in front of a store."""
+import threading
+import time
+from collections import OrderedDict
+
+from record import Record
+
+
+class RecordCache:
+    """Bounded LRU of key -> record with hit/miss counters
+
+    ``ttl`` bounds how long an entry may be served, which limits staleness
+    when another gunicorn worker writes the same key. Entries are held as
+    compact ``Record`` objects and handed out as fresh dicts.
+
+    Every invalidation bumps ``generation``; a fill read from the store
+    passes the generation it started at and is dropped if a write
+    invalidated anything since, so an older record never replaces a newer
+    one for the length of the TTL.
+    """
+
+    def __init__(self, size=10000, ttl=5.0):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, record = entry
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return record.to_dict()
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, record, generation=None):
+        if self.size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic(), Record.from_dict(record))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class CachedStore:
+    """Store wrapper: reads go through the cache, writes go through to the store"""
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def get(self, key):
+        record = self.cache.get(key)
+        if record is None:
+            generation = self.cache.generation
+            record = self.store.get(key)
+            if record is not None:
+                self.cache.set(key, record, generation)
+        return record
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def put_many(self, items):
+        # Invalidated rather than filled: with concurrent writers the last
+        # fill is not necessarily the last commit
+        items = list(items)
+        for key, _ in items:
+            self.cache.invalidate(key)
+        self.store.put_many(items)
+        for key, _ in items:
+            self.cache.invalidate(key)
+
+    def insert_many(self, items):
+        # Not cached: a batch of new keys would evict the ones /check is reading
+        inserted = self.store.insert_many(items)
+        for key in inserted:
+            self.cache.invalidate(key)
+        return inserted
+
+    def modify_many(self, ops):
+        ops = list(ops)
+        for key, _ in ops:
+            self.cache.invalidate(key)
+        records = self.store.modify_many(ops)
+        for key, _ in ops:
+            self.cache.invalidate(key)
+        return records
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        deleted = self.store.delete_many(keys)
+        for key in keys:
+            self.cache.invalidate(key)
+        return deleted
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
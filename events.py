@@ -0,0 +1,215 @@
+"""Append-only log of /check and admin events, written off the request path.
+
+Routes call ``emit``, which only puts the event on a bounded queue; a
+background thread drains it in batches into gzip-compressed NDJSON
+segments under ``EVENT_LOG_DIR``. When the queue is full the event is
+dropped and counted rather than making the request wait. Each process
+writes its own segments (``events-<day>-<time>-<pid>.ndjson.gz``), so
+gunicorn workers never interleave lines; a segment is closed at the end
+of the day or once it reaches ``EVENT_SEGMENT_BYTES``. Every batch is its
+own gzip member, so a killed worker loses at most the batch in flight.
+
+    EVENT_LOG=on  EVENT_LOG_DIR=events  EVENT_QUEUE_SIZE=10000
+    EVENT_BATCH=500  EVENT_FLUSH_INTERVAL=1  EVENT_SEGMENT_BYTES=16777216
+
+Rollups stream the segments line by line, keeping only the per-day or
+per-key/day counters in memory:
+
+    python events.py rollup --by day [--since 2026-01-01] [--until 2026-02-01]
+    python events.py rollup --by key [--event check]
+
+Each row counts ``<event>:<outcome>``; a /check outcome is the key's status
+(active, suspended, ...), ``not_found`` for a key the server does not hold,
+``blocked``, ``rate_limited`` or ``bad_request``.
+"""
+import atexit
+import glob
+import gzip
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import serializer
+
+EVENT_LOG = os.environ.get('EVENT_LOG', 'on')
+EVENT_LOG_DIR = os.environ.get('EVENT_LOG_DIR', 'events')
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 10000))
+EVENT_BATCH = int(os.environ.get('EVENT_BATCH', 500))
+EVENT_FLUSH_INTERVAL = float(os.environ.get('EVENT_FLUSH_INTERVAL', 1))
+EVENT_SEGMENT_BYTES = int(os.environ.get('EVENT_SEGMENT_BYTES', 16 * 1024 * 1024))
+
+SEGMENT_PATTERN = 'events-*.ndjson.gz'
+
+
+class EventLog:
+    """Bounded queue plus the background thread writing it to segments"""
+
+    def __init__(self, directory=EVENT_LOG_DIR, queue_size=EVENT_QUEUE_SIZE, batch=EVENT_BATCH,
+                 flush_interval=EVENT_FLUSH_INTERVAL, segment_bytes=EVENT_SEGMENT_BYTES):
+        self.directory = directory
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._segment = None
+        self._segment_day = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        # The writer thread and close() at exit may both write
+        self._write_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def emit(self, event, key=None, **fields):
+        """Queue an event; never blocks, drops it if the writer is behind"""
+        if self._pid != os.getpid():
+            self._start()
+        item = {'ts': int(time.time() * 1000), 'event': event}
+        if key is not None:
+            item['key'] = key
+        item.update(fields)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # Started lazily so each forked gunicorn worker gets its own writer
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Inherited from the parent: its queue and segment are not ours
+                self.queue = queue.Queue(self.queue.maxsize)
+                self._segment = None
+                self._write_lock = threading.Lock()
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                events = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            self._drain_into(events)
+            self._write(events)
+
+    def _drain_into(self, events):
+        while len(events) < self.batch:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def _segment_path(self, day):
+        if self._segment is None or self._segment_day != day or \
+                os.path.getsize(self._segment) >= self.segment_bytes:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+            self._segment = os.path.join(self.directory, f'events-{stamp}-{os.getpid()}.ndjson.gz')
+            self._segment_day = day
+        return self._segment
+
+    def _write(self, events):
+        data = b''.join(serializer.dumps(event, pretty=False) + b'\n' for event in events)
+        try:
+            with self._write_lock, gzip.open(self._segment_path(time.strftime('%Y%m%d')), 'ab') as f:
+                f.write(data)
+        except OSError as e:
+            self.failed += len(events)
+            print(f"❌ Event log write failed: {e}")
+            return
+        self.written += len(events)
+
+    def close(self):
+        """Write out whatever is still queued (at exit)"""
+        if self._pid != os.getpid():
+            return
+        events = []
+        self._drain_into(events)
+        while events:
+            self._write(events)
+            events = []
+            self._drain_into(events)
+
+    def info(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                'failed': self.failed}
+
+
+def event_log_from_env():
+    """EventLog for EVENT_LOG_DIR, or None if EVENT_LOG=off"""
+    if EVENT_LOG == 'off':
+        return None
+    return EventLog()
+
+
+def read_events(directory=EVENT_LOG_DIR):
+    """Every event in the segments under `directory`, one at a time"""
+    for path in sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN))):
+        try:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        yield serializer.loads(line)
+        except (EOFError, gzip.BadGzipFile) as e:
+            # A worker killed mid-batch leaves a truncated last member
+            print(f"⚠️ {path}: {e}", file=sys.stderr)
+
+
+def event_day(event):
+    return datetime.fromtimestamp(event['ts'] / 1000).strftime('%Y-%m-%d')
+
+
+def outcome(event):
+    """What happened: /check outcome, or success/failure of an admin action"""
+    if 'outcome' in event:
+        return event['outcome']
+    return 'ok' if event.get('success', True) else 'failed'
+
+
+def rollup(events, by='day', since=None, until=None, event=None):
+    """Counts per day (and per key with by='key'), as sorted rows"""
+    groups = defaultdict(Counter)
+    for item in events:
+        day = event_day(item)
+        if (since and day < since) or (until and day >= until) or (event and item['event'] != event):
+            continue
+        group = (day,) if by == 'day' else (item.get('key', ''), day)
+        counts = groups[group]
+        counts['total'] += 1
+        counts[f"{item['event']}:{outcome(item)}"] += 1
+        for error in item.get('errors', ()):
+            counts[f'error:{error}'] += 1
+    for group in sorted(groups):
+        row = {'day': group[0]} if by == 'day' else {'key': group[0], 'day': group[1]}
+        row.update(sorted(groups[group].items()))
+        yield row
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Event log tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('rollup', help='Per-day or per-key/day counts as NDJSON')
+    command.add_argument('--dir', default=EVENT_LOG_DIR)
+    command.add_argument('--by', choices=('day', 'key'), default='day')
+    command.add_argument('--since', help='first day included (YYYY-MM-DD)')
+    command.add_argument('--until', help='first day excluded (YYYY-MM-DD)')
+    command.add_argument('--event', help='only this event (check, activate, ...)')
+    args = parser.parse_args(argv)
+
+    out = sys.stdout.buffer
+    for row in rollup(read_events(args.dir), args.by, args.since, args.until, args.event):
+        out.write(serializer.dumps(row, pretty=False) + b'\n')
+
+
+if __name__ == '__main__':
+    main()
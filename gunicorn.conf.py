@@ -0,0 +1,9 @@
+"""gunicorn settings, read from the working directory by ``gunicorn server:app``."""
+import os
+import secrets
+
+
+def on_starting(server):
+    # One id per master start, inherited by every worker it forks: the
+    # workers of this boot share the index and Bloom filter one of them built
+    os.environ['BOOT_ID'] = str(secrets.randbits(63))
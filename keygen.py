@@ -0,0 +1,96 @@
+"""Random activation keys for /generate and the streamed export of the keys created.
+
+A key is GENERATE_GROUPS groups of GENERATE_GROUP_SIZE characters drawn with
+``secrets`` from an alphabet without look-alikes (no 0/O, 1/I/L), e.g.
+``K7QM-2XHT-9WRC-BN4E``: 31^16, about 2^79 keys with the defaults. The store
+still checks every key (``insert_many`` only inserts keys it does not
+hold), and a key that was taken is drawn again.
+
+The export is written in chunks of EXPORT_CHUNK rows, so a response of
+100k keys is never held as one body:
+
+    csv     key,status,months,expiry,activated (header line first)
+    ndjson  one {"key", "status", "months", "expiry", "activated"} per line
+"""
+import csv
+import io
+import os
+import secrets
+import time
+
+import serializer
+
+GENERATE_MAX = int(os.environ.get('GENERATE_MAX', 100000))
+GENERATE_GROUPS = int(os.environ.get('GENERATE_GROUPS', 4))
+GENERATE_GROUP_SIZE = int(os.environ.get('GENERATE_GROUP_SIZE', 4))
+# Draws of the keys still missing before /generate gives up on the rest
+GENERATE_ATTEMPTS = 5
+EXPORT_CHUNK = 1000
+
+ALPHABET = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
+MAX_PREFIX = 16
+EXPORT_FIELDS = ('key', 'status', 'months', 'expiry', 'activated')
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def new_key(prefix=''):
+    groups = [''.join(secrets.choice(ALPHABET) for _ in range(GENERATE_GROUP_SIZE))
+              for _ in range(GENERATE_GROUPS)]
+    return prefix + '-'.join(groups)
+
+
+def candidates(count, prefix=''):
+    """`count` distinct random keys"""
+    keys = set()
+    while len(keys) < count:
+        keys.add(new_key(prefix))
+    return list(keys)
+
+
+def parse_request(data):
+    """(count, months, prefix, format) from a /generate body, None if invalid"""
+    data = data if isinstance(data, dict) else {}
+    try:
+        count = int(data.get('count', 1))
+        months = int(data.get('months', 1))
+    except (TypeError, ValueError):
+        return None
+    prefix = str(data.get('prefix') or '').strip().upper()
+    fmt = data.get('format', 'csv')
+    if not 1 <= count <= GENERATE_MAX or months < 0 or fmt not in EXPORT_FORMATS:
+        return None
+    if len(prefix) > MAX_PREFIX or not all(c.isascii() and (c.isalnum() or c == '-') for c in prefix):
+        return None
+    return count, months, prefix, fmt
+
+
+def export_filename(fmt):
+    return f"keys-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}"
+
+
+def export_row(key, record):
+    return {'key': key, **{name: record.get(name) for name in EXPORT_FIELDS[1:]}}
+
+
+def export(records, fmt):
+    """Chunks of the csv/ndjson export of [(key, record)]"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        for count, (key, record) in enumerate(records, 1):
+            row = export_row(key, record)
+            writer.writerow([row[name] for name in EXPORT_FIELDS])
+            if count % EXPORT_CHUNK == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+    else:
+        chunk = []
+        for key, record in records:
+            chunk.append(serializer.dumps(export_row(key, record), pretty=False) + b'\n')
+            if len(chunk) >= EXPORT_CHUNK:
+                yield b''.join(chunk)
+                chunk = []
+        yield b''.join(chunk)
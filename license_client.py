@@ -0,0 +1,145 @@
+"""Reference verifier for the signed license tokens returned by /check.
+
+A protected client can keep the token from its last successful /check and
+validate it offline until it expires instead of calling the server on
+every launch:
+
+    verifier = LicenseVerifier.from_server(SERVER_URL)
+    revocations = RevocationList(SERVER_URL)
+    claims = verifier.verify(token, device_id, file_path, file_hash)
+    revocations.refresh()          # cheap: 304 while nothing changed
+    if revocations.is_revoked(claims):
+        ...                        # call /check again
+
+Tokens are ``base64url(payload).base64url(signature)``. The payload is
+compact sorted JSON with the key, status, license expiry, ``issued_at`` /
+``expires_at`` in epoch milliseconds, the key's revocation version when
+the token was issued (``rv``) and SHA-256 digests of the bound device id,
+path and file hash. /revocations lists each recently revoked key's current
+revocation version; a token is revoked once that is higher than its ``rv``. EdDSA tokens are checked against the
+server's public key (needs the ``cryptography`` package); HS256 tokens
+need the shared secret, so anyone holding it can also mint tokens.
+
+Only the standard library is required, so the file can be copied into a
+client as is.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# urllib.request and cryptography are imported where they are used: the
+# server imports this module for its helpers and should not pay for them
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def binding_digest(value):
+    """SHA-256 hex of a bound device id / path / file hash, as carried in tokens"""
+    return hashlib.sha256((value or '').encode()).hexdigest()
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class LicenseVerifier:
+    def __init__(self, alg, public_key=None, secret=None):
+        self.alg = alg
+        if alg == 'EdDSA':
+            try:
+                from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+            except ImportError:
+                raise RuntimeError("EdDSA tokens need the cryptography package") from None
+            self._public_key = Ed25519PublicKey.from_public_bytes(b64decode(public_key))
+        elif alg == 'HS256':
+            self._secret = secret.encode() if isinstance(secret, str) else secret
+        else:
+            raise ValueError(f"Unsupported token algorithm: {alg}")
+
+    @classmethod
+    def from_server(cls, server_url, secret=None, timeout=10):
+        """Verifier for the algorithm and public key published at /license/key"""
+        import urllib.request
+        with urllib.request.urlopen(f"{server_url.rstrip('/')}/license/key", timeout=timeout) as response:
+            info = json.load(response)
+        return cls(info['alg'], public_key=info.get('public_key'), secret=secret)
+
+    def _check_signature(self, signed, signature):
+        if self.alg == 'EdDSA':
+            from cryptography.exceptions import InvalidSignature
+            try:
+                self._public_key.verify(signature, signed)
+            except InvalidSignature:
+                raise InvalidToken("bad signature") from None
+        elif not hmac.compare_digest(hmac.new(self._secret, signed, hashlib.sha256).digest(), signature):
+            raise InvalidToken("bad signature")
+
+    def verify(self, token, device_id, file_path, file_hash, now=None):
+        """Claims of a valid, unexpired token bound to this device/path/file"""
+        try:
+            payload, signature = token.split('.')
+            signed = payload.encode()
+            self._check_signature(signed, b64decode(signature))
+            claims = json.loads(b64decode(payload))
+        except (ValueError, TypeError) as e:
+            raise InvalidToken(f"malformed token: {e}") from None
+        if claims.get('alg') != self.alg:
+            raise InvalidToken("unexpected algorithm")
+        if (now or now_ms()) >= claims['expires_at']:
+            raise InvalidToken("expired")
+        if claims.get('status') != 'active':
+            raise InvalidToken(f"key is {claims.get('status')}")
+        for field, value in (('device', device_id), ('path', file_path), ('file', file_hash)):
+            if not hmac.compare_digest(claims[field], binding_digest(value)):
+                raise InvalidToken(f"different {field}")
+        return claims
+
+
+class RevocationList:
+    """Polls /revocations with If-None-Match, so an unchanged list costs a 304"""
+
+    def __init__(self, server_url, timeout=10):
+        self.url = f"{server_url.rstrip('/')}/revocations"
+        self.timeout = timeout
+        self.etag = None
+        self.revoked = {}
+
+    def refresh(self):
+        """Fetch the list if it changed; returns True when it did"""
+        import urllib.error
+        import urllib.request
+        request = urllib.request.Request(self.url)
+        if self.etag:
+            request.add_header('If-None-Match', self.etag)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = json.load(response)
+                self.etag = response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return False
+            raise
+        self.revoked = body['revoked']
+        return True
+
+    def is_revoked(self, claims):
+        """A token is revoked if its key was deactivated/suspended after it was issued"""
+        revocation = self.revoked.get(claims['key'])
+        if revocation is None:
+            return False
+        if 'rv' in claims:
+            return revocation > claims['rv']
+        # Tokens from before revocation versions
+        return claims['issued_at'] <= revocation
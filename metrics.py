@@ -0,0 +1,216 @@
+"""Prometheus-style metrics for the Flask app.
+
+Counters and histograms are plain in-process dicts guarded by one lock,
+rendered in the Prometheus text exposition format by ``/metrics``. Each
+gunicorn worker keeps its own numbers; ``process_info{pid=...}`` shows
+which worker answered a scrape.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request
+
+from profiler import add_phase
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+STORE_READS = ('get', 'get_many', 'scan', 'items', 'stats', 'count', 'due', 'next_due', 'revocations',
+               'version', 'changes')
+STORE_WRITES = ('put', 'put_many', 'insert_many', 'modify', 'modify_many', 'delete_many', 'reconcile',
+                'revoke')
+# Reads returning a generator: timed while it is iterated, not when it is created
+STORE_ITERATORS = ('items',)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, values=(), amount=1):
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for values, count in sorted(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, values)} {count}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, values, seconds):
+        series = self.values.get(values)
+        if series is None:
+            # [per-bucket counts..., +Inf count], sum
+            series = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), values + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, values)
+            lines.append(f'{self.name}_sum{labels} {total:.6f}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """Request and store instrumentation for one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter(
+            'http_requests_total', 'Requests by route, method and status code',
+            ('route', 'method', 'status'))
+        self.latency = Histogram(
+            'http_request_duration_seconds', 'Request handling time by route',
+            ('route', 'method'))
+        self.store_latency = Histogram(
+            'store_operation_duration_seconds', 'Store call time by operation',
+            ('kind', 'op'))
+        self.gauges = []
+        self.gauge_groups = []
+
+    def gauge(self, name, help, fn):
+        """Register a value computed at scrape time"""
+        self.gauges.append((name, help, fn))
+
+    def gauge_group(self, fn, gauges):
+        """Register gauges read from one fn() call per scrape, as (name, help, field of the result)"""
+        self.gauge_groups.append((fn, gauges))
+
+    def observe_request(self, route, method, status, seconds):
+        with self.lock:
+            self.requests.inc((route, method, status))
+            self.latency.observe((route, method), seconds)
+
+    def observe_store(self, kind, op, seconds):
+        with self.lock:
+            self.store_latency.observe((kind, op), seconds)
+
+    def init_app(self, app):
+        @app.before_request
+        def start_timer():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def record_request(response):
+            started = g.pop('metrics_started', None)
+            if started is not None:
+                route = request.url_rule.rule if request.url_rule else 'unmatched'
+                self.observe_request(route, request.method, response.status_code,
+                                     time.perf_counter() - started)
+            return response
+
+    def render(self):
+        pid = os.getpid()
+        with self.lock:
+            lines = self.requests.render() + self.latency.render() + self.store_latency.render()
+        for name, help, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+        for fn, gauges in self.gauge_groups:
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for name, help, field in gauges:
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {values[field]}']
+        lines += ['# HELP process_info Worker serving this scrape', '# TYPE process_info gauge',
+                  f'process_info{{pid="{pid}"}} 1']
+        return '\n'.join(lines) + '\n'
+
+
+class TimedStore:
+    """Store wrapper recording the duration of every read and write call"""
+
+    def __init__(self, store, metrics):
+        self.store = store
+        self.metrics = metrics
+        for op in STORE_READS + STORE_WRITES:
+            if hasattr(store, op):
+                timed = self._timed_iter if op in STORE_ITERATORS else self._timed
+                setattr(self, op, timed('read' if op in STORE_READS else 'write', op, getattr(store, op)))
+
+    def _timed(self, kind, op, fn):
+        observe = self.metrics.observe_store
+        phase = 'store_' + kind
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - started
+                observe(kind, op, seconds)
+                add_phase(phase, seconds)
+        return timed
+
+    def _timed_iter(self, kind, op, fn):
+        observe = self.metrics.observe_store
+        phase = 'store_' + kind
+
+        def timed(*args, **kwargs):
+            # Only the time spent producing items, not the caller's work between them
+            seconds = 0.0
+            try:
+                started = time.perf_counter()
+                try:
+                    iterator = iter(fn(*args, **kwargs))
+                finally:
+                    seconds += time.perf_counter() - started
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        seconds += time.perf_counter() - started
+                    yield item
+            finally:
+                observe(kind, op, seconds)
+                add_phase(phase, seconds)
+        return timed
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def database_bytes(path):
+    """Size of the database file plus its SQLite WAL or JSON journal, if any"""
+    total = 0
+    for suffix in ('', '-wal', '.log'):
+        try:
+            total += os.path.getsize(path + suffix)
+        except OSError:
+            pass
+    return total
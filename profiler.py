@@ -0,0 +1,280 @@
+"""On-demand sampling profiler and slow-request log, for finding latency spikes in production.
+
+Profiler: ``POST /admin/profile {"seconds": 30}`` (or the bot's 🔬 button)
+samples, every PROFILE_INTERVAL_MS, the stack of every thread that is
+handling a request, in every worker, for that long; ``GET /admin/profile``
+returns the merged samples as collapsed stacks (one ``frame;frame;... count``
+line per stack, rooted at the route), the input of flamegraph.pl and
+speedscope. Workers coordinate through PROFILE_DIR: the start request
+writes ``control`` (run id, end time, interval), each worker looks at it
+at most once a second from a before_request hook, samples from a
+background thread until the end time and writes ``<run>-<pid>.collapsed``.
+While no profile runs the cost is a clock read per request.
+
+Slow requests: each request keeps a trace of where its time went, fed by
+the JSON provider (parse, serialize), TimedStore (store_read,
+store_write) and the stores' locks (lock_wait, which is part of the store
+time). A request slower than SLOW_REQUEST_MS is appended as one JSON line
+to SLOW_REQUEST_LOG, which the workers share (O_APPEND); ``GET /admin/slow``
+returns the latest ones.
+
+    ADMIN_TOKEN=...   required by the /admin routes, which are off without it
+    PROFILE_DIR=profiles  PROFILE_INTERVAL_MS=5  PROFILE_MAX_SECONDS=120
+    SLOW_REQUEST_MS=500 (0 = off)  SLOW_REQUEST_LOG=slow_requests.ndjson
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import serializer
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 120))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG', 'slow_requests.ndjson')
+
+MAX_DEPTH = 128
+# Bytes read from the end of the slow log for /admin/slow
+SLOW_TAIL_BYTES = 256 * 1024
+
+_local = threading.local()
+
+
+def add_phase(name, seconds):
+    """Charge time to a phase of the current request's trace; no-op outside a traced request"""
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - started)
+
+
+def collapse(frame, root):
+    """'root;file:function;...' from the outermost frame down to `frame`"""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    names.append(root)
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Sampling profiler of the request threads, started for all workers through PROFILE_DIR"""
+
+    def __init__(self, directory=PROFILE_DIR, interval_ms=PROFILE_INTERVAL_MS):
+        self.directory = directory
+        self.control_path = os.path.join(directory, 'control')
+        self.interval_ms = interval_ms
+        self.samples = 0
+        # thread id -> route, for the threads handling a request right now
+        self._active = {}
+        self._next_poll = 0.0
+        self._control_mtime = None
+        self._sampled_run = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Runs already sampled by the parent still need sampling in each worker
+        self._lock = threading.Lock()
+        self._active = {}
+        self._sampled_run = None
+        self._control_mtime = None
+
+    def start(self, seconds, interval_ms=None):
+        """Ask every worker to sample for `seconds`; returns the run"""
+        seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+        run = {
+            'run': time.strftime('%Y%m%d-%H%M%S'),
+            'until': time.time() + seconds,
+            'interval_ms': max(1.0, float(interval_ms or self.interval_ms))
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.control_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(serializer.dumps(run))
+        os.replace(tmp_path, self.control_path)
+        self._next_poll = 0.0
+        self.poll()
+        return run
+
+    def control(self):
+        try:
+            with open(self.control_path, 'rb') as f:
+                return serializer.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def poll(self):
+        """Start sampling if a run was requested since the last look (at most once a second)"""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + 1.0
+        try:
+            mtime = os.stat(self.control_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        with self._lock:
+            if mtime == self._control_mtime:
+                return
+            self._control_mtime = mtime
+            run = self.control()
+            if run is None or run['run'] == self._sampled_run or time.time() >= run['until']:
+                return
+            self._sampled_run = run['run']
+        threading.Thread(target=self._sample, args=(run,), daemon=True).start()
+
+    def enter(self, route):
+        self._active[threading.get_ident()] = route
+
+    def leave(self):
+        self._active.pop(threading.get_ident(), None)
+
+    def _sample(self, run):
+        stacks = Counter()
+        interval = run['interval_ms'] / 1000
+        print(f"🔬 Profiling worker {os.getpid()} until {time.strftime('%H:%M:%S', time.localtime(run['until']))}")
+        while time.time() < run['until']:
+            frames = sys._current_frames()
+            for ident, route in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[collapse(frame, route)] += 1
+            self.samples += 1
+            time.sleep(interval)
+        path = os.path.join(self.directory, f"{run['run']}-{os.getpid()}.collapsed")
+        with open(path + '.tmp', 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        os.replace(path + '.tmp', path)
+
+    def result(self):
+        """Latest run with every worker's stacks merged, None if there was none"""
+        run = self.control()
+        if run is None:
+            return None
+        stacks = Counter()
+        workers = 0
+        prefix = run['run'] + '-'
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith(prefix) and name.endswith('.collapsed')):
+                continue
+            workers += 1
+            with open(os.path.join(self.directory, name)) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    stacks[stack] += int(count)
+        return {
+            'run': run['run'],
+            'running': time.time() < run['until'],
+            'until': run['until'],
+            'workers': workers,
+            'samples': sum(stacks.values()),
+            'collapsed': ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+        }
+
+    def init_app(self, app):
+        from flask import request
+
+        @app.before_request
+        def profile_request():
+            self.poll()
+            rule = request.url_rule.rule if request.url_rule else 'unmatched'
+            self.enter(f'{request.method} {rule}')
+
+        @app.teardown_request
+        def end_profile_request(exc):
+            self.leave()
+
+
+class SlowRequestLog:
+    """Per-phase timings of requests slower than the threshold, one JSON line each"""
+
+    def __init__(self, path=SLOW_REQUEST_LOG, threshold_ms=SLOW_REQUEST_MS):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.logged = 0
+
+    def write(self, entry):
+        line = serializer.dumps(entry, pretty=False) + b'\n'
+        # One write on an O_APPEND descriptor: workers' lines never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.logged += 1
+
+    def recent(self, limit=50):
+        """The last `limit` slow requests, newest first"""
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - SLOW_TAIL_BYTES))
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in reversed(lines):
+            try:
+                entries.append(serializer.loads(line))
+            except ValueError:
+                # First line cut by the seek
+                continue
+            if len(entries) >= limit:
+                break
+        return entries
+
+    def init_app(self, app):
+        from flask import request
+
+        @app.before_request
+        def begin_trace():
+            _local.phases = {}
+            _local.started = time.perf_counter()
+
+        @app.after_request
+        def log_slow_request(response):
+            phases = getattr(_local, 'phases', None)
+            if phases is None:
+                return response
+            _local.phases = None
+            elapsed_ms = (time.perf_counter() - _local.started) * 1000
+            if elapsed_ms >= self.threshold_ms:
+                # lock_wait is already inside the store phases
+                accounted = sum(seconds for name, seconds in phases.items() if name != 'lock_wait')
+                self.write({
+                    'ts': int(time.time() * 1000),
+                    'pid': os.getpid(),
+                    'method': request.method,
+                    'path': request.path,
+                    'route': request.url_rule.rule if request.url_rule else None,
+                    'status': response.status_code,
+                    'ms': round(elapsed_ms, 2),
+                    'phases': {name: round(seconds * 1000, 2) for name, seconds in sorted(phases.items())},
+                    'other_ms': round(max(0.0, elapsed_ms - accounted * 1000), 2)
+                })
+                print(f"🐢 Slow request: {request.method} {request.path} {elapsed_ms:.0f}ms")
+            return response
+
+
+def slow_log_from_env():
+    """SlowRequestLog for SLOW_REQUEST_LOG, or None if SLOW_REQUEST_MS=0"""
+    if SLOW_REQUEST_MS <= 0:
+        return None
+    return SlowRequestLog()
@@ -0,0 +1,197 @@
+"""Sliding-window rate limiting for /check, applied before any store I/O.
+
+Each rule (client IP, device_id, key) allows ``limit`` requests per
+``window`` seconds, estimated with the usual two-window approximation:
+the previous window's count weighted by how much of it still overlaps
+plus the current window's count. A request is admitted only if every one
+of its buckets has room, and only admitted requests are counted, so a
+client that backs off recovers.
+
+Limits come from the environment as ``<count>/<seconds>`` (0 disables a
+rule):
+
+    RATE_LIMIT_IP=120/60  RATE_LIMIT_DEVICE=60/60  RATE_LIMIT_KEY=60/60
+
+Buckets live in a bounded in-process LRU by default (each gunicorn worker
+counts on its own); RATE_LIMIT_BACKEND=sqlite shares them between workers
+through ``RATE_LIMIT_PATH``.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_rule(value):
+    """'120/60' -> (120, 60.0), None if disabled"""
+    count, _, seconds = value.partition('/')
+    count = int(count)
+    if count <= 0:
+        return None
+    return count, float(seconds or 60)
+
+
+RULES = {
+    name: parse_rule(os.environ.get(f'RATE_LIMIT_{name.upper()}', default))
+    for name, default in (('ip', '120/60'), ('device', '60/60'), ('key', '60/60'))
+}
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH', 'ratelimit.db')
+RATE_LIMIT_BUCKETS = int(os.environ.get('RATE_LIMIT_BUCKETS', 100000))
+
+
+def roll(state, index):
+    """Move a bucket's [window index, current, previous] forward to `index`"""
+    if state[0] == index - 1:
+        state[:] = [index, 0, state[1]]
+    elif state[0] != index:
+        state[:] = [index, 0, 0]
+    return state
+
+
+def retry_after(state, limit, window, now):
+    """Seconds until the bucket admits another request, 0 if it has room now"""
+    index, current, previous = state
+    elapsed = now - index * window
+    if previous * (1 - elapsed / window) + current < limit:
+        return 0
+    if current >= limit:
+        # Wait for the next window, then for enough of this one to slide out
+        wait = window - elapsed + window * max(0.0, 1 - limit / current)
+    else:
+        wait = window * (1 - (limit - current) / previous) - elapsed
+    return max(1, math.ceil(wait))
+
+
+class MemoryBackend:
+    """Buckets in an LRU dict; idle buckets fall out first"""
+
+    def __init__(self, max_buckets=RATE_LIMIT_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, buckets, now):
+        """Count one request in every bucket, or return the Retry-After seconds"""
+        with self._lock:
+            states = []
+            wait = 0
+            for name, limit, window in buckets:
+                index = int(now // window)
+                state = self._buckets.get(name)
+                if state is None:
+                    state = [index, 0, 0]
+                roll(state, index)
+                states.append((name, state))
+                wait = max(wait, retry_after(state, limit, window, now))
+            if wait:
+                return wait
+            for name, state in states:
+                state[1] += 1
+                self._buckets[name] = state
+                self._buckets.move_to_end(name)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SqliteBackend:
+    """Buckets in a small SQLite table shared by every worker on the machine"""
+
+    PRUNE_EVERY = 60
+
+    def __init__(self, path=RATE_LIMIT_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._pruned = 0
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            ' name TEXT PRIMARY KEY,'
+            ' idx INTEGER NOT NULL,'
+            ' current INTEGER NOT NULL,'
+            ' previous INTEGER NOT NULL,'
+            ' expires REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def acquire(self, buckets, now):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            states = []
+            wait = 0
+            for name, limit, window in buckets:
+                index = int(now // window)
+                row = conn.execute(
+                    'SELECT idx, current, previous FROM buckets WHERE name = ?', (name,)
+                ).fetchone()
+                state = roll(list(row) if row else [index, 0, 0], index)
+                states.append((name, state, (index + 2) * window))
+                wait = max(wait, retry_after(state, limit, window, now))
+            if not wait:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO buckets (name, idx, current, previous, expires)'
+                    ' VALUES (?, ?, ?, ?, ?)',
+                    [(name, state[0], state[1] + 1, state[2], expires) for name, state, expires in states]
+                )
+            if now - self._pruned > self.PRUNE_EVERY:
+                self._pruned = now
+                # Buckets two windows old count nothing any more
+                conn.execute('DELETE FROM buckets WHERE expires < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM buckets').fetchone()[0]
+
+
+class RateLimiter:
+    """Applies the configured rules to one request's identities"""
+
+    def __init__(self, rules=RULES, backend=None):
+        self.rules = {name: rule for name, rule in rules.items() if rule}
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.rejected = 0
+
+    def check(self, **identities):
+        """0 if the request may proceed, else the Retry-After seconds
+
+        ``identities`` maps rule names to values (ip=..., device=..., key=...);
+        missing or empty values are not limited.
+        """
+        buckets = [
+            (f'{name}:{value}', limit, window)
+            for name, (limit, window) in self.rules.items()
+            for value in (identities.get(name),) if value
+        ]
+        if not buckets:
+            return 0
+        wait = self.backend.acquire(buckets, time.time())
+        if wait:
+            self.rejected += 1
+        return wait
+
+
+def limiter_from_env():
+    if not any(RULES.values()):
+        return None
+    backend = SqliteBackend() if RATE_LIMIT_BACKEND == 'sqlite' else MemoryBackend()
+    return RateLimiter(RULES, backend)
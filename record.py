@@ -0,0 +1,180 @@
+"""Compact in-memory form of an activation record.
+
+Stores that keep every record resident (the journaled JSON store, the read
+cache) hold ``Record`` objects instead of dicts: ``__slots__`` instead of a
+per-record dict, the status as a small ``Status`` enum, timestamps as
+integer microseconds since the epoch and the binding strings interned.
+
+A ``Record`` is a read-only mapping, so ``record['status']`` and
+``record.get('expiry')`` return exactly the strings the dict held and
+``to_dict()`` rebuilds the original dict (same keys, same values), which
+keeps the /check and /list responses byte-for-byte unchanged.
+
+The status and counter helpers at the end (``effective_status``,
+``compute_stats``) work on any record mapping and need only the standard
+library, so the bot can use them without the server's modules.
+"""
+import sys
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from enum import IntEnum
+
+FIELDS = (
+    'status',
+    'activated',
+    'expiry',
+    'months',
+    'registered_device',
+    'registered_path',
+    'registered_hash',
+    'first_use',
+    'resume',
+)
+
+TIME_FIELDS = frozenset(('activated', 'expiry', 'first_use', 'resume'))
+INTERNED_FIELDS = frozenset(('registered_device', 'registered_path', 'registered_hash'))
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class Status(IntEnum):
+    ACTIVE = 0
+    INACTIVE = 1
+    SUSPENDED = 2
+    EXPIRED = 3
+
+
+STATUS_BY_NAME = {status.name.lower(): status for status in Status}
+STATUS_NAMES = {status: status.name.lower() for status in Status}
+
+
+def pack_time(value):
+    """ISO timestamp -> int microseconds, when that round-trips exactly
+
+    Anything else ('permanent', timezone-aware or oddly formatted values)
+    is kept as the original string.
+    """
+    if not isinstance(value, str) or value == 'permanent':
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if moment.tzinfo is not None or moment.isoformat() != value:
+        return value
+    return (moment - EPOCH) // MICROSECOND
+
+
+def unpack_time(value):
+    if type(value) is int:
+        return (EPOCH + value * MICROSECOND).isoformat()
+    return value
+
+
+def _pack(field, value):
+    if field == 'status':
+        return STATUS_BY_NAME.get(value, value)
+    if field in TIME_FIELDS:
+        return pack_time(value)
+    if field in INTERNED_FIELDS and isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def _unpack(field, value):
+    if field == 'status':
+        return STATUS_NAMES.get(value, value)
+    if field in TIME_FIELDS:
+        return unpack_time(value)
+    return value
+
+
+class Record(Mapping):
+    """Slotted activation record; fields missing from the dict stay unset"""
+
+    __slots__ = FIELDS + ('extra',)
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls()
+        for field, value in data.items():
+            if field in FIELDS:
+                setattr(record, field, _pack(field, value))
+            else:
+                # Fields this version does not know about are kept verbatim
+                if not hasattr(record, 'extra'):
+                    record.extra = {}
+                record.extra[field] = value
+        return record
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, field):
+        if field in FIELDS:
+            try:
+                return _unpack(field, getattr(self, field))
+            except AttributeError:
+                raise KeyError(field) from None
+        try:
+            return self.extra[field]
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __iter__(self):
+        for field in FIELDS:
+            if hasattr(self, field):
+                yield field
+        if hasattr(self, 'extra'):
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'Record({self.to_dict()!r})'
+
+
+def as_record(record):
+    """Record (or None) for a dict coming from a store or a request"""
+    if record is None or isinstance(record, Record):
+        return record
+    return Record.from_dict(record)
+
+
+def is_past(value, now):
+    if not value or value == 'permanent':
+        return False
+    try:
+        return now > datetime.fromisoformat(value)
+    except ValueError:
+        return False
+
+
+def effective_status(record, now=None):
+    """Status of the record at `now`, including transitions not yet persisted"""
+    now = now or datetime.now()
+    status = record['status']
+    if status in ('active', 'suspended') and is_past(record.get('expiry'), now):
+        return 'expired'
+    if status == 'suspended' and is_past(record.get('resume'), now):
+        return 'active'
+    return status
+
+
+def compute_stats(records):
+    """Full scan of the records, used to seed and reconcile the counters"""
+    total = active = suspended = 0
+    for record in records:
+        total += 1
+        if record['status'] == 'active':
+            active += 1
+        elif record['status'] == 'suspended':
+            suspended += 1
+    return {
+        'total_keys': total,
+        'active_keys': active,
+        'suspended_keys': suspended,
+        'inactive_keys': total - active - suspended
+    }
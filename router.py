@@ -0,0 +1,769 @@
+"""Sharded deployment: a thin router in front of several server.py shards.
+
+Keys are spread over the shards with a consistent hash ring (SHARD_VNODES
+points per shard), so adding a shard only moves the keys that now hash to
+it. The router forwards /check/<key> and the single-key admin routes to
+the key's shard, splits /batch/* by shard and merges the results back in
+request order, and answers the read routes by asking every shard in
+parallel:
+
+    /stats        counters summed
+    /list         per-shard pages merged by key (the cursor is still the last key)
+                  both tagged "<ring id>:<tag1>.<tag2>..." with the shards' ETags,
+                  304 while every shard answers 304 to its own tag
+    /changes      version "<ring id>:<v1>.<v2>...", one store version per shard;
+                  a version from another ring gets a full snapshot
+    /revocations  union of the shards' lists
+    /generate     keys drawn by the router, each inserted on its own shard
+
+Each shard is an ordinary server.py with its own database and SHARD_TOKEN
+set; the router sends the same token to the /shard routes that move
+records between shards.
+
+    SHARDS=http://10.0.0.1:5000,http://10.0.0.2:5000  SHARD_TOKEN=...
+    gunicorn router:app --workers 1 --threads 16
+
+Behind a proxy set TRUSTED_PROXIES on the router as on a single server;
+the router passes the client's address on to the shards, which run with
+TRUSTED_PROXIES=1 to trust the router alone.
+
+Adding or removing shards:
+
+    python router.py rebalance --router http://127.0.0.1:8000 --shards URL1,URL2,URL3
+
+The router switches to the new ring once the requests in flight have
+finished, then moves every key whose owner changed in the background:
+copy to the new owner, then delete from the old one. A request for a key
+that has not moved yet moves it first, under the same per-key lock, so
+no write lands on a shard that is losing the key. Until the move is done
+/stats may count a key being copied twice. Moves are coordinated in
+memory, so run the router as one process; the ring and a move in
+progress are saved to ROUTER_STATE and resumed after a restart.
+
+Locally, with several processes on one machine:
+
+    python router.py launch --shards 3 --port 8000
+
+starts three shards (each in shards/<n>/, ports 8001-8003) and the router.
+"""
+import hashlib
+import heapq
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+
+import requests
+from flask import Flask, Response, request
+from werkzeug.http import quote_etag, unquote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import keygen
+import serializer
+
+SHARDS = os.environ.get('SHARDS', '')
+SHARD_TOKEN = os.environ.get('SHARD_TOKEN', '')
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', 64))
+ROUTER_STATE = os.environ.get('ROUTER_STATE', 'router_state.json')
+ROUTER_TIMEOUT = float(os.environ.get('ROUTER_TIMEOUT', 10))
+ROUTER_CONCURRENCY = int(os.environ.get('ROUTER_CONCURRENCY', 16))
+# Keys per request when moving records, and per shard page for /list
+ROUTER_PAGE_SIZE = int(os.environ.get('ROUTER_PAGE_SIZE', 500))
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 1000))
+MAX_BATCH = int(os.environ.get('MAX_BATCH', 1000))
+# Proxies in front of the router (0 = clients connect directly)
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+LOCK_STRIPES = 64
+SINGLE_KEY_ROUTES = ('activate', 'deactivate', 'extend', 'suspend', 'resume')
+BATCH_ROUTES = ('activate', 'extend', 'suspend', 'deactivate')
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring: a key belongs to the shard of the next point clockwise"""
+
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        self.shards = list(shards)
+        points = sorted((ring_hash(f'{shard}#{i}'), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+        # Changes whenever the shard list does; part of the /changes version
+        self.id = hashlib.sha1('\n'.join(self.shards).encode()).hexdigest()[:8]
+
+    def owner(self, key):
+        if not self._hashes:
+            raise LookupError('No shards configured')
+        return self._owners[bisect_right(self._hashes, ring_hash(key)) % len(self._hashes)]
+
+
+class ShardError(Exception):
+    """A shard could not be reached or did not answer 200"""
+
+    def __init__(self, shard, message):
+        super().__init__(f'{shard}: {message}')
+        self.shard = shard
+
+
+class Router:
+    """Current ring, the ring being moved away from, and the key moves between them"""
+
+    def __init__(self, state_path=ROUTER_STATE, token=SHARD_TOKEN):
+        self.state_path = state_path
+        self.token = token
+        self.ring = HashRing([])
+        # Ring the keys are still being moved from, None when no rebalance is running
+        self.previous = None
+        self.moved = 0
+        self.pool = ThreadPoolExecutor(ROUTER_CONCURRENCY)
+        self._local = threading.local()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._state_lock = threading.Lock()
+        self._routing = threading.Condition()
+        self._in_flight = 0
+        self._switching = False
+
+    # --- shard calls
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def call(self, shard, method, path, body=None, params=None, headers=None):
+        """Raw response from a shard, ShardError if it cannot be reached"""
+        try:
+            return self._session().request(method, shard + path, data=body, params=params,
+                                           headers=headers, timeout=ROUTER_TIMEOUT)
+        except requests.RequestException as e:
+            raise ShardError(shard, str(e)) from None
+
+    def call_json(self, shard, method, path, data=None, params=None):
+        """Decoded 200 answer from a shard, ShardError otherwise"""
+        headers = {'X-Shard-Token': self.token}
+        body = None
+        if data is not None:
+            body = serializer.dumps(data, pretty=False)
+            headers['Content-Type'] = 'application/json'
+        response = self.call(shard, method, path, body, params, headers)
+        if response.status_code != 200:
+            raise ShardError(shard, f'HTTP {response.status_code}')
+        return serializer.loads(response.content)
+
+    def scatter(self, fn, shards):
+        """{shard: fn(shard)} with the shards called in parallel"""
+        shards = list(shards)
+        return dict(zip(shards, self.pool.map(fn, shards)))
+
+    # --- ring state
+
+    def load(self, shards=()):
+        """Ring (and any rebalance in progress) from ROUTER_STATE, else `shards`
+
+        A saved ring that differs from `shards` is rebalanced onto them, so
+        changing SHARDS and restarting moves the keys too.
+        """
+        shards = list(shards)
+        if not os.path.exists(self.state_path):
+            self.ring = HashRing(shards)
+            if shards:
+                self._save()
+            return
+        with open(self.state_path, 'rb') as f:
+            state = serializer.loads(f.read())
+        self.ring = HashRing(state['shards'])
+        if state.get('previous') is not None:
+            self.previous = HashRing(state['previous'])
+            print(f"🔁 Resuming rebalance from {len(self.previous.shards)} to {len(self.ring.shards)} shards")
+            self._start_moving()
+        elif shards and shards != self.ring.shards:
+            self.rebalance(shards)
+
+    def _save(self):
+        state = {'shards': self.ring.shards,
+                 'previous': self.previous.shards if self.previous is not None else None}
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(serializer.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+    @contextmanager
+    def routing(self):
+        """Held while a keyed request is routed, so a ring switch waits for it"""
+        with self._routing:
+            while self._switching:
+                self._routing.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._routing:
+                self._in_flight -= 1
+                self._routing.notify_all()
+
+    def rebalance(self, shards):
+        """Switch to a ring of `shards` and start moving keys to it"""
+        with self._state_lock:
+            if self.previous is not None:
+                raise ValueError('A rebalance is already in progress')
+            if not shards:
+                raise ValueError('At least one shard is needed')
+            with self._routing:
+                # A write still on its way to the old owner must land before keys are copied
+                self._switching = True
+                while self._in_flight:
+                    self._routing.wait()
+                self.previous, self.ring = self.ring, HashRing(shards)
+                self._switching = False
+                self._routing.notify_all()
+            self.moved = 0
+            self._save()
+        print(f"🔁 Rebalancing from {len(self.previous.shards)} to {len(self.ring.shards)} shards")
+        self._start_moving()
+
+    def _start_moving(self):
+        threading.Thread(target=self._move_all, daemon=True).start()
+
+    # --- moving keys
+
+    @contextmanager
+    def _locked(self, keys):
+        stripes = sorted({ring_hash(key) % LOCK_STRIPES for key in keys})
+        with ExitStack() as stack:
+            for stripe in stripes:
+                stack.enter_context(self._stripes[stripe])
+            yield
+
+    def _move(self, source, keys):
+        """Copy the keys `source` still has to their owners, then delete them there"""
+        targets = {}
+        for key in keys:
+            owner = self.ring.owner(key)
+            if owner != source:
+                targets.setdefault(owner, []).append(key)
+        for target, target_keys in targets.items():
+            with self._locked(target_keys):
+                exported = self.call_json(source, 'POST', '/shard/export', {'keys': target_keys})
+                records = exported['records']
+                if not records:
+                    # Moved already
+                    continue
+                self.call_json(target, 'POST', '/shard/import',
+                               {'records': records, 'revocations': exported.get('revocations', {})})
+                self.call_json(source, 'POST', '/shard/drop', {'keys': [key for key, _ in records]})
+                self.moved += len(records)
+
+    def ensure_moved(self, keys):
+        """Move keys a request is about to touch, if the rebalance has not reached them"""
+        previous = self.previous
+        if previous is None:
+            return
+        by_source = {}
+        for key in keys:
+            source = previous.owner(key)
+            if source != self.ring.owner(key):
+                by_source.setdefault(source, []).append(key)
+        for source, source_keys in by_source.items():
+            self._move(source, source_keys)
+
+    def _move_all(self):
+        """Walk every shard of the old ring and move the keys it no longer owns"""
+        for shard in self.previous.shards:
+            after = None
+            while True:
+                try:
+                    page = self.call_json(shard, 'POST', '/shard/export',
+                                          {'after': after, 'limit': ROUTER_PAGE_SIZE})
+                    self._move(shard, [key for key, _ in page['records']])
+                except ShardError as e:
+                    print(f"❌ Rebalance: {e}, retrying")
+                    time.sleep(5)
+                    continue
+                if page['next_cursor'] is None:
+                    break
+                after = page['next_cursor']
+        with self._state_lock:
+            self.previous = None
+            self._save()
+        print(f"✅ Rebalance done: {self.moved} keys moved")
+
+
+app = Flask(__name__)
+if TRUSTED_PROXIES:
+    # Behind the platform's proxy: resolve the client's address from X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+router = Router()
+router.load([shard.strip().rstrip('/') for shard in SHARDS.split(',') if shard.strip()])
+
+
+def json_response(obj, status=200):
+    return Response(serializer.dumps(obj) + b'\n', status=status, mimetype='application/json')
+
+
+def forward(shard):
+    """Pass the current request to a shard unchanged and relay its answer"""
+    headers = {'Content-Type': request.content_type} if request.content_type else {}
+    # The client's address as resolved by ProxyFix; shards trust exactly this one hop
+    headers['X-Forwarded-For'] = request.remote_addr
+    response = router.call(shard, request.method, request.path, request.get_data(),
+                           request.query_string.decode() or None, headers)
+    relayed = Response(response.content, status=response.status_code,
+                       content_type=response.headers.get('Content-Type'))
+    if 'Retry-After' in response.headers:
+        relayed.headers['Retry-After'] = response.headers['Retry-After']
+    return relayed
+
+
+@app.errorhandler(ShardError)
+def shard_unavailable(e):
+    print(f"❌ Shard unavailable: {e}")
+    return json_response({'success': False, 'error': 'Shard unavailable', 'shard': e.shard}, 502)
+
+
+@app.errorhandler(LookupError)
+def no_shards(e):
+    return json_response({'success': False, 'error': str(e)}, 503)
+
+
+@app.route('/')
+def home():
+    return json_response({
+        'status': 'online',
+        'message': 'Ashraf Activation Router',
+        'shards': len(router.ring.shards)
+    })
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Ready when every shard is"""
+    def probe(shard):
+        try:
+            return router.call(shard, 'GET', '/healthz').status_code == 200
+        except ShardError:
+            return False
+
+    shards = router.scatter(probe, router.ring.shards)
+    ready = bool(shards) and all(shards.values())
+    return json_response({
+        'status': 'ready' if ready else 'degraded',
+        'shards': {shard: 'ready' if ok else 'down' for shard, ok in shards.items()},
+        'rebalancing': router.previous is not None
+    }, 200 if ready else 503)
+
+
+@app.route('/check/<key>', methods=['POST'])
+def check_key(key):
+    key = key.upper()
+    with router.routing():
+        router.ensure_moved([key])
+        return forward(router.ring.owner(key))
+
+
+@app.route('/<any(%s):action>' % ', '.join(SINGLE_KEY_ROUTES), methods=['POST'])
+def single_key(action):
+    data = request.get_json(silent=True)
+    key = str(data.get('key', '')).upper() if isinstance(data, dict) else ''
+    with router.routing():
+        router.ensure_moved([key])
+        return forward(router.ring.owner(key))
+
+
+def batch_key(entry):
+    key = entry.get('key', '') if isinstance(entry, dict) else entry
+    return str(key).strip().upper()
+
+
+@app.route('/batch/<any(%s):action>' % ', '.join(BATCH_ROUTES), methods=['POST'])
+def batch(action):
+    """Split a batch by shard, send the parts in parallel, merge the results in order"""
+    data = request.get_json(silent=True)
+    entries = data.get('keys') if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BATCH:
+        # Invalid: let a shard give its usual 400
+        return forward(router.ring.owner(''))
+
+    with router.routing():
+        keys = [batch_key(entry) for entry in entries]
+        router.ensure_moved(keys)
+        parts = {}
+        for position, (key, entry) in enumerate(zip(keys, entries)):
+            parts.setdefault(router.ring.owner(key), []).append((position, entry))
+
+        def send(shard):
+            body = dict(data, keys=[entry for _, entry in parts[shard]])
+            try:
+                return router.call_json(shard, 'POST', f'/batch/{action}', body)['results']
+            except ShardError as e:
+                print(f"❌ Batch part failed: {e}")
+                return None
+
+        answers = router.scatter(send, parts)
+
+    results = [None] * len(entries)
+    for shard, part in parts.items():
+        answer = answers[shard]
+        for offset, (position, _) in enumerate(part):
+            results[position] = answer[offset] if answer is not None else \
+                {'key': keys[position], 'success': False, 'error': 'Shard unavailable'}
+    succeeded = sum(1 for result in results if result['success'])
+    return json_response({
+        'success': True,
+        'results': results,
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    })
+
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    """Draw keys, activate each on its shard, stream the export of the keys created"""
+    parsed = keygen.parse_request(request.get_json(silent=True))
+    if parsed is None:
+        # Invalid: let a shard give its usual 400
+        return forward(router.ring.owner(''))
+    count, months, prefix, fmt = parsed
+
+    created = []
+    with router.routing():
+        for _ in range(keygen.GENERATE_ATTEMPTS):
+            keys = keygen.candidates(count - len(created), prefix)
+            router.ensure_moved(keys)
+            parts = {}
+            for key in keys:
+                parts.setdefault(router.ring.owner(key), []).append(key)
+
+            def insert(shard):
+                try:
+                    return router.call_json(shard, 'POST', '/shard/insert',
+                                            {'keys': parts[shard], 'months': months})
+                except ShardError as e:
+                    print(f"❌ Generate part failed: {e}")
+                    return None
+
+            answers = router.scatter(insert, parts)
+            for answer in answers.values():
+                if answer is not None:
+                    created += [(key, answer['record']) for key in answer['inserted']]
+            # A shard that failed may be down: report the keys created so far
+            if len(created) == count or None in answers.values():
+                break
+
+    response = Response(keygen.export(created, fmt), mimetype=keygen.EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{keygen.export_filename(fmt)}"'
+    response.headers['X-Generated-Count'] = str(len(created))
+    return response
+
+
+def shard_stats(shard, tag=None):
+    """(ETag, counters) of a shard's /stats; counters are None if it answered 304 to `tag`"""
+    response = router.call(shard, 'GET', '/stats', headers={'If-None-Match': quote_etag(tag)} if tag else None)
+    if response.status_code not in (200, 304):
+        raise ShardError(shard, f'HTTP {response.status_code}')
+    etag, _ = unquote_etag(response.headers.get('ETag'))
+    return etag, serializer.loads(response.content) if response.status_code == 200 else None
+
+
+def client_tags(ring):
+    """{shard: tag} from the client's If-None-Match for this ring, {} if it sent none"""
+    for value in request.if_none_match.as_set():
+        ring_id, _, tags = value.partition(':')
+        tags = tags.split('.')
+        if ring_id == ring.id and len(tags) == len(ring.shards):
+            return dict(zip(ring.shards, tags))
+    return {}
+
+
+def shard_versions():
+    """(ETag of the shards' store versions, {shard: counters or None}, 304 if the client is current)
+
+    The ETag is "<ring id>:<tag1>.<tag2>..." with each shard's own /stats
+    ETag, so an unchanged shard is asked with its tag and answers 304.
+    """
+    ring = router.ring
+    known = client_tags(ring)
+    answers = router.scatter(lambda shard: shard_stats(shard, known.get(shard)), ring.shards)
+    tags = [answers[shard][0] for shard in ring.shards]
+    if not all(tags):
+        # A shard without versioned answers: nothing to compare against
+        return None, {shard: stats for shard, (_, stats) in answers.items()}, None
+    etag = f"{ring.id}:{'.'.join(tags)}"
+    cached = None
+    if request.if_none_match.contains(etag):
+        cached = Response(status=304)
+        cached.set_etag(etag)
+    return etag, {shard: stats for shard, (_, stats) in answers.items()}, cached
+
+
+def tagged(response, etag):
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Every shard's counters, summed; 304 while no shard changed"""
+    etag, answers, cached = shard_versions()
+    if cached is not None:
+        return cached
+    missing = [shard for shard, stats in answers.items() if stats is None]
+    answers.update({shard: stats for shard, (_, stats) in
+                    router.scatter(shard_stats, missing).items()})
+    totals = {}
+    for stats in answers.values():
+        for name, value in stats.items():
+            totals[name] = totals.get(name, 0) + value
+    return tagged(json_response(totals), etag)
+
+
+def owned_first(rows_by_shard):
+    """{key: row} over all shards, the owner's row winning for a key two shards hold mid-move"""
+    merged = {}
+    for shard, rows in rows_by_shard.items():
+        for key, row in rows:
+            if key not in merged or router.ring.owner(key) == shard:
+                merged[key] = row
+    return merged
+
+
+def shard_list_pages(shard, args):
+    """Every /list item of one shard matching the filters in `args`, in key order"""
+    params = dict(args, limit=ROUTER_PAGE_SIZE)
+    while True:
+        page = router.call_json(shard, 'GET', '/list', params=params)
+        yield from page['keys']
+        if not page.get('next_cursor'):
+            return
+        params['cursor'] = page['next_cursor']
+
+
+@app.route('/list', methods=['GET'])
+def list_keys():
+    """/list across all shards, merged by key; 304 while no shard changed"""
+    etag, _, cached = shard_versions()
+    if cached is not None:
+        return cached
+    args = {name: value for name, value in request.args.items() if name not in ('limit', 'cursor', 'format')}
+    shards = router.ring.shards
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor') or None
+
+    if request.args.get('format') == 'ndjson':
+        streams = [shard_list_pages(shard, dict(args, cursor=cursor) if cursor else args) for shard in shards]
+
+        def export():
+            last = None
+            for item in heapq.merge(*streams, key=lambda item: item['key']):
+                if item['key'] != last:
+                    last = item['key']
+                    yield serializer.dumps(item, pretty=False) + b'\n'
+        return tagged(Response(export(), mimetype='application/x-ndjson'), etag)
+
+    if limit is None and cursor is None:
+        pages = router.scatter(lambda shard: router.call_json(shard, 'GET', '/list', params=args), shards)
+        merged = owned_first({shard: [(item['key'], item) for item in page['keys']]
+                              for shard, page in pages.items()})
+        keys_list = [merged[key] for key in sorted(merged)]
+        return tagged(json_response({'keys': keys_list, 'total': len(keys_list)}), etag)
+
+    limit = max(1, min(limit or LIST_PAGE_SIZE, LIST_PAGE_SIZE))
+    params = dict(args, limit=limit)
+    if cursor:
+        params['cursor'] = cursor
+    pages = router.scatter(lambda shard: router.call_json(shard, 'GET', '/list', params=params), shards)
+    merged = owned_first({shard: [(item['key'], item) for item in page['keys']]
+                          for shard, page in pages.items()})
+    keys = sorted(merged)
+    # A shard with more to give only vouches for keys up to its last one
+    more = [page['keys'][-1]['key'] for page in pages.values() if page.get('next_cursor')]
+    if more:
+        keys = [key for key in keys if key <= min(more)]
+    page_keys = keys[:limit]
+    return tagged(json_response({
+        'keys': [merged[key] for key in page_keys],
+        'total': len(page_keys),
+        'next_cursor': page_keys[-1] if page_keys and (more or len(merged) > limit) else None
+    }), etag)
+
+
+def parse_version(value, ring):
+    """Per-shard versions from a /changes version of this ring, None if from another"""
+    ring_id, _, versions = (value or '').partition(':')
+    parts = versions.split('.')
+    if ring_id != ring.id or len(parts) != len(ring.shards):
+        return None
+    try:
+        return [int(part) for part in parts]
+    except ValueError:
+        return None
+
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """Change feed across shards; deltas only from a key's owner"""
+    ring = router.ring
+    since = parse_version(request.args.get('since'), ring)
+
+    def changes(shard, shard_since):
+        return router.call_json(shard, 'GET', '/changes', params={'since': shard_since})
+
+    answers = router.scatter(lambda shard: changes(shard, since[ring.shards.index(shard)] if since else -1),
+                             ring.shards)
+    snapshot = since is None or any(answer['snapshot'] for answer in answers.values())
+    if snapshot:
+        # One shard too far behind: everything, from every shard, or the client
+        # would keep other shards' keys it should have dropped
+        stale = [shard for shard, answer in answers.items() if not answer['snapshot']]
+        answers.update(router.scatter(lambda shard: changes(shard, -1), stale))
+        previous = router.previous
+        if previous is not None:
+            # Keys still on a shard that is leaving the ring
+            leaving = [shard for shard in previous.shards if shard not in answers]
+            leaving_answers = router.scatter(lambda shard: changes(shard, -1), leaving)
+        else:
+            leaving_answers = {}
+        keys = owned_first({shard: answer['keys'].items()
+                            for shard, answer in {**leaving_answers, **answers}.items()})
+    else:
+        # A copy arriving on its new owner is the change; the old owner's delete is not
+        keys = {key: row for shard, answer in answers.items()
+                for key, row in answer['keys'].items() if ring.owner(key) == shard}
+
+    first = next(iter(answers.values()), {})
+    return json_response({
+        'version': f"{ring.id}:{'.'.join(str(answers[shard]['version']) for shard in ring.shards)}",
+        'modified': max((answer['modified'] for answer in answers.values()), default=0),
+        'snapshot': snapshot,
+        'fields': first.get('fields', []),
+        'keys': keys
+    })
+
+
+@app.route('/revocations', methods=['GET'])
+def get_revocations():
+    """Union of the shards' revocation lists; 304 while unchanged"""
+    revoked = {}
+    ttl = None
+    for answer in router.scatter(lambda shard: router.call_json(shard, 'GET', '/revocations'),
+                                 router.ring.shards).values():
+        ttl = answer['ttl']
+        for key, revoked_at in answer['revoked'].items():
+            revoked[key] = max(revoked_at, revoked.get(key, revoked_at))
+    body = serializer.dumps({'revoked': revoked, 'ttl': ttl}, sort_keys=True)
+    response = Response(body + b'\n', mimetype='application/json')
+    response.set_etag(hashlib.sha256(body).hexdigest()[:32])
+    return response.make_conditional(request)
+
+
+@app.route('/license/key', methods=['GET'])
+def get_license_key():
+    # Every shard signs with the same key
+    return forward(router.ring.shards[0])
+
+
+@app.route('/shards', methods=['GET'])
+def get_shards():
+    return json_response({
+        'shards': router.ring.shards,
+        'ring': router.ring.id,
+        'rebalancing_from': router.previous.shards if router.previous is not None else None,
+        'moved': router.moved
+    })
+
+
+@app.route('/shards', methods=['POST'])
+def set_shards():
+    """Rebalance onto a new shard list (needs SHARD_TOKEN)"""
+    token = request.headers.get('X-Shard-Token', '')
+    if not router.token or not secrets.compare_digest(token.encode(), router.token.encode()):
+        return json_response({'error': 'Not found'}, 404)
+    data = request.get_json(silent=True) or {}
+    shards = [str(shard).rstrip('/') for shard in data.get('shards', [])]
+    try:
+        router.rebalance(shards)
+    except ValueError as e:
+        return json_response({'success': False, 'error': str(e)}, 409)
+    return json_response({'success': True, 'shards': shards, 'ring': router.ring.id})
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{url}/healthz', timeout=2).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def launch(count, port, directory):
+    """Run `count` local shards (ports port+1...) and the router on `port` until interrupted"""
+    token = router.token or secrets.token_hex(16)
+    router.token = token
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    processes = []
+    shards = []
+    # Stopping the launcher stops its shards too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for number in range(count):
+            shard_dir = os.path.join(directory, str(number))
+            os.makedirs(shard_dir, exist_ok=True)
+            shard_port = port + 1 + number
+            env = dict(os.environ, PORT=str(shard_port), SHARD_TOKEN=token, TRUSTED_PROXIES='1')
+            # Each shard in its own directory: its own database, events and rate limits
+            processes.append(subprocess.Popen([sys.executable, server_py], cwd=shard_dir, env=env))
+            shards.append(f'http://127.0.0.1:{shard_port}')
+        for shard in shards:
+            if not wait_ready(shard):
+                raise SystemExit(f"❌ Shard {shard} did not start")
+        router.state_path = os.path.join(directory, 'router_state.json')
+        # Started before with another count: the keys are moved onto this ring
+        router.load(shards)
+        print(f"🔀 Router on port {port} over {len(shards)} shards (SHARD_TOKEN={token})")
+        app.run(host='0.0.0.0', port=port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Sharded activation server')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('launch', help='Run local shards and the router')
+    command.add_argument('--shards', type=int, default=3)
+    command.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    command.add_argument('--dir', default='shards')
+    command = commands.add_parser('rebalance', help='Move a running router onto a new shard list')
+    command.add_argument('--router', required=True, help='router URL')
+    command.add_argument('--shards', required=True, help='comma-separated shard URLs')
+    args = parser.parse_args(argv)
+
+    if args.command == 'launch':
+        launch(args.shards, args.port, args.dir)
+    else:
+        response = requests.post(f"{args.router.rstrip('/')}/shards", timeout=ROUTER_TIMEOUT,
+                                 json={'shards': [shard.strip() for shard in args.shards.split(',')]},
+                                 headers={'X-Shard-Token': SHARD_TOKEN})
+        print(serializer.dumps(response.json(), pretty=True).decode())
+
+
+if __name__ == '__main__':
+    main()
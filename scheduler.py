@@ -0,0 +1,110 @@
+"""Time-based key transitions: suspension resume and expiry.
+
+The scheduler asks the store for keys whose ``resume`` or ``expiry`` time
+has passed (an indexed range query on SQLite) and applies the transitions
+in bulk, through the store, so the /stats counters stay correct. Between
+runs ``/check`` reports the effective status computed by
+``record.effective_status`` without writing anything.
+
+Runs in-process in server.py (SCHEDULER=inprocess, the default) or as its
+own worker:
+
+    python scheduler.py
+
+The worker has to reach the web service's storage (same machine and
+DB_PATH), and the web service then runs with SCHEDULER=off. On platforms
+that give every service its own container and disk (Render), a separate
+worker would only update a copy nobody reads, so keep the default there.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from bloom import bloom_from_env
+from record import effective_status
+from shmindex import index_from_env
+from store import store_from_env
+
+SCHEDULER_INTERVAL = float(os.environ.get('SCHEDULER_INTERVAL', 30))
+SCHEDULER_BATCH = int(os.environ.get('SCHEDULER_BATCH', 500))
+
+
+def apply_due(now):
+    """Record modifier persisting the transitions that are due at `now`"""
+    def apply(record):
+        status = effective_status(record, now)
+        if status == record['status']:
+            return False
+        record['status'] = status
+        record.pop('resume', None)
+        return True
+    return apply
+
+
+class Scheduler:
+    """Applies due resume/expiry transitions in batches"""
+
+    def __init__(self, store, interval=SCHEDULER_INTERVAL, batch=SCHEDULER_BATCH):
+        self.store = store
+        self.interval = interval
+        self.batch = batch
+        self.transitions = 0
+
+    def run_once(self, now=None):
+        """Apply every transition due at `now`, returns how many keys changed"""
+        now = now or datetime.now()
+        changed = 0
+        previous = None
+        while True:
+            keys = self.store.due(now.isoformat(), self.batch)
+            if not keys or keys == previous:
+                break
+            previous = keys
+            # Each modifier re-checks the record inside the transaction, so
+            # a concurrent /extend or /resume is never overwritten; only the
+            # records it actually changed count as transitions
+            transition = apply_due(now)
+            applied = []
+
+            def apply(record):
+                applied.append(transition(record))
+                return applied[-1]
+            self.store.modify_many([(key, apply) for key in keys])
+            changed += sum(applied)
+            if len(keys) < self.batch:
+                break
+        self.transitions += changed
+        return changed
+
+    def seconds_until_next(self, now=None):
+        now = now or datetime.now()
+        upcoming = self.store.next_due()
+        if not upcoming:
+            return self.interval
+        wait = (datetime.fromisoformat(upcoming) - now).total_seconds()
+        return min(max(wait, 0.05), self.interval)
+
+    def run_forever(self):
+        while True:
+            try:
+                changed = self.run_once()
+                if changed:
+                    print(f"⏰ Scheduler applied {changed} resume/expiry transitions")
+                wait = self.seconds_until_next()
+            except Exception as e:
+                print(f"❌ Scheduler run failed: {e}")
+                wait = self.interval
+            time.sleep(wait)
+
+    def start(self):
+        thread = threading.Thread(target=self.run_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    print(f"⏰ Scheduler worker running every {SCHEDULER_INTERVAL}s at most")
+    # Keeps a shared /check index and Bloom filter on this machine in step
+    store, _ = bloom_from_env(index_from_env(store_from_env())[0])
+    Scheduler(store).run_forever()
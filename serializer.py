@@ -0,0 +1,175 @@
+"""JSON encoding shared by the stores, the route responses and the bot.
+
+Uses orjson, then msgspec, then the stdlib ``json`` module, whichever is
+installed first (``JSON_BACKEND`` forces one). Output is compact; set
+``JSON_PRETTY=1`` to get the old indented ``database.json`` and responses
+while debugging.
+
+``Schema`` describes the shape of a JSON object (activation records, the
+/check request and response). With msgspec installed ``decode`` parses
+straight into a typed struct, which validates while decoding and skips
+fields the schema does not know; otherwise the parsed dict is checked
+field by field.
+"""
+import json
+import os
+from collections.abc import Mapping
+from typing import Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+JSON_PRETTY = os.environ.get('JSON_PRETTY', '').lower() in ('1', 'true', 'yes')
+
+_available = [name for name, module in (('orjson', orjson), ('msgspec', msgspec)) if module]
+BACKEND = os.environ.get('JSON_BACKEND') or (_available[0] if _available else 'json')
+if BACKEND not in _available + ['json']:
+    raise ValueError(f"JSON_BACKEND={BACKEND} is not installed")
+
+
+def _default(obj):
+    # Record and other read-only mappings
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if BACKEND == 'msgspec':
+    _encoder = msgspec.json.Encoder(enc_hook=_default)
+    _sorted_encoder = msgspec.json.Encoder(enc_hook=_default, order='sorted')
+    _decoder = msgspec.json.Decoder()
+
+
+def dumps(obj, pretty=None, sort_keys=False):
+    """Encode to UTF-8 bytes, compact unless `pretty` (default JSON_PRETTY)"""
+    pretty = JSON_PRETTY if pretty is None else pretty
+    if BACKEND == 'orjson':
+        option = 0
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_default, option=option)
+    if BACKEND == 'msgspec':
+        data = (_sorted_encoder if sort_keys else _encoder).encode(obj)
+        return msgspec.json.format(data, indent=2) if pretty else data
+    return json.dumps(
+        obj, default=_default, sort_keys=sort_keys, ensure_ascii=False,
+        indent=2 if pretty else None, separators=None if pretty else (',', ':')
+    ).encode()
+
+
+def loads(data):
+    if BACKEND == 'orjson':
+        return orjson.loads(data)
+    if BACKEND == 'msgspec':
+        return _decoder.decode(data)
+    return json.loads(data)
+
+
+def _accepts(kind, value):
+    if isinstance(kind, tuple):
+        return any(_accepts(one, value) for one in kind)
+    if kind is int:
+        # bool is an int subclass but never a valid count
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, kind)
+
+
+class Schema:
+    """Typed shape of a JSON object: {field: type or tuple of types}, None allowed if optional"""
+
+    def __init__(self, name, fields, required=(), optional=()):
+        self.name = name
+        self.fields = fields
+        self.required = frozenset(required)
+        self.optional = frozenset(optional)
+        self._decoder = None
+        if msgspec is not None:
+            struct = msgspec.defstruct(name, [
+                (field, self._annotation(field, kind))
+                if field in self.required else
+                (field, Union[self._annotation(field, kind), msgspec.UnsetType], msgspec.UNSET)
+                for field, kind in fields.items()
+            ], kw_only=True)
+            self._decoder = msgspec.json.Decoder(struct)
+
+    def _annotation(self, field, kind):
+        if isinstance(kind, tuple):
+            kind = Union[kind]
+        return Optional[kind] if field in self.optional else kind
+
+    def validate(self, obj):
+        """Return `obj` if it matches the schema, raise ValueError otherwise"""
+        if not isinstance(obj, dict):
+            raise ValueError(f"{self.name}: expected an object")
+        for field in self.required:
+            if field not in obj:
+                raise ValueError(f"{self.name}: missing {field!r}")
+        for field, kind in self.fields.items():
+            value = obj.get(field)
+            if field not in obj or (value is None and field in self.optional):
+                continue
+            if not _accepts(kind, value):
+                names = ' or '.join(one.__name__ for one in kind) if isinstance(kind, tuple) else kind.__name__
+                raise ValueError(f"{self.name}: {field!r} must be {names}")
+        return obj
+
+    def decode(self, data):
+        """Parse and validate JSON bytes into a dict of the schema's fields"""
+        if self._decoder is None:
+            obj = self.validate(loads(data))
+            return {field: obj[field] for field in self.fields if field in obj}
+        try:
+            struct = self._decoder.decode(data)
+        except msgspec.ValidationError as e:
+            raise ValueError(f"{self.name}: {e}") from None
+        values = {}
+        for field in self.fields:
+            value = getattr(struct, field)
+            if value is not msgspec.UNSET:
+                values[field] = value
+        return values
+
+
+RECORD = Schema('ActivationRecord', {
+    'status': str,
+    'activated': str,
+    'expiry': str,
+    'months': int,
+    'registered_device': str,
+    'registered_path': str,
+    'registered_hash': str,
+    'first_use': str,
+    'resume': str,
+}, required=('status',), optional=(
+    'activated', 'expiry', 'months', 'registered_device', 'registered_path',
+    'registered_hash', 'first_use', 'resume'
+))
+
+CHECK_REQUEST = Schema('CheckRequest', {
+    # Clients have always been free to send a numeric device id
+    'device_id': (str, int),
+    'file_path': str,
+    'file_hash': str,
+    'token': bool,
+}, optional=('device_id', 'file_path', 'file_hash', 'token'))
+
+CHECK_RESPONSE = Schema('CheckResponse', {
+    'found': bool,
+    'status': str,
+    'message': str,
+    'expiry': str,
+    'activated': str,
+    'resume': str,
+    'months': int,
+    'registered': bool,
+    'token': str,
+}, required=('found',), optional=('expiry', 'activated', 'resume', 'months'))
@@ -1,14 +1,66 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import json
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import hashlib
-from datetime import datetime, timedelta
+import hmac
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import keygen
+import serializer
+from store import store_from_env
+from cache import RecordCache, CachedStore
+from record import EPOCH, MICROSECOND, effective_status
+from shmindex import UNKNOWN, index_from_env
+from bloom import bloom_from_env
+from singleflight import singleflight_from_env
+from license_client import now_ms
+from tokens import LICENSE_TOKEN_TTL, signer_from_env
+from ratelimit import limiter_from_env
+from events import event_log_from_env
+from scheduler import Scheduler
+from metrics import Metrics, TimedStore, database_bytes
+from profiler import Profiler, phase, slow_log_from_env
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through serializer.py (orjson/msgspec when installed)"""
+
+    def dumps(self, obj, **kwargs):
+        return serializer.dumps(obj, sort_keys=self.sort_keys).decode()
+
+    def loads(self, s, **kwargs):
+        with phase('parse'):
+            return serializer.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = serializer.JSON_PRETTY or self._app.debug
+        with phase('serialize'):
+            body = serializer.dumps(obj, pretty=pretty, sort_keys=self.sort_keys) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
 
-DB_FILE = "database.json"
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 5))
+STATS_RECONCILE_INTERVAL = int(os.environ.get("STATS_RECONCILE_INTERVAL", 3600))
+MAX_BATCH = int(os.environ.get("MAX_BATCH", 1000))
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", 1000))
+SCHEDULER = os.environ.get("SCHEDULER", "inprocess")
+# Reverse proxies in front of the app (Render: 1), so the client IP comes from X-Forwarded-For
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+# Shared with router.py when this server is one shard of several; the /shard routes are off without it
+SHARD_TOKEN = os.environ.get("SHARD_TOKEN", "")
+# Token for the /admin profiling routes, which are off without it
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 def get_device_id(request):
     """Extract unique device ID from request"""
@@ -25,18 +77,163 @@ def get_file_hash(request):
     data = request.get_json(silent=True) or {}
     return data.get('file_hash', '')
 
-# Initialize database
-if not os.path.exists(DB_FILE):
-    with open(DB_FILE, "w") as f:
-        json.dump({
-            "activations": {},
-            "stats": {
-                "total_keys": 0,
-                "active_keys": 0,
-                "suspended_keys": 0,
-                "inactive_keys": 0
-            }
-        }, f, indent=2)
+BOOT_STARTED = time.perf_counter()
+
+# Initialize database (DB_BACKEND / DB_PATH, see store.py)
+metrics = Metrics()
+metrics.init_app(app)
+# Per-phase timings of slow requests (SLOW_REQUEST_MS, see profiler.py)
+slow_log = slow_log_from_env()
+if slow_log is not None:
+    slow_log.init_app(app)
+    metrics.gauge('slow_requests_logged', 'Requests over SLOW_REQUEST_MS logged by this worker', lambda: slow_log.logged)
+# Sampling profiler, idle until started through /admin/profile
+profiler = Profiler()
+profiler.init_app(app)
+store = TimedStore(store_from_env(), metrics)
+# Shared mmap key index answering /check (SHM_INDEX=off to disable, see shmindex.py)
+store, index = index_from_env(store)
+# Shared Bloom filter rejecting unknown keys on /check (BLOOM_FILTER=off to disable, see bloom.py)
+store, bloom = bloom_from_env(store)
+# Concurrent reads of one key share a single store read (SINGLEFLIGHT, see singleflight.py)
+store, flight = singleflight_from_env(store)
+cache = RecordCache(CACHE_SIZE, CACHE_TTL)
+store = CachedStore(store, cache)
+if index is not None:
+    index.ensure()
+if bloom is not None:
+    bloom.ensure()
+
+metrics.gauge('activation_keys', 'Keys in the store', lambda: store.stats()['total_keys'])
+metrics.gauge('database_size_bytes', 'Database file size on disk', lambda: database_bytes(store.path))
+metrics.gauge('cache_entries', 'Records held in the read cache', lambda: cache.info()['size'])
+metrics.gauge('cache_hits', 'Read cache hits since start', lambda: cache.hits)
+metrics.gauge('cache_misses', 'Read cache misses since start', lambda: cache.misses)
+metrics.gauge('cache_hit_ratio', 'Read cache hit ratio since start', lambda: cache.info()['hit_ratio'])
+if index is not None:
+    metrics.gauge('shm_index_entries', 'Keys in the shared index', lambda: index.info()['entries'])
+    metrics.gauge('shm_index_hits', '/check answers served from the shared index', lambda: index.hits)
+    metrics.gauge('shm_index_fallbacks', 'Index slots that sent /check to the store', lambda: index.fallbacks)
+if bloom is not None:
+    # info() counts the filter's set bits: once per scrape for all four
+    metrics.gauge_group(bloom.info, [
+        ('bloom_keys', 'Keys added to the Bloom filter', 'keys'),
+        ('bloom_capacity', 'Keys the Bloom filter is sized for', 'capacity'),
+        ('bloom_bits', 'Bloom filter size in bits', 'bits'),
+        ('bloom_estimated_fp_rate', 'False-positive rate implied by the filled bits', 'estimated_fp_rate')
+    ])
+    metrics.gauge('bloom_rejected', '/check requests for unknown keys rejected by the filter', lambda: bloom.rejected)
+    metrics.gauge('bloom_false_positives', 'Unknown keys the filter let through', lambda: bloom.false_positives)
+if flight is not None:
+    metrics.gauge('singleflight_leaders', 'Record reads and first-use writes that ran', lambda: flight.leaders)
+    metrics.gauge('singleflight_coalesced', 'Calls that shared another request\'s read or write', lambda: flight.coalesced)
+    metrics.gauge('singleflight_coalesced_ratio', 'Share of calls coalesced since start', lambda: flight.info()['coalesced_ratio'])
+    metrics.gauge('singleflight_shared_reads', 'Reads served from another worker\'s slot', lambda: flight.info()['shared'])
+
+def reconcile_stats_forever():
+    """Periodically verify the incremental stats counters against a full scan"""
+    while True:
+        time.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            # Drift is logged and corrected by the store
+            store.reconcile()
+            if index is not None:
+                # Repairs slots a crashed writer committed but never indexed
+                index.rebuild()
+            if bloom is not None:
+                bloom.rebuild()
+        except Exception as e:
+            print(f"❌ Stats reconcile failed: {e}")
+
+if STATS_RECONCILE_INTERVAL > 0:
+    threading.Thread(target=reconcile_stats_forever, daemon=True).start()
+
+# Per-IP/device/key limits on /check (RATE_LIMIT_*, see ratelimit.py)
+limiter = limiter_from_env()
+if limiter is not None:
+    metrics.gauge('rate_limited_requests', '/check requests rejected with 429', lambda: limiter.rejected)
+    metrics.gauge('rate_limit_buckets', 'Rate limit buckets held', lambda: len(limiter.backend))
+
+    @app.before_request
+    def limit_check_requests():
+        """Reject abusive /check traffic before the route touches the store"""
+        if request.endpoint != 'check_key':
+            return None
+        body = request.get_json(silent=True)
+        device_id = body.get('device_id') if isinstance(body, dict) else None
+        wait = limiter.check(
+            ip=request.remote_addr,
+            device=device_id if isinstance(device_id, str) else None,
+            key=(request.view_args or {}).get('key', '').upper()
+        )
+        if wait:
+            response = jsonify({'found': False, 'error': 'Too many requests'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(wait)
+            return response
+        return None
+
+ADMIN_EVENTS = {
+    'activate_key': 'activate', 'deactivate_key': 'deactivate', 'extend_key': 'extend',
+    'suspend_key': 'suspend', 'resume_key': 'resume', 'batch_activate': 'activate',
+    'batch_extend': 'extend', 'batch_suspend': 'suspend', 'batch_deactivate': 'deactivate'
+}
+
+# Usage/admin event log, written by a background thread (EVENT_LOG=off to disable, see events.py)
+events = event_log_from_env()
+if events is not None:
+    metrics.gauge('events_queued', 'Events waiting for the log writer', lambda: events.queue.qsize())
+    metrics.gauge('events_written', 'Events written to the log', lambda: events.written)
+    metrics.gauge('events_dropped', 'Events dropped because the log queue was full', lambda: events.dropped)
+
+    @app.after_request
+    def log_check_event(response):
+        """One event per /check, with the outcome the handlers left in `g`"""
+        if request.endpoint == 'check_key':
+            key = (request.view_args or {}).get('key', '').upper()
+            if response.status_code == 429:
+                events.emit('check', key, outcome='rate_limited')
+            elif response.status_code == 400:
+                events.emit('check', key, outcome='bad_request')
+            elif 'check_errors' in g:
+                events.emit('check', key, outcome='blocked', errors=g.check_errors)
+            else:
+                events.emit('check', key, outcome=g.get('check_status', 'unknown'))
+        return response
+
+    @app.after_request
+    def log_admin_event(response):
+        """One event per key an admin route touched, read back from its response"""
+        event = ADMIN_EVENTS.get(request.endpoint)
+        if event is None or response.status_code != 200:
+            return response
+        body = response.get_json(silent=True) or {}
+        if 'results' in body:
+            for result in body['results']:
+                events.emit(event, result['key'], success=result['success'], batch=True)
+        else:
+            data = request.get_json(silent=True) or {}
+            fields = {name: data[name] for name in ('months', 'hours') if name in data}
+            events.emit(event, str(data.get('key', '')).upper(), success=body.get('success', False), **fields)
+        return response
+
+def log_event(event, key, **fields):
+    if events is not None:
+        events.emit(event, key, **fields)
+
+# Offline license tokens for /check (LICENSE_SIGNING_KEY / LICENSE_HMAC_SECRET, see tokens.py)
+signer = signer_from_env()
+
+# Resume/expiry transitions; set SCHEDULER=off when `python scheduler.py` runs as its own worker
+scheduler = Scheduler(store)
+if SCHEDULER == "inprocess":
+    scheduler.start()
+
+# Index and filter are mapped from their snapshot when the store has not
+# changed since, so a cold start does not rebuild them from the records
+BOOT_SECONDS = round(time.perf_counter() - BOOT_STARTED, 3)
+print(f"⚡ Ready in {BOOT_SECONDS}s (index: {index.loaded if index is not None else 'off'}, "
+      f"bloom: {bloom.loaded if bloom is not None else 'off'})")
 
 @app.route('/')
 def home():
@@ -47,21 +244,47 @@ def home():
         "server_url": "https://server5-3.onrender.com"
     })
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Readiness probe for the platform and the bot's keep-warm ping; reads no records"""
+    return jsonify({
+        'status': 'ready',
+        'uptime': round(time.perf_counter() - BOOT_STARTED, 1),
+        'boot_seconds': BOOT_SECONDS,
+        'index': index.loaded if index is not None else 'off',
+        'bloom': bloom.loaded if bloom is not None else 'off'
+    })
+
 @app.route('/check/<key>', methods=['POST'])
 def check_key(key):
     """Check key status with device, path and file binding"""
     key = key.upper()
-    data = request.get_json(silent=True) or {}
+    body = request.get_data()
+    try:
+        with phase('parse'):
+            data = parse_check_request(body) if request.is_json and body else {}
+    except ValueError as e:
+        return jsonify({'found': False, 'error': str(e)}), 400
     
     device_id = data.get('device_id')
     file_path = data.get('file_path')
     file_hash = data.get('file_hash')
+    want_token = data.get('token')
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
+    if bloom is not None and not bloom.might_contain(key):
+        return not_found()
     
-    if key in db['activations']:
-        key_data = db['activations'][key].copy()
+    if index is not None:
+        response = check_from_index(key, device_id, file_path, file_hash, want_token)
+        if response is not None:
+            return response
+    
+    key_data = store.get(key)
+    
+    if key_data is not None:
+        # Resume/expiry transitions that are due but not yet persisted by the
+        # scheduler are applied here for the response only
+        key_data['status'] = effective_status(key_data)
         
         # Check registered device, path and file
         registered_device = key_data.get('registered_device')
@@ -70,16 +293,30 @@ def check_key(key):
         
         # If key is active but no registration data (first use)
         if key_data['status'] == 'active' and not registered_device and device_id:
-            # Register all data for first time
-            db['activations'][key]['registered_device'] = device_id
-            db['activations'][key]['registered_path'] = file_path
-            db['activations'][key]['registered_hash'] = file_hash
-            db['activations'][key]['first_use'] = datetime.now().isoformat()
-            with open(DB_FILE, 'w') as f:
-                json.dump(db, f, indent=2)
-            key_data['registered_device'] = device_id
-            key_data['registered_path'] = file_path
-            key_data['registered_hash'] = file_hash
+            # Register all data for first time. The store runs this as an
+            # atomic compare-and-set: only the first caller binds the key,
+            # everyone else is checked against the winner's binding.
+            registered_at = datetime.now().isoformat()
+            def register(record):
+                if effective_status(record) != 'active' or record.get('registered_device'):
+                    return False
+                record['registered_device'] = device_id
+                record['registered_path'] = file_path
+                record['registered_hash'] = file_hash
+                record['first_use'] = registered_at
+                return True
+            # Identical first-use requests (same key and binding) share one write
+            record = coalesced(('register', key, device_id, file_path, file_hash),
+                               lambda: store.modify(key, register))
+            if record is None:
+                return not_found()
+            if record.get('first_use') == registered_at:
+                log_event('register', key)
+            key_data = dict(record, status=effective_status(record))
+            if record['registered_device'] != device_id:
+                registered_device = record['registered_device']
+                registered_path = record['registered_path']
+                registered_hash = record['registered_hash']
         
         # Verify everything matches
         if registered_device:
@@ -92,26 +329,9 @@ def check_key(key):
                 errors.append("Different file")
             
             if errors:
-                return jsonify({
-                    'found': True,
-                    'status': 'blocked',
-                    'message': f'Access denied: {", ".join(errors)}',
-                    'expiry': key_data.get('expiry', ''),
-                    'activated': key_data.get('activated', '')
-                }), 403
-        
-        # Check if temporary suspension ended
-        if key_data['status'] == 'suspended' and 'resume' in key_data:
-            resume_time = datetime.fromisoformat(key_data['resume'])
-            if datetime.now() > resume_time:
-                key_data['status'] = 'active'
-                db['activations'][key]['status'] = 'active'
-                if 'resume' in db['activations'][key]:
-                    del db['activations'][key]['resume']
-                with open(DB_FILE, 'w') as f:
-                    json.dump(db, f, indent=2)
+                return blocked_response(errors, key_data.get('expiry', ''), key_data.get('activated', ''))
         
-        return jsonify({
+        return check_response({
             'found': True,
             'status': key_data['status'],
             'expiry': key_data.get('expiry', ''),
@@ -119,26 +339,118 @@ def check_key(key):
             'resume': key_data.get('resume', ''),
             'months': key_data.get('months', 0),
             'registered': bool(key_data.get('registered_device'))
-        })
+        }, key, want_token, device_id, file_path, file_hash)
     
+    return unknown_key()
+
+def parse_check_request(body):
+    """The /check fields of a JSON body; a body that is not an object (null, a list) counts as {}"""
+    try:
+        data = serializer.CHECK_REQUEST.decode(body)
+    except ValueError:
+        # Malformed JSON raises again here and stays a 400
+        if not isinstance(serializer.loads(body), dict):
+            return {}
+        raise
+    if isinstance(data.get('device_id'), int):
+        # Bound as text, as the SQLite store would keep it anyway
+        data['device_id'] = str(data['device_id'])
+    return data
+
+def coalesced(key, fn):
+    """fn(), shared with concurrent calls for the same key when single-flight is on"""
+    return flight.do(key, fn) if flight is not None else fn()
+
+def check_response(body, key, want_token, device_id, file_path, file_hash):
+    """/check answer, with a signed offline token if asked for and the key is active and bound"""
+    g.check_status = body['status']
+    if signer is not None and want_token and body['status'] == 'active' and body['registered']:
+        token = issue_token(key, device_id, file_path, file_hash)
+        if token is not None:
+            body['token'] = token
+    return jsonify(body)
+
+def issue_token(key, device_id, file_path, file_hash):
+    """Offline token for the key if the store still has it active and bound to these values
+
+    The /check answer may come from the index or the cache, which can trail
+    a deactivation committed a moment ago. The key's revocation version is
+    read first and the record after it, straight from the store: a
+    deactivation either shows in the record, or its revoke_tokens() records
+    a higher version than the token carries.
+    """
+    revocation = store.revocations(0, [key]).get(key, 0)
+    record = store.get_many([key])[0]
+    if record is None or effective_status(record) != 'active':
+        return None
+    bound = (record.get('registered_device'), record.get('registered_path'), record.get('registered_hash'))
+    if bound != (device_id, file_path, file_hash):
+        return None
+    return signer.issue(key, record['expiry'], device_id, file_path, file_hash, revocation)
+
+def unknown_key():
+    """/check answer for a key the filter let through but the store does not hold"""
+    if bloom is not None:
+        bloom.false_positives += 1
+    return not_found()
+
+def not_found():
+    """/check answer for a key the store does not hold, logged as outcome 'not_found'"""
+    g.check_status = 'not_found'
     return jsonify({'found': False})
 
-@app.route('/activate', methods=['POST'])
-def activate_key():
-    """Activate a new key"""
-    data = request.json
-    key = data.get('key', '').upper()
-    months = int(data.get('months', 1))
+def blocked_response(errors, expiry, activated):
+    g.check_errors = errors
+    return jsonify({
+        'found': True,
+        'status': 'blocked',
+        'message': f'Access denied: {", ".join(errors)}',
+        'expiry': expiry,
+        'activated': activated
+    }), 403
+
+def check_from_index(key, device_id, file_path, file_hash, want_token):
+    """/check answered from the shared index, None when the store has to answer"""
+    entry = index.lookup(key)
+    if entry is UNKNOWN:
+        return None
+    if entry is None:
+        return unknown_key()
+    
+    status = entry.effective_status((datetime.now() - EPOCH) // MICROSECOND)
+    if status == 'active' and not entry.registered and device_id:
+        # First use: the binding is written through the store
+        return None
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
+    if entry.registered:
+        errors = entry.binding_errors(device_id, file_path, file_hash)
+        if errors:
+            return blocked_response(errors, entry.field('expiry'), entry.field('activated'))
     
+    return check_response({
+        'found': True,
+        'status': status,
+        'expiry': entry.field('expiry'),
+        'activated': entry.field('activated'),
+        'resume': entry.field('resume'),
+        'months': entry.field('months'),
+        'registered': entry.registered
+    }, key, want_token, device_id, file_path, file_hash)
+
+def revoke_tokens(keys):
+    """Cut short the offline tokens already issued for these keys"""
+    if signer is not None and keys:
+        now = now_ms()
+        store.revoke(keys, now, now - LICENSE_TOKEN_TTL * 1000)
+
+def new_activation(months):
+    """Build the record stored for a freshly activated key"""
     if months > 0:
         expiry = (datetime.now() + timedelta(days=months*30)).isoformat()
     else:
         expiry = "permanent"
     
-    db['activations'][key] = {
+    return {
         'status': 'active',
         'activated': datetime.now().isoformat(),
         'expiry': expiry,
@@ -148,24 +460,58 @@ def activate_key():
         'registered_hash': None,
         'first_use': None
     }
+
+def extender(months):
+    """Record modifier adding `months` to the expiry and reactivating the key"""
+    def extend(record):
+        if record['expiry'] != "permanent":
+            now = datetime.now()
+            current_expiry = datetime.fromisoformat(record['expiry'])
+            if effective_status(record, now) == 'expired':
+                # An expired key gets the full extension from today, also
+                # when the scheduler has not marked it expired yet
+                current_expiry = max(current_expiry, now)
+            new_expiry = current_expiry + timedelta(days=months*30)
+            expiry = new_expiry.isoformat()
+        else:
+            expiry = "permanent"
+        
+        record.update({
+            'expiry': expiry,
+            'months': record['months'] + months,
+            'status': 'active'
+        })
+        return True
+    return extend
+
+def suspender(resume):
+    """Record modifier suspending the key until `resume`"""
+    def suspend(record):
+        record['status'] = 'suspended'
+        record['resume'] = resume
+        return True
+    return suspend
+
+def deactivate_record(record):
+    record['status'] = 'inactive'
+    return True
+
+def resume_record(record):
+    record['status'] = 'active'
+    record.pop('resume', None)
+    return True
+
+@app.route('/activate', methods=['POST'])
+def activate_key():
+    """Activate a new key"""
+    data = request.json
+    key = data.get('key', '').upper()
+    months = int(data.get('months', 1))
     
-    # Update statistics
-    total = len(db['activations'])
-    active = sum(1 for k in db['activations'].values() if k['status'] == 'active')
-    suspended = sum(1 for k in db['activations'].values() if k['status'] == 'suspended')
-    inactive = total - active - suspended
-    
-    db['stats'] = {
-        'total_keys': total,
-        'active_keys': active,
-        'suspended_keys': suspended,
-        'inactive_keys': inactive
-    }
-    
-    with open(DB_FILE, 'w') as f:
-        json.dump(db, f, indent=2)
+    record = new_activation(months)
+    store.put(key, record)
     
-    return jsonify({'success': True, 'key': key, 'expiry': expiry})
+    return jsonify({'success': True, 'key': key, 'expiry': record['expiry']})
 
 @app.route('/deactivate', methods=['POST'])
 def deactivate_key():
@@ -173,28 +519,8 @@ def deactivate_key():
     data = request.json
     key = data.get('key', '').upper()
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
-    
-    if key in db['activations']:
-        db['activations'][key]['status'] = 'inactive'
-        
-        # Update statistics
-        total = len(db['activations'])
-        active = sum(1 for k in db['activations'].values() if k['status'] == 'active')
-        suspended = sum(1 for k in db['activations'].values() if k['status'] == 'suspended')
-        inactive = total - active - suspended
-        
-        db['stats'] = {
-            'total_keys': total,
-            'active_keys': active,
-            'suspended_keys': suspended,
-            'inactive_keys': inactive
-        }
-        
-        with open(DB_FILE, 'w') as f:
-            json.dump(db, f, indent=2)
-        
+    if store.modify(key, deactivate_record) is not None:
+        revoke_tokens([key])
         return jsonify({'success': True})
     
     return jsonify({'success': False})
@@ -206,40 +532,9 @@ def extend_key():
     key = data.get('key', '').upper()
     months = int(data.get('months', 1))
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
-    
-    if key in db['activations']:
-        if db['activations'][key]['expiry'] != "permanent":
-            current_expiry = datetime.fromisoformat(db['activations'][key]['expiry'])
-            new_expiry = current_expiry + timedelta(days=months*30)
-            expiry = new_expiry.isoformat()
-        else:
-            expiry = "permanent"
-        
-        db['activations'][key].update({
-            'expiry': expiry,
-            'months': db['activations'][key]['months'] + months,
-            'status': 'active'
-        })
-        
-        # Update statistics
-        total = len(db['activations'])
-        active = sum(1 for k in db['activations'].values() if k['status'] == 'active')
-        suspended = sum(1 for k in db['activations'].values() if k['status'] == 'suspended')
-        inactive = total - active - suspended
-        
-        db['stats'] = {
-            'total_keys': total,
-            'active_keys': active,
-            'suspended_keys': suspended,
-            'inactive_keys': inactive
-        }
-        
-        with open(DB_FILE, 'w') as f:
-            json.dump(db, f, indent=2)
-        
-        return jsonify({'success': True, 'key': key, 'expiry': expiry})
+    record = store.modify(key, extender(months))
+    if record is not None:
+        return jsonify({'success': True, 'key': key, 'expiry': record['expiry']})
     
     return jsonify({'success': False})
 
@@ -250,30 +545,10 @@ def suspend_key():
     key = data.get('key', '').upper()
     hours = int(data.get('hours', 1))
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
+    resume = (datetime.now() + timedelta(hours=hours)).isoformat()
     
-    if key in db['activations']:
-        resume = (datetime.now() + timedelta(hours=hours)).isoformat()
-        db['activations'][key]['status'] = 'suspended'
-        db['activations'][key]['resume'] = resume
-        
-        # Update statistics
-        total = len(db['activations'])
-        active = sum(1 for k in db['activations'].values() if k['status'] == 'active')
-        suspended = sum(1 for k in db['activations'].values() if k['status'] == 'suspended')
-        inactive = total - active - suspended
-        
-        db['stats'] = {
-            'total_keys': total,
-            'active_keys': active,
-            'suspended_keys': suspended,
-            'inactive_keys': inactive
-        }
-        
-        with open(DB_FILE, 'w') as f:
-            json.dump(db, f, indent=2)
-        
+    if store.modify(key, suspender(resume)) is not None:
+        revoke_tokens([key])
         return jsonify({'success': True, 'resume': resume})
     
     return jsonify({'success': False})
@@ -284,58 +559,434 @@ def resume_key():
     data = request.json
     key = data.get('key', '').upper()
     
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
-    
-    if key in db['activations']:
-        db['activations'][key]['status'] = 'active'
-        if 'resume' in db['activations'][key]:
-            del db['activations'][key]['resume']
-        
-        # Update statistics
-        total = len(db['activations'])
-        active = sum(1 for k in db['activations'].values() if k['status'] == 'active')
-        suspended = sum(1 for k in db['activations'].values() if k['status'] == 'suspended')
-        inactive = total - active - suspended
-        
-        db['stats'] = {
-            'total_keys': total,
-            'active_keys': active,
-            'suspended_keys': suspended,
-            'inactive_keys': inactive
-        }
-        
-        with open(DB_FILE, 'w') as f:
-            json.dump(db, f, indent=2)
-        
+    if store.modify(key, resume_record) is not None:
         return jsonify({'success': True})
     
     return jsonify({'success': False})
 
+def batch_items(data, field=None, default=1):
+    """Normalise a batch body into [(KEY, value)]
+
+    Accepts {"keys": ["A", "B"], "<field>": n} or
+    {"keys": [{"key": "A", "<field>": n}, ...]}. Returns None if invalid.
+    """
+    entries = (data or {}).get('keys')
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BATCH:
+        return None
+    shared = data.get(field, default) if field else None
+    items = []
+    try:
+        for entry in entries:
+            if isinstance(entry, dict):
+                key = str(entry.get('key', ''))
+                value = entry.get(field, shared) if field else None
+            else:
+                key, value = str(entry), shared
+            key = key.strip().upper()
+            if not key:
+                return None
+            items.append((key, int(value) if field else None))
+    except (TypeError, ValueError):
+        return None
+    return items
+
+def batch_error():
+    return jsonify({
+        'success': False,
+        'error': f'Invalid batch: "keys" must list 1-{MAX_BATCH} keys with integer values'
+    }), 400
+
+def batch_response(results):
+    succeeded = sum(1 for r in results if r['success'])
+    return jsonify({
+        'success': True,
+        'results': results,
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    })
+
+@app.route('/batch/activate', methods=['POST'])
+def batch_activate():
+    """Activate many keys in one transaction"""
+    items = batch_items(request.get_json(silent=True), 'months')
+    if items is None:
+        return batch_error()
+    
+    records = [(key, new_activation(months)) for key, months in items]
+    store.put_many(records)
+    
+    return batch_response([
+        {'key': key, 'success': True, 'expiry': record['expiry']}
+        for key, record in records
+    ])
+
+@app.route('/batch/extend', methods=['POST'])
+def batch_extend():
+    """Extend many keys in one transaction"""
+    items = batch_items(request.get_json(silent=True), 'months')
+    if items is None:
+        return batch_error()
+    
+    records = store.modify_many([(key, extender(months)) for key, months in items])
+    
+    return batch_response([
+        {'key': key, 'success': True, 'expiry': record['expiry']} if record is not None
+        else {'key': key, 'success': False}
+        for (key, _), record in zip(items, records)
+    ])
+
+@app.route('/batch/suspend', methods=['POST'])
+def batch_suspend():
+    """Suspend many keys in one transaction"""
+    items = batch_items(request.get_json(silent=True), 'hours')
+    if items is None:
+        return batch_error()
+    
+    now = datetime.now()
+    ops = []
+    for key, hours in items:
+        ops.append((key, suspender((now + timedelta(hours=hours)).isoformat())))
+    records = store.modify_many(ops)
+    revoke_tokens([key for (key, _), record in zip(items, records) if record is not None])
+    
+    return batch_response([
+        {'key': key, 'success': True, 'resume': record['resume']} if record is not None
+        else {'key': key, 'success': False}
+        for (key, _), record in zip(items, records)
+    ])
+
+@app.route('/batch/deactivate', methods=['POST'])
+def batch_deactivate():
+    """Deactivate many keys in one transaction"""
+    items = batch_items(request.get_json(silent=True))
+    if items is None:
+        return batch_error()
+    
+    records = store.modify_many([(key, deactivate_record) for key, _ in items])
+    revoke_tokens([key for (key, _), record in zip(items, records) if record is not None])
+    
+    return batch_response([
+        {'key': key, 'success': record is not None}
+        for (key, _), record in zip(items, records)
+    ])
+
+def generate_records(count, months, prefix=''):
+    """`count` new random keys activated for `months`, inserted in one transaction
+
+    Keys the store already holds are drawn again, in another transaction.
+    """
+    record = new_activation(months)
+    created = []
+    for _ in range(keygen.GENERATE_ATTEMPTS):
+        items = [(key, record) for key in keygen.candidates(count - len(created), prefix)]
+        inserted = set(store.insert_many(items))
+        created += [item for item in items if item[0] in inserted]
+        if len(created) == count:
+            break
+    return created
+
+def export_response(records, fmt):
+    """Generated keys streamed as a CSV/NDJSON attachment"""
+    response = Response(keygen.export(records, fmt), mimetype=keygen.EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{keygen.export_filename(fmt)}"'
+    response.headers['X-Generated-Count'] = str(len(records))
+    return response
+
+@app.route('/generate', methods=['POST'])
+def generate_keys():
+    """Create random keys activated for `months`, streamed back as CSV or NDJSON"""
+    parsed = keygen.parse_request(request.get_json(silent=True))
+    if parsed is None:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid request: "count" must be 1-{keygen.GENERATE_MAX}, "months" >= 0, '
+                     f'"format" csv or ndjson'
+        }), 400
+    count, months, prefix, fmt = parsed
+    created = generate_records(count, months, prefix)
+    log_event('generate', None, count=len(created), months=months)
+    print(f"🎲 Generated {len(created)} keys ({months} months)")
+    return export_response(created, fmt)
+
+def list_item(key, data):
+    return {
+        'key': key,
+        'status': data['status'],
+        'expiry': data.get('expiry', ''),
+        'activated': data.get('activated', ''),
+        'registered': bool(data.get('registered_device'))
+    }
+
+def list_filters(args):
+    """Read the /list filters from the query string"""
+    filters = {}
+    if args.get('status'):
+        filters['status'] = args['status']
+    if args.get('prefix'):
+        filters['prefix'] = args['prefix'].upper()
+    if args.get('expires_after'):
+        filters['expires_after'] = datetime.fromisoformat(args['expires_after']).isoformat()
+    if args.get('expires_before'):
+        filters['expires_before'] = datetime.fromisoformat(args['expires_before']).isoformat()
+    if args.get('registered') in ('1', 'true', 'yes'):
+        filters['registered'] = True
+    elif args.get('registered') in ('0', 'false', 'no'):
+        filters['registered'] = False
+    return filters
+
+def not_modified(version, modified):
+    """304 if the client's copy of a /stats or /list answer is still current"""
+    if request.if_none_match:
+        current = request.if_none_match.contains(version_tag(version, modified))
+    else:
+        since = request.if_modified_since
+        current = bool(since and modified and modified // 1000 <= since.timestamp())
+    return versioned(Response(status=304), version, modified) if current else None
+
+def version_tag(version, modified):
+    # The modification time tells apart equal versions of a recreated database
+    return f'v{version}-{modified}'
+
+def versioned(response, version, modified):
+    """Tag a response with the store version it was built from"""
+    response.set_etag(version_tag(version, modified))
+    if modified:
+        response.last_modified = datetime.fromtimestamp(modified // 1000, timezone.utc)
+    return response
+
 @app.route('/list', methods=['GET'])
 def list_keys():
-    """List all keys"""
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
-    
-    keys_list = []
-    for key, data in db['activations'].items():
-        keys_list.append({
-            'key': key,
-            'status': data['status'],
-            'expiry': data.get('expiry', ''),
-            'activated': data.get('activated', ''),
-            'registered': bool(data.get('registered_device'))
-        })
+    """List keys, optionally filtered, paginated (limit/cursor) or streamed as NDJSON"""
+    version, modified = store.version()
+    cached = not_modified(version, modified)
+    if cached is not None:
+        return cached
+    try:
+        filters = list_filters(request.args)
+        limit = request.args.get('limit', type=int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    cursor = request.args.get('cursor') or None
+    
+    if request.args.get('format') == 'ndjson':
+        def export():
+            after = cursor
+            while True:
+                page = store.scan(after=after, limit=LIST_PAGE_SIZE, **filters)
+                for key, data in page:
+                    yield serializer.dumps(list_item(key, data), pretty=False) + b'\n'
+                if len(page) < LIST_PAGE_SIZE:
+                    break
+                after = page[-1][0]
+        return versioned(Response(export(), mimetype='application/x-ndjson'), version, modified)
     
-    return jsonify({'keys': keys_list, 'total': len(keys_list)})
+    if limit is None and cursor is None:
+        # Unpaginated form kept for existing clients
+        keys_list = [list_item(key, data) for key, data in store.scan(**filters)]
+        return versioned(jsonify({'keys': keys_list, 'total': len(keys_list)}), version, modified)
+    
+    limit = max(1, min(limit or LIST_PAGE_SIZE, LIST_PAGE_SIZE))
+    # Fetch one extra row to know whether another page exists
+    page = store.scan(after=cursor, limit=limit + 1, **filters)
+    keys_list = [list_item(key, data) for key, data in page[:limit]]
+    
+    return versioned(jsonify({
+        'keys': keys_list,
+        'total': len(keys_list),
+        'next_cursor': keys_list[-1]['key'] if len(page) > limit else None
+    }), version, modified)
+
+MIRROR_FIELDS = ('status', 'expiry', 'activated', 'resume', 'months', 'registered')
+
+def mirror_row(data):
+    """A record as the /changes feed sends it, values in MIRROR_FIELDS order; None if deleted"""
+    if data is None:
+        return None
+    return [data['status'], data.get('expiry', ''), data.get('activated', ''),
+            data.get('resume', ''), data.get('months', 0), bool(data.get('registered_device'))]
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """Keys written after store version `since`, or every key if the change log starts later
+
+    A client keeps the returned version and asks again with it; records
+    are sent whole, so applying one twice is harmless. A null row is a key
+    that was deleted (moved to another shard).
+    """
+    since = request.args.get('since', 0, type=int)
+    version, modified, records = store.changes(since)
+    snapshot = records is None
+    if snapshot:
+        # Read after the version, so these are at least as new as it
+        records = store.items()
+    return jsonify({
+        'version': version,
+        'modified': modified,
+        'snapshot': snapshot,
+        'fields': MIRROR_FIELDS,
+        'keys': {key: mirror_row(data) for key, data in records}
+    })
+
+def shard_request():
+    """True if the request comes from the router (carries SHARD_TOKEN)"""
+    token = request.headers.get('X-Shard-Token', '')
+    return bool(SHARD_TOKEN) and hmac.compare_digest(token.encode(), SHARD_TOKEN.encode())
+
+def shard_forbidden():
+    return jsonify({'error': 'Not found'}), 404
+
+@app.route('/shard/export', methods=['POST'])
+def shard_export():
+    """Full records of the listed keys, or a page of every record after a cursor"""
+    if not shard_request():
+        return shard_forbidden()
+    data = request.get_json(silent=True) or {}
+    if 'keys' in data:
+        records = []
+        for key in data['keys']:
+            # Another worker may have written the key since this one cached it
+            cache.invalidate(key)
+            record = store.get(key)
+            if record is not None:
+                records.append((key, record))
+        next_cursor = None
+        # Revocation versions move with the keys, so the new owner keeps increasing them
+        revocations = store.revocations(0, [key for key, _ in records]) if records else {}
+    else:
+        limit = max(1, min(int(data.get('limit') or LIST_PAGE_SIZE), LIST_PAGE_SIZE))
+        page = store.scan(after=data.get('after'), limit=limit + 1)
+        records = page[:limit]
+        next_cursor = records[-1][0] if len(page) > limit else None
+        revocations = {}
+    return jsonify({'records': [[key, dict(record)] for key, record in records],
+                    'revocations': revocations,
+                    'next_cursor': next_cursor})
+
+@app.route('/shard/import', methods=['POST'])
+def shard_import():
+    """Store records moved here from another shard, as they were"""
+    if not shard_request():
+        return shard_forbidden()
+    data = request.get_json(silent=True) or {}
+    try:
+        items = [(str(key), serializer.RECORD.validate(record)) for key, record in data.get('records', [])]
+        revocations = {str(key): int(value) for key, value in (data.get('revocations') or {}).items()}
+    except (AttributeError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if items:
+        store.put_many(items)
+    keep_after = now_ms() - LICENSE_TOKEN_TTL * 1000
+    for value in set(revocations.values()):
+        store.revoke([key for key in revocations if revocations[key] == value], value, keep_after)
+    for key, _ in items:
+        log_event('moved_in', key)
+    return jsonify({'success': True, 'imported': len(items)})
+
+@app.route('/shard/drop', methods=['POST'])
+def shard_drop():
+    """Delete keys another shard now holds"""
+    if not shard_request():
+        return shard_forbidden()
+    data = request.get_json(silent=True) or {}
+    keys = [str(key) for key in data.get('keys', [])]
+    deleted = store.delete_many(keys) if keys else []
+    for key in deleted:
+        log_event('moved_out', key)
+    return jsonify({'success': True, 'deleted': deleted})
+
+@app.route('/shard/insert', methods=['POST'])
+def shard_insert():
+    """Activate the router's generated keys that this shard does not hold yet"""
+    if not shard_request():
+        return shard_forbidden()
+    data = request.get_json(silent=True) or {}
+    record = new_activation(int(data.get('months', 1)))
+    keys = [str(key) for key in data.get('keys', [])]
+    inserted = store.insert_many([(key, record) for key in keys]) if keys else []
+    return jsonify({'success': True, 'inserted': inserted, 'record': record})
+
+@app.route('/license/key', methods=['GET'])
+def get_license_key():
+    """Algorithm and public key clients verify offline license tokens with"""
+    if signer is None:
+        return jsonify({'error': 'License tokens are not enabled'}), 404
+    return jsonify({'alg': signer.alg, 'public_key': signer.public_key, 'ttl': signer.ttl})
+
+@app.route('/revocations', methods=['GET'])
+def get_revocations():
+    """Keys deactivated/suspended within the token lifetime; 304 while unchanged"""
+    since = now_ms() - LICENSE_TOKEN_TTL * 1000
+    body = serializer.dumps({'revoked': store.revocations(since), 'ttl': LICENSE_TOKEN_TTL},
+                            sort_keys=True)
+    response = Response(body + b'\n', mimetype='application/json')
+    response.set_etag(hashlib.sha256(body).hexdigest()[:32])
+    return response.make_conditional(request)
 
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Get system statistics"""
-    with open(DB_FILE, 'r') as f:
-        db = json.load(f)
-    return jsonify(db['stats'])
+    version, modified = store.version()
+    cached = not_modified(version, modified)
+    if cached is not None:
+        return cached
+    return versioned(jsonify(store.stats()), version, modified)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for this worker"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats/cache', methods=['GET'])
+def get_cache_stats():
+    """Get read cache hit/miss counters"""
+    return jsonify(cache.info())
+
+def admin_request():
+    """True if the request carries ADMIN_TOKEN (X-Admin-Token or a Bearer token)"""
+    token = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if not token and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def admin_forbidden():
+    # The /admin routes do not exist for a request without the token
+    return jsonify({'error': 'Not found'}), 404
+
+@app.route('/admin/profile', methods=['POST'])
+def start_profile():
+    """Sample the request threads of every worker for the next `seconds`"""
+    if not admin_request():
+        return admin_forbidden()
+    data = request.get_json(silent=True) or {}
+    try:
+        run = profiler.start(data.get('seconds', 10), data.get('interval_ms'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid seconds or interval_ms'}), 400
+    return jsonify({'success': True, **run})
+
+@app.route('/admin/profile', methods=['GET'])
+def get_profile():
+    """Collapsed stacks of the latest profile, merged across workers"""
+    if not admin_request():
+        return admin_forbidden()
+    result = profiler.result()
+    if result is None:
+        return jsonify({'error': 'No profile has been taken'}), 404
+    if request.args.get('format') == 'collapsed':
+        return Response(result['collapsed'], mimetype='text/plain')
+    return jsonify(result)
+
+@app.route('/admin/slow', methods=['GET'])
+def get_slow_requests():
+    """Latest requests over SLOW_REQUEST_MS with their per-phase timings"""
+    if not admin_request():
+        return admin_forbidden()
+    if slow_log is None:
+        return jsonify({'threshold_ms': 0, 'requests': []})
+    limit = max(1, min(request.args.get('limit', 20, type=int), 200))
+    return jsonify({'threshold_ms': slow_log.threshold_ms, 'requests': slow_log.recent(limit)})
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,479 @@
+"""Shared, memory-mapped key index for /check across gunicorn workers.
+
+One file (``<DB_PATH>.index``) holds an open-addressing hash table with a
+fixed-size slot per key: status, activated/expiry/resume as epoch
+microseconds, months, and keyed digests of the bound device, path and
+file hash. Every worker maps the same file, so /check reads a slot in
+place instead of loading and deserializing the record, and there is one
+copy of the index per machine rather than one per worker.
+
+Writers update slots in place after the store commits, under an flock on
+``<path>.lock``. They write the records as the store holds them once the
+flock is held, not the ones they committed: two writers of one key may
+reach the index in the opposite order from their commits, and the one
+arriving last still writes the latest commit. Each slot carries a sequence number (odd while being
+written) so readers retry instead of seeing a torn slot. Growing the table,
+and the periodic rebuild that repairs a writer that died between commit
+and index update, build a new file from the store and swap it in with
+os.replace; the old file is flagged retired so other workers remap.
+
+The file outlives the process and serves as a snapshot for the next boot:
+the header records the store version the table reflects and how many
+writes are between their store commit and their index update. A boot
+whose store is still at that version, with no write left half done,
+maps the file as it is instead of rebuilding from the store. Otherwise it
+is rebuilt once per boot (per gunicorn master, told apart by the random
+BOOT_ID it hands its workers). The index is only an accelerator: any slot
+it cannot represent exactly is flagged and /check falls back to the store.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import secrets
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from record import STATUS_BY_NAME, STATUS_NAMES, pack_time, unpack_time
+
+SHM_INDEX = os.environ.get('SHM_INDEX', 'on')
+# Same in every worker of one gunicorn master (set in gunicorn.conf.py), new
+# on each start; a process started without it is a boot of its own
+BOOT_ID = int(os.environ.get('BOOT_ID') or secrets.randbits(63))
+
+MAGIC = b'AKIX'
+FORMAT = 2
+KEY_BYTES = 48
+MIN_CAPACITY = 1024
+MAX_LOAD = 0.7
+
+# magic, format, capacity, used, retired, boot id, digest key, writes in
+# flight, store version and modified time the table reflects
+HEADER = struct.Struct('<4sIQQIQ16siqq')
+HEADER_SIZE = 128
+SEQ = struct.Struct('<I')
+# key, key hash, status, flags, months, activated, expiry, resume,
+# device digest, path digest, file hash digest
+BODY = struct.Struct('<48sQBBxxiqqq16s16s16s')
+SLOT_SIZE = 144
+
+FALLBACK = 1
+REGISTERED = 2
+
+TIME_MISSING = -2 ** 63
+TIME_NONE = -2 ** 63 + 1
+TIME_PERMANENT = 2 ** 63 - 1
+MONTHS_MISSING = -2 ** 31
+MONTHS_NONE = -2 ** 31 + 1
+
+# Returned by lookup() when the index cannot answer for the key
+UNKNOWN = object()
+
+
+def _key_hash(raw):
+    value = int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'little')
+    return value or 1
+
+
+def _pack_time(record, field):
+    if field not in record:
+        return TIME_MISSING
+    value = record[field]
+    if value is None:
+        return TIME_NONE
+    if value == 'permanent':
+        return TIME_PERMANENT
+    value = pack_time(value)
+    if type(value) is not int:
+        raise ValueError(field)
+    return value
+
+
+def _unpack_time(value, default=''):
+    if value == TIME_MISSING:
+        return default
+    if value == TIME_NONE:
+        return None
+    if value == TIME_PERMANENT:
+        return 'permanent'
+    return unpack_time(value)
+
+
+class IndexEntry:
+    """Decoded slot; times are epoch microseconds or one of the sentinels"""
+
+    __slots__ = ('status', 'fallback', 'registered', 'months', 'activated', 'expiry',
+                 'resume', 'bindings', 'digest_key')
+
+    def __init__(self, body, digest_key):
+        status, flags, months, activated, expiry, resume = body[2:8]
+        self.status = STATUS_NAMES.get(status)
+        self.fallback = bool(flags & FALLBACK) or self.status is None
+        self.registered = bool(flags & REGISTERED)
+        self.months = months
+        self.activated = activated
+        self.expiry = expiry
+        self.resume = resume
+        self.bindings = body[8:]
+        self.digest_key = digest_key
+
+    def effective_status(self, now_us):
+        """record.effective_status() on the packed times"""
+        if self.status in ('active', 'suspended') and TIME_NONE < self.expiry < TIME_PERMANENT \
+                and now_us > self.expiry:
+            return 'expired'
+        if self.status == 'suspended' and TIME_NONE < self.resume < TIME_PERMANENT \
+                and now_us > self.resume:
+            return 'active'
+        return self.status
+
+    def field(self, name):
+        """The value record.get(name, '') would give, as /check returns it"""
+        if name == 'months':
+            if self.months == MONTHS_MISSING:
+                return 0
+            return None if self.months == MONTHS_NONE else self.months
+        return _unpack_time(getattr(self, name))
+
+    def binding_errors(self, device_id, file_path, file_hash):
+        """The /check "Different ..." errors for a request against the bound values"""
+        errors = []
+        for label, value, bound in zip(('Different device', 'Different path', 'Different file'),
+                                       (device_id, file_path, file_hash), self.bindings):
+            try:
+                if _digest(self.digest_key, value) != bound:
+                    errors.append(label)
+            except ValueError:
+                errors.append(label)
+        return errors
+
+
+class _Torn(Exception):
+    """A slot stayed mid-write (its writer died); the store has to answer"""
+
+
+def _digest(digest_key, value):
+    if value is None:
+        data = b'\0'
+    elif isinstance(value, str):
+        data = b'\1' + value.encode()
+    else:
+        raise ValueError(value)
+    return hashlib.blake2b(data, digest_size=16, key=digest_key).digest()
+
+
+class KeyIndex:
+    """Memory-mapped open-addressing table of activation keys"""
+
+    SPIN_LIMIT = 10000
+
+    def __init__(self, path, source, version=None, fetch=None):
+        self.path = path
+        self.lock_path = path + '.lock'
+        # Callable returning (key, record) pairs, used to (re)build the table
+        self.source = source
+        # Callable returning the store's (version, modified), to trust a snapshot
+        self.version = version
+        # Callable returning the committed records of a list of keys (None if absent)
+        self.fetch = fetch
+        # How ensure() found the table: 'built', 'snapshot' or 'shared'
+        self.loaded = None
+        self.hits = 0
+        self.fallbacks = 0
+        # (mmap, capacity, digest key), replaced as one when the file is swapped
+        self._table = None
+        self._thread_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_thread_lock)
+
+    def _reset_thread_lock(self):
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        """Map the current index file, None if there is none"""
+        try:
+            with open(self.path, 'r+b') as f:
+                mapping = mmap.mmap(f.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            return None
+        if len(mapping) < HEADER_SIZE:
+            return None
+        magic, fmt, capacity, _, _, _, digest_key = HEADER.unpack_from(mapping, 0)[:7]
+        if magic != MAGIC or fmt != FORMAT or len(mapping) != HEADER_SIZE + capacity * SLOT_SIZE:
+            return None
+        return mapping, capacity, digest_key
+
+    def _current(self):
+        table = self._table
+        if table is None or HEADER.unpack_from(table[0], 0)[4]:
+            # Not mapped yet, or another process swapped in a new file. The
+            # old map is left to the GC so concurrent readers can finish
+            table = self._table = self._open()
+        return table
+
+    def _find(self, table, raw, writer=False):
+        """(offset, body) of the key's slot, or of the empty slot ending its probe"""
+        mapping, capacity, _ = table
+        padded = raw.ljust(KEY_BYTES, b'\0')
+        key_hash = _key_hash(raw)
+        index = key_hash & (capacity - 1)
+        for _ in range(capacity):
+            offset = HEADER_SIZE + index * SLOT_SIZE
+            if writer:
+                # Writers hold the lock, so an odd sequence is a dead writer's
+                body = BODY.unpack_from(mapping, offset + SEQ.size)
+            else:
+                for _ in range(self.SPIN_LIMIT):
+                    seq = SEQ.unpack_from(mapping, offset)[0]
+                    if seq & 1:
+                        continue
+                    body = BODY.unpack_from(mapping, offset + SEQ.size)
+                    if SEQ.unpack_from(mapping, offset)[0] == seq:
+                        break
+                else:
+                    raise _Torn()
+            if not body[1] or (body[1] == key_hash and body[0] == padded):
+                return offset, body
+            index = (index + 1) & (capacity - 1)
+        return None, None
+
+    def lookup(self, key):
+        """IndexEntry for the key, None if absent, UNKNOWN if the store must answer"""
+        raw = key.encode()
+        table = self._current() if len(raw) <= KEY_BYTES else None
+        if table is None:
+            return UNKNOWN
+        try:
+            _, body = self._find(table, raw)
+        except _Torn:
+            body = None
+        else:
+            if body is None or not body[1]:
+                return None
+        entry = IndexEntry(body, table[2]) if body is not None else None
+        if entry is None or entry.fallback:
+            self.fallbacks += 1
+            return UNKNOWN
+        self.hits += 1
+        return entry
+
+    @staticmethod
+    def _pack(table, raw, record):
+        digest_key = table[2]
+        try:
+            if record is None:
+                raise KeyError('deleted')
+            status = STATUS_BY_NAME[record['status']]
+            months = record['months'] if 'months' in record else MONTHS_MISSING
+            if months is None:
+                months = MONTHS_NONE
+            elif type(months) is not int or not MONTHS_NONE < months < 2 ** 31:
+                raise ValueError('months')
+            return BODY.pack(
+                raw, _key_hash(raw), status,
+                REGISTERED if record.get('registered_device') else 0, months,
+                _pack_time(record, 'activated'), _pack_time(record, 'expiry'),
+                _pack_time(record, 'resume'),
+                _digest(digest_key, record.get('registered_device')),
+                _digest(digest_key, record.get('registered_path')),
+                _digest(digest_key, record.get('registered_hash'))
+            )
+        except (KeyError, ValueError):
+            # Status or fields the slot cannot hold exactly: /check asks the store
+            return BODY.pack(raw, _key_hash(raw), 0, FALLBACK, 0, 0, 0, 0, b'', b'', b'')
+
+    @staticmethod
+    def _write(mapping, offset, body):
+        seq = SEQ.unpack_from(mapping, offset)[0] | 1
+        SEQ.pack_into(mapping, offset, seq)
+        mapping[offset + SEQ.size:offset + SEQ.size + BODY.size] = body
+        SEQ.pack_into(mapping, offset, (seq + 1) & 0xFFFFFFFF)
+
+    def _update_header(self, table, **fields):
+        header = HEADER.unpack_from(table[0], 0)
+        HEADER.pack_into(table[0], 0, *[fields.get(name, value) for name, value in zip(
+            ('magic', 'format', 'capacity', 'used', 'retired', 'boot', 'digest_key',
+             'pending', 'version', 'modified'), header)])
+
+    def begin_write(self):
+        """Count a store write in flight until its update_many()"""
+        with self._locked():
+            table = self._current()
+            if table is not None:
+                self._update_header(table, pending=HEADER.unpack_from(table[0], 0)[7] + 1)
+
+    def update_many(self, keys, version=None):
+        """Write the keys the store just committed into their slots
+
+        The records are read back from the store under the lock, so the
+        last writer to get here writes the latest commit whatever order the
+        commits happened in. ``version`` is the store's (version, modified)
+        after the commit; it ends the write counted by begin_write(). A
+        ``None`` record (deleted, or missing) flags the key's slot, if it
+        has one, so /check asks the store: open addressing cannot empty a
+        slot without breaking probes.
+        """
+        keys = [key for key in dict.fromkeys(keys) if len(key.encode()) <= KEY_BYTES]
+        with self._locked():
+            table = self._current()
+            if table is None:
+                return
+            items = [(key.encode(), record) for key, record in zip(keys, self.fetch(keys))] if keys else []
+            mapping, capacity, _ = table
+            header = HEADER.unpack_from(mapping, 0)
+            used = header[3]
+            for raw, record in items:
+                offset, body = self._find(table, raw, writer=True)
+                if record is None:
+                    if offset is not None and body[1]:
+                        self._write(mapping, offset, self._pack(table, raw, None))
+                    continue
+                if offset is None or (not body[1] and used + 1 > capacity * MAX_LOAD):
+                    # Full: the store already has the records, a bigger table picks them up
+                    self._build(capacity * 2, pending=header[7])
+                    table = self._table
+                    header = HEADER.unpack_from(table[0], 0)
+                    used = None
+                    break
+                if not body[1]:
+                    used += 1
+                self._write(mapping, offset, self._pack(table, raw, record))
+            fields = {'pending': max(0, header[7] - 1)} if version is not None else {}
+            if used is not None:
+                fields['used'] = used
+            if version is not None and tuple(version) > header[8:10]:
+                fields['version'], fields['modified'] = version
+            self._update_header(table, **fields)
+
+    def ensure(self):
+        """Map the index, building it unless this boot or a usable snapshot has one"""
+        with self._locked():
+            table = self._current()
+            header = HEADER.unpack_from(table[0], 0) if table is not None else None
+            sibling = header is not None and header[5] == BOOT_ID
+            # Whoever wrote the file, it is only reused while it matches the store
+            current = header is not None and header[7] == 0 and self.version is not None \
+                and tuple(self.version()) == header[8:10]
+            if current and sibling:
+                # A sibling worker of this boot (gunicorn master) got here first
+                self.loaded = 'shared'
+            elif current:
+                self._update_header(table, boot=BOOT_ID)
+                self.loaded = 'snapshot'
+            else:
+                # A sibling's writes may still be in flight; a past boot's are dead
+                self._build(pending=header[7] if sibling else 0)
+                self.loaded = 'built'
+
+    def rebuild(self):
+        with self._locked():
+            table = self._current()
+            self._build(pending=HEADER.unpack_from(table[0], 0)[7] if table is not None else 0)
+
+    def _build(self, capacity=MIN_CAPACITY, pending=0):
+        """Write a fresh table from the store and swap it in (caller holds the lock)
+
+        ``pending`` carries over the writes in flight; a boot-time build drops
+        the count left behind by writers that died.
+        """
+        # Read first: a write landing before items() only makes the snapshot look stale
+        version = tuple(self.version()) if self.version is not None else (0, 0)
+        items = [(raw, record) for raw, record in ((key.encode(), record) for key, record in self.source())
+                 if len(raw) <= KEY_BYTES]
+        capacity = max(capacity, MIN_CAPACITY)
+        while len(items) > capacity * MAX_LOAD / 2:
+            capacity *= 2
+        old = self._current()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.index-', dir=directory)
+        try:
+            with os.fdopen(fd, 'r+b') as f:
+                f.truncate(HEADER_SIZE + capacity * SLOT_SIZE)
+                mapping = mmap.mmap(f.fileno(), 0)
+            table = (mapping, capacity, secrets.token_bytes(16))
+            for raw, record in items:
+                offset, _ = self._find(table, raw, writer=True)
+                self._write(mapping, offset, self._pack(table, raw, record))
+            HEADER.pack_into(mapping, 0, MAGIC, FORMAT, capacity, len(items), 0,
+                             BOOT_ID, table[2], pending, *version)
+            mapping.flush()
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if old is not None:
+            self._update_header(old, retired=1)
+        self._table = table
+
+    def info(self):
+        table = self._current()
+        entries, capacity = HEADER.unpack_from(table[0], 0)[3:1:-1] if table else (0, 0)
+        return {'entries': entries, 'capacity': capacity, 'hits': self.hits, 'fallbacks': self.fallbacks,
+                'loaded': self.loaded}
+
+
+class IndexedStore:
+    """Store wrapper keeping the shared index in step with every write"""
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def put_many(self, items):
+        items = list(items)
+        # A crash before update_many() leaves the write counted, so the next
+        # boot rebuilds instead of trusting the snapshot
+        self.index.begin_write()
+        self.store.put_many(items)
+        self.index.update_many([key for key, _ in items], self.store.version())
+
+    def modify_many(self, ops):
+        ops = list(ops)
+        self.index.begin_write()
+        records = self.store.modify_many(ops)
+        self.index.update_many([key for key, _ in ops], self.store.version())
+        return records
+
+    def insert_many(self, items):
+        items = list(items)
+        self.index.begin_write()
+        inserted = self.store.insert_many(items)
+        self.index.update_many(inserted, self.store.version())
+        return inserted
+
+    def delete_many(self, keys):
+        self.index.begin_write()
+        deleted = self.store.delete_many(keys)
+        self.index.update_many(deleted, self.store.version())
+        return deleted
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def index_from_env(store):
+    """(store wrapped to maintain the index, KeyIndex), or (store, None) if SHM_INDEX=off"""
+    if SHM_INDEX == 'off':
+        return store, None
+    path = os.environ.get('SHM_INDEX_PATH', store.path + '.index')
+    index = KeyIndex(path, store.items, store.version, store.get_many)
+    return IndexedStore(store, index), index
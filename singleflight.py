@@ -0,0 +1,230 @@
+"""Single-flight coalescing of concurrent reads of the same key.
+
+A burst of /check requests for one key (a popular app launching on many
+machines at once) would otherwise have every request read and parse the
+record on its own. ``SingleFlight`` lets the first caller for a key do
+the read while the others in the same worker wait for it and share the
+result; each request still checks its own device, path and file binding
+against the record.
+
+With SINGLEFLIGHT=machine the gunicorn workers of one machine share reads
+too: the worker doing a read holds a byte-range lock on one of
+FLIGHT_STRIPES slots in ``<DB_PATH>.flight`` and leaves the record there
+with the store version it read it at. A worker that finds the record for
+its key at the store's current version reuses it, which costs a version()
+call instead of a get() (a stat instead of parsing database.json).
+
+    SINGLEFLIGHT=process   coalesce within a worker (default)
+    SINGLEFLIGHT=machine   and across the workers of this machine
+    SINGLEFLIGHT=off
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import serializer
+
+SINGLEFLIGHT = os.environ.get('SINGLEFLIGHT', 'process')
+FLIGHT_STRIPES = int(os.environ.get('FLIGHT_STRIPES', 256))
+FLIGHT_SLOT_BYTES = int(os.environ.get('FLIGHT_SLOT_BYTES', 1024))
+
+# payload length (0 = empty), store version and modified time it was read at
+SLOT_HEADER = struct.Struct('<Iqq')
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FlightSlots:
+    """Last record read per stripe, shared by the workers of one machine"""
+
+    def __init__(self, path, stripes=FLIGHT_STRIPES, slot_bytes=FLIGHT_SLOT_BYTES):
+        self.path = path
+        self.stripes = stripes
+        self.slot_bytes = slot_bytes
+        self.shared = 0
+        self._fd = None
+        self._map = None
+        self._pid = None
+        # Byte-range locks are per process: threads also need their own lock
+        self._thread_locks = [threading.Lock() for _ in range(stripes)]
+        os.register_at_fork(after_in_child=self._reset_thread_locks)
+
+    def _reset_thread_locks(self):
+        self._thread_locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def _open(self):
+        if self._pid != os.getpid():
+            # Closing any descriptor of the file drops the process's locks, so keep one open
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = self.stripes * self.slot_bytes
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+        return self._fd
+
+    def _load(self, stripe):
+        offset = stripe * self.slot_bytes
+        length, version, modified = SLOT_HEADER.unpack_from(self._map, offset)
+        if not length or length > self.slot_bytes - SLOT_HEADER.size:
+            return None
+        start = offset + SLOT_HEADER.size
+        key, record = serializer.loads(self._map[start:start + length])
+        return key, (version, modified), record
+
+    def _store(self, stripe, key, version, record):
+        offset = stripe * self.slot_bytes
+        payload = serializer.dumps([key, record], pretty=False)
+        if len(payload) > self.slot_bytes - SLOT_HEADER.size:
+            # Too big for a slot: the next reader goes to the store
+            SLOT_HEADER.pack_into(self._map, offset, 0, 0, 0)
+            return
+        start = offset + SLOT_HEADER.size
+        self._map[start:start + len(payload)] = payload
+        SLOT_HEADER.pack_into(self._map, offset, len(payload), *version)
+
+    def read(self, key, version, get):
+        """get(key), unless a worker read the key at the store's current version()"""
+        stripe = zlib.crc32(key.encode()) % self.stripes
+        with self._thread_locks[stripe]:
+            fd = self._open()
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                # Version first: a write landing before get() only makes the slot look stale
+                current = tuple(version())
+                slot = self._load(stripe)
+                if slot is not None and slot[0] == key and slot[1] == current:
+                    self.shared += 1
+                    return slot[2]
+                record = get(key)
+                self._store(stripe, key, current, record)
+                return record
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, stripe)
+
+
+class SingleFlight:
+    """Calls in flight by key; callers arriving while one runs share its result"""
+
+    def __init__(self, slots=None):
+        self.slots = slots
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """fn() for the first caller of `key`; concurrent callers get its result or exception"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def forget(self, keys):
+        """A write landed: later callers start a new call instead of joining one begun before it"""
+        with self._lock:
+            for key in keys:
+                self._calls.pop(key, None)
+
+    def info(self):
+        calls = self.leaders + self.coalesced
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'coalesced_ratio': round(self.coalesced / calls, 4) if calls else 0.0,
+            'shared': self.slots.shared if self.slots is not None else 0,
+            'in_flight': len(self._calls)
+        }
+
+
+class CoalescedStore:
+    """Store wrapper sending concurrent get() calls for one key through a SingleFlight"""
+
+    def __init__(self, store, flight):
+        self.store = store
+        self.flight = flight
+
+    def _read(self, key):
+        if self.flight.slots is None:
+            return self.store.get(key)
+        return self.flight.slots.read(key, self.store.version, self.store.get)
+
+    def get(self, key):
+        record = self.flight.do(key, lambda: self._read(key))
+        # Every caller gets its own copy: /check updates the status in place
+        return dict(record) if record is not None else None
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def put_many(self, items):
+        items = list(items)
+        self.store.put_many(items)
+        self.flight.forget(key for key, _ in items)
+
+    def insert_many(self, items):
+        inserted = self.store.insert_many(items)
+        self.flight.forget(inserted)
+        return inserted
+
+    def modify_many(self, ops):
+        ops = list(ops)
+        records = self.store.modify_many(ops)
+        self.flight.forget(key for key, _ in ops)
+        return records
+
+    def delete_many(self, keys):
+        deleted = self.store.delete_many(keys)
+        self.flight.forget(deleted)
+        return deleted
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def singleflight_from_env(store):
+    """(store wrapped to coalesce reads, SingleFlight), or (store, None) if SINGLEFLIGHT=off"""
+    if SINGLEFLIGHT == 'off':
+        return store, None
+    slots = None
+    if SINGLEFLIGHT == 'machine':
+        slots = FlightSlots(os.environ.get('FLIGHT_PATH', store.path + '.flight'))
+    flight = SingleFlight(slots)
+    return CoalescedStore(store, flight), flight
@@ -0,0 +1,1136 @@
+"""Storage backends for activation records.
+
+All backends expose the same small interface used by server.py:
+
+    get(key)          -> record dict or None
+    get_many(keys)    -> [record dict or None] for the keys, read at one point
+    put(key, record)  -> insert or replace a record
+    modify(key, fn)   -> atomic read-modify-write of a single record; ``fn``
+                         mutates the record and returns True to persist it
+    modify_many(ops)  -> several (key, fn) modifications in one transaction
+    put_many(items)   -> several puts in one transaction
+    insert_many(items) -> puts of the keys not in the store yet, in one
+                         transaction; returns the keys inserted
+    delete_many(keys) -> remove records in one transaction, returns the keys
+                         that existed (used when a key moves to another shard)
+    items()           -> iterate (key, record) pairs ordered by key
+    scan(...)         -> filtered keyset page of (key, record) after a cursor
+    due(now, limit)   -> keys whose resume/expiry time is <= now
+    next_due()        -> earliest pending resume/expiry time, or None
+    stats()           -> the /stats counters
+    count()           -> number of keys
+    reconcile()       -> verify the counters against a full scan, fix drift
+    revoke(keys, at, keep_after)
+                      -> record that the keys' license tokens were revoked at
+                         ``at`` (epoch ms), forgetting revocations before
+                         ``keep_after``. The value kept per key is its
+                         revocation version: max(at, previous value + 1), so
+                         it grows with every revocation of the key
+    revocations(since, keys=None)
+                      -> {key: revocation version} for revocations at or
+                         after ``since``, of ``keys`` only if given
+    version()         -> (version, modified): a counter every write that changes
+                         records or counters bumps, and its time in epoch ms
+    changes(since)    -> (version, modified, [(key, record)] written after
+                         version ``since``, None for keys since deleted),
+                         records None when the change log no longer reaches
+                         back that far
+
+Each version bump logs the keys it wrote or deleted; the last
+``CHANGE_LOG_SIZE`` versions are kept, which is what lets /changes send
+deltas. A logged key that no longer exists comes back as a ``None``
+record, the tombstone telling a mirror to drop it.
+
+The /stats counters are maintained incrementally from status transitions
+(``apply_transition``) in the same write as the record itself.
+
+``JsonStore`` keeps the original ``database.json`` layout and
+``JournaledJsonStore`` adds an append-only log on top of it. ``SqliteStore``
+keeps one indexed row per key so lookups and single-key updates do not
+touch the rest of the database.
+"""
+import fcntl
+import os
+import sqlite3
+import sys
+import tempfile
+import logging
+import threading
+import time
+from bisect import bisect_right
+from contextlib import contextmanager
+
+import serializer
+from profiler import add_phase
+from record import FIELDS, Record, compute_stats
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = 'database.json'
+CHANGE_LOG_SIZE = int(os.environ.get('CHANGE_LOG_SIZE', 1000))
+
+
+def empty_stats():
+    return {
+        'total_keys': 0,
+        'active_keys': 0,
+        'suspended_keys': 0,
+        'inactive_keys': 0
+    }
+
+
+STATUS_COUNTERS = {
+    'active': 'active_keys',
+    'suspended': 'suspended_keys',
+}
+
+
+def bump_version(db, keys=()):
+    """Advance the version of a JSON document about to be saved, logging the keys written"""
+    # Documents from before the change log only have deltas from here on
+    db.setdefault('changes_from', db.get('version', 0))
+    db['version'] = db.get('version', 0) + 1
+    db['modified'] = int(time.time() * 1000)
+    log_change(db, db['version'], keys)
+
+
+def log_change(db, version, keys):
+    """Append a version's keys to the document's change log, keeping CHANGE_LOG_SIZE versions"""
+    changes = db.setdefault('changes', [])
+    if changes and version <= changes[-1][0]:
+        # Replayed journal line that is already logged
+        return
+    changes.append([version, sorted(set(keys))])
+    if len(changes) > CHANGE_LOG_SIZE:
+        db['changes_from'] = changes[-CHANGE_LOG_SIZE - 1][0]
+        del changes[:-CHANGE_LOG_SIZE]
+
+
+def changed_keys(db, since):
+    """Keys a JSON document logged after version `since`, None if its log starts later"""
+    version = db.get('version', 0)
+    if since > version or since < db.get('changes_from', version):
+        return None
+    keys = set()
+    for logged, logged_keys in reversed(db.get('changes', ())):
+        if logged <= since:
+            break
+        keys.update(logged_keys)
+    return keys
+
+
+def apply_transition(stats, old_status, new_status):
+    """Adjust the /stats counters in O(1) for one record changing status
+
+    ``None`` stands for "no record", so inserts pass ``old_status=None``.
+    """
+    if old_status == new_status:
+        return stats
+    for status, delta in ((old_status, -1), (new_status, 1)):
+        if status is None:
+            continue
+        stats['total_keys'] += delta
+        stats[STATUS_COUNTERS.get(status, 'inactive_keys')] += delta
+    return stats
+
+
+def matches(key, record, status=None, prefix=None, expires_after=None,
+            expires_before=None, registered=None):
+    """Python version of the /list filters, for backends without an index"""
+    if status is not None and record['status'] != status:
+        return False
+    if prefix and not key.startswith(prefix):
+        return False
+    if expires_after is not None or expires_before is not None:
+        expiry = record.get('expiry')
+        if not expiry or expiry == 'permanent':
+            return False
+        if expires_after is not None and expiry < expires_after:
+            return False
+        if expires_before is not None and expiry > expires_before:
+            return False
+    if registered is not None and bool(record.get('registered_device')) != registered:
+        return False
+    return True
+
+
+def _is_due(record, now):
+    if record['status'] == 'suspended' and record.get('resume') and record['resume'] <= now:
+        return True
+    expiry = record.get('expiry')
+    return (record['status'] in ('active', 'suspended')
+            and expiry not in (None, '', 'permanent') and expiry <= now)
+
+
+class JsonStore:
+    """Original backend: the whole database is one JSON document
+
+    Writers hold an exclusive flock on ``<path>.lock`` for the whole
+    read-modify-write, and the file is replaced atomically (temp file +
+    fsync + rename) so readers never see a torn document.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._thread_lock = threading.Lock()
+        self._version = (None, None)
+        # (signature, (sorted keys, records)) of the document scan() last read
+        self._scan_cache = (None, None)
+        # A worker forked while another thread held the lock would inherit it held
+        os.register_at_fork(after_in_child=self._reset_thread_lock)
+        with self._locked():
+            if not os.path.exists(path):
+                self._save({'activations': {}, 'stats': empty_stats()})
+        # Older files could carry stale stats (e.g. after an auto-resume)
+        self.reconcile()
+
+    def _reset_thread_lock(self):
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        # flock serialises processes, the thread lock serialises threads of
+        # one process (flock is per open file description, not per thread)
+        started = time.perf_counter()
+        with self._thread_lock:
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                add_phase('lock_wait', time.perf_counter() - started)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            return serializer.loads(f.read())
+
+    def _save(self, db):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.database-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(serializer.dumps(db))
+                f.flush()
+                os.fsync(f.fileno())
+                stat = os.fstat(f.fileno())
+            os.replace(tmp_path, self.path)
+            # version() right after our own save needs no reparse
+            self._version = ((stat.st_ino, stat.st_mtime_ns, stat.st_size),
+                             (db.get('version', 0), db.get('modified', 0)))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        return self._load()['activations'].get(key)
+
+    def get_many(self, keys):
+        activations = self._load()['activations']
+        return [activations.get(key) for key in keys]
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def modify_many(self, ops):
+        with self._locked():
+            db = self._load()
+            results = []
+            changed = []
+            for key, fn in ops:
+                record = db['activations'].get(key)
+                if record is not None:
+                    old_status = record['status']
+                    if fn(record):
+                        apply_transition(db['stats'], old_status, record['status'])
+                        changed.append(key)
+                results.append(record)
+            if changed:
+                bump_version(db, changed)
+                self._save(db)
+            return results
+
+    def put_many(self, items):
+        with self._locked():
+            db = self._load()
+            for key, record in items:
+                old = db['activations'].get(key)
+                apply_transition(db['stats'], old and old['status'], record['status'])
+                db['activations'][key] = dict(record)
+            bump_version(db, [key for key, _ in items])
+            self._save(db)
+
+    def insert_many(self, items):
+        with self._locked():
+            db = self._load()
+            inserted = []
+            for key, record in items:
+                if key not in db['activations']:
+                    apply_transition(db['stats'], None, record['status'])
+                    db['activations'][key] = dict(record)
+                    inserted.append(key)
+            if inserted:
+                bump_version(db, inserted)
+                self._save(db)
+            return inserted
+
+    def delete_many(self, keys):
+        with self._locked():
+            db = self._load()
+            deleted = []
+            for key in keys:
+                record = db['activations'].pop(key, None)
+                if record is not None:
+                    apply_transition(db['stats'], record['status'], None)
+                    deleted.append(key)
+            if deleted:
+                bump_version(db, deleted)
+                self._save(db)
+            return deleted
+
+    def items(self):
+        activations = self._load()['activations']
+        for key in sorted(activations):
+            yield key, activations[key]
+
+    def _scan_snapshot(self):
+        """(sorted keys, records) of the document, parsed again only once the file changed
+
+        A paged /list or export calls scan() once per page; without this
+        every page would parse and sort the whole document again.
+        """
+        stat = os.stat(self.path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached_signature, snapshot = self._scan_cache
+        if signature != cached_signature:
+            activations = self._load()['activations']
+            snapshot = (sorted(activations), activations)
+            self._scan_cache = (signature, snapshot)
+        return snapshot
+
+    def scan(self, after=None, limit=None, **filters):
+        keys, activations = self._scan_snapshot()
+        page = []
+        for i in range(bisect_right(keys, after) if after is not None else 0, len(keys)):
+            key = keys[i]
+            if matches(key, activations[key], **filters):
+                page.append((key, activations[key]))
+                if limit is not None and len(page) >= limit:
+                    break
+        return page
+
+    def due(self, now, limit):
+        keys = []
+        for key, record in sorted(self._load()['activations'].items()):
+            if _is_due(record, now):
+                keys.append(key)
+                if len(keys) >= limit:
+                    break
+        return keys
+
+    def next_due(self):
+        times = []
+        for record in self._load()['activations'].values():
+            if record['status'] == 'suspended' and record.get('resume'):
+                times.append(record['resume'])
+            if record['status'] in ('active', 'suspended') and record.get('expiry') not in (None, '', 'permanent'):
+                times.append(record['expiry'])
+        return min(times) if times else None
+
+    def stats(self):
+        return self._load()['stats']
+
+    def count(self):
+        return len(self._load()['activations'])
+
+    def revoke(self, keys, at, keep_after):
+        with self._locked():
+            db = self._load()
+            previous = db.get('revocations', {})
+            revoked = {key: value for key, value in previous.items() if value >= keep_after}
+            revoked.update((key, max(at, previous.get(key, 0) + 1)) for key in keys)
+            db['revocations'] = revoked
+            self._save(db)
+
+    def revocations(self, since, keys=None):
+        revoked = self._load().get('revocations', {})
+        if keys is not None:
+            revoked = {key: revoked[key] for key in keys if key in revoked}
+        return {key: value for key, value in revoked.items() if value >= since}
+
+    def version(self):
+        # Every save replaces the file, so its inode, mtime and size identify
+        # the version without parsing the whole document again
+        stat = os.stat(self.path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached_signature, version = self._version
+        if signature != cached_signature:
+            db = self._load()
+            version = (db.get('version', 0), db.get('modified', 0))
+            self._version = (signature, version)
+        return version
+
+    def changes(self, since):
+        db = self._load()
+        keys = changed_keys(db, since)
+        records = None
+        if keys is not None:
+            activations = db['activations']
+            records = [(key, activations.get(key)) for key in sorted(keys)]
+        return db.get('version', 0), db.get('modified', 0), records
+
+    def reconcile(self):
+        with self._locked():
+            db = self._load()
+            actual = compute_stats(db['activations'].values())
+            drift = _drift(db.get('stats', {}), actual)
+            if drift:
+                db['stats'] = actual
+                bump_version(db)
+                self._save(db)
+        return drift
+
+
+class JournaledJsonStore(JsonStore):
+    """database.json snapshot plus an append-only journal of changed records
+
+    Each write appends one compact line per changed record to
+    ``<path>.log`` instead of rewriting the whole file, so a mutation costs
+    O(record). The log is fsynced in batches every ``fsync_interval``
+    seconds (0 = on every write) and folded into the snapshot once it
+    outgrows ``compact_bytes`` or every ``compact_interval`` seconds.
+
+    Every process keeps the snapshot + log in memory and, under the same
+    flock as JsonStore, replays whatever other processes appended since its
+    last call. Compaction replaces the log file; the new inode tells other
+    processes to reload the snapshot. Log lines hold full records, so
+    replaying a line that already reached the snapshot is harmless, and a
+    torn last line left by a crash is ignored and cut off by the next write.
+
+    The resident records are compact ``Record`` objects (see record.py);
+    callers still get plain dicts from get() and modify().
+    """
+
+    def __init__(self, path, fsync_interval=None, compact_bytes=None, compact_interval=None):
+        self.log_path = path + '.log'
+        self.fsync_interval = float(os.environ.get('JOURNAL_FSYNC_INTERVAL', 0.05)
+                                    if fsync_interval is None else fsync_interval)
+        self.compact_bytes = int(os.environ.get('JOURNAL_COMPACT_BYTES', 8 * 1024 * 1024)
+                                 if compact_bytes is None else compact_bytes)
+        self.compact_interval = float(os.environ.get('JOURNAL_COMPACT_INTERVAL', 300)
+                                      if compact_interval is None else compact_interval)
+        self.db = None
+        self._log_file = None
+        self._log_inode = None
+        self._offset = 0
+        self._dirty = False
+        self._flusher_pid = None
+        super().__init__(path)
+
+    def _sync(self):
+        """Catch up with the snapshot and log (caller holds the lock)"""
+        if self._flusher_pid != os.getpid():
+            # New process (or forked worker): start from a clean view
+            self.db = None
+            self._log_file = None
+            self._start_flusher()
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            with open(self.log_path, 'ab'):
+                pass
+            stat = os.stat(self.log_path)
+        if self.db is None or stat.st_ino != self._log_inode:
+            # First load, or another process compacted the log
+            self.db = JsonStore._load(self)
+            self.db['activations'] = {
+                key: Record.from_dict(record) for key, record in self.db['activations'].items()
+            }
+            self.db.setdefault('revocations', {})
+            self.db.setdefault('version', 0)
+            self.db.setdefault('modified', 0)
+            self.db.setdefault('changes', [])
+            self.db.setdefault('changes_from', self.db['version'])
+            self._offset = 0
+            if self._log_file is not None:
+                self._log_file.close()
+            self._log_file = open(self.log_path, 'ab')
+            self._log_inode = os.fstat(self._log_file.fileno()).st_ino
+            stat = os.stat(self.log_path)
+        if stat.st_size > self._offset:
+            with open(self.log_path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            # Record lines of one write come just before its version line
+            written = []
+            for line in data[:end].splitlines():
+                if line:
+                    entry = serializer.loads(line)
+                    if 'v' in entry:
+                        self.db['version'] = entry['v']
+                        self.db['modified'] = entry['m']
+                        log_change(self.db, entry['v'], written)
+                        written = []
+                    elif 'rv' in entry:
+                        self.db['revocations'][entry['k']] = entry['rv']
+                    elif entry['r'] is None:
+                        self._remove(entry['k'])
+                        written.append(entry['k'])
+                    else:
+                        self._apply(entry['k'], Record.from_dict(entry['r']))
+                        written.append(entry['k'])
+            self._offset += end
+
+    def _apply(self, key, record):
+        activations = self.db['activations']
+        old = activations.get(key)
+        apply_transition(self.db['stats'], old and old['status'], record['status'])
+        activations[key] = record
+
+    def _remove(self, key):
+        record = self.db['activations'].pop(key, None)
+        if record is not None:
+            apply_transition(self.db['stats'], record['status'], None)
+        return record
+
+    def _append(self, entries, field='r'):
+        lines = [{'k': key, field: value} for key, value in entries]
+        if field == 'r':
+            bump_version(self.db, [key for key, _ in entries])
+            lines.append({'v': self.db['version'], 'm': self.db['modified']})
+        data = b''.join(serializer.dumps(line, pretty=False) + b'\n' for line in lines)
+        if os.fstat(self._log_file.fileno()).st_size > self._offset:
+            # Torn line from a writer that died mid-append
+            self._log_file.truncate(self._offset)
+        self._log_file.write(data)
+        self._log_file.flush()
+        self._offset += len(data)
+        if self.fsync_interval <= 0:
+            os.fsync(self._log_file.fileno())
+        else:
+            self._dirty = True
+        if self._offset >= self.compact_bytes:
+            self._compact()
+
+    def _compact(self):
+        """Fold the log into the snapshot (caller holds the lock)"""
+        self._save({
+            'activations': {key: record.to_dict() for key, record in self.db['activations'].items()},
+            'stats': self.db['stats'],
+            'revocations': self.db['revocations'],
+            'version': self.db['version'],
+            'modified': self.db['modified'],
+            'changes': self.db['changes'],
+            'changes_from': self.db['changes_from']
+        })
+        directory = os.path.dirname(os.path.abspath(self.log_path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.database-log-', dir=directory)
+        os.close(fd)
+        os.replace(tmp_path, self.log_path)
+        self._log_file.close()
+        self._log_file = open(self.log_path, 'ab')
+        self._log_inode = os.fstat(self._log_file.fileno()).st_ino
+        self._offset = 0
+        self._dirty = False
+
+    def _start_flusher(self):
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._flush_forever, args=(os.getpid(),), daemon=True)
+        thread.start()
+
+    def _flush_forever(self, pid):
+        last_compact = time.monotonic()
+        interval = self.fsync_interval if self.fsync_interval > 0 else 1.0
+        while self._flusher_pid == pid:
+            time.sleep(interval)
+            try:
+                if self._dirty:
+                    with self._thread_lock:
+                        if self._dirty and self._log_file is not None:
+                            os.fsync(self._log_file.fileno())
+                            self._dirty = False
+                if self.compact_interval > 0 and time.monotonic() - last_compact >= self.compact_interval:
+                    last_compact = time.monotonic()
+                    with self._locked():
+                        self._sync()
+                        if self._offset:
+                            self._compact()
+            except Exception:
+                logger.exception("journal flush failed")
+
+    def _load(self):
+        # Shallow copy: callers iterate it without holding the lock. The
+        # records are read-only Record mappings, not dicts
+        with self._locked():
+            self._sync()
+            return {'activations': dict(self.db['activations']), 'stats': dict(self.db['stats'])}
+
+    def get(self, key):
+        with self._locked():
+            self._sync()
+            record = self.db['activations'].get(key)
+            return record.to_dict() if record is not None else None
+
+    def get_many(self, keys):
+        with self._locked():
+            self._sync()
+            records = [self.db['activations'].get(key) for key in keys]
+        return [record.to_dict() if record is not None else None for record in records]
+
+    def put_many(self, items):
+        with self._locked():
+            self._sync()
+            entries = [(key, dict(record)) for key, record in items]
+            for key, record in entries:
+                self._apply(key, Record.from_dict(record))
+            self._append(entries)
+
+    def insert_many(self, items):
+        with self._locked():
+            self._sync()
+            entries = []
+            for key, record in items:
+                if key not in self.db['activations']:
+                    record = dict(record)
+                    self._apply(key, Record.from_dict(record))
+                    entries.append((key, record))
+            if entries:
+                self._append(entries)
+            return [key for key, _ in entries]
+
+    def modify_many(self, ops):
+        with self._locked():
+            self._sync()
+            results = []
+            entries = []
+            for key, fn in ops:
+                record = self.db['activations'].get(key)
+                if record is not None:
+                    record = record.to_dict()
+                    if fn(record):
+                        self._apply(key, Record.from_dict(record))
+                        entries.append((key, record))
+                    record = dict(record)
+                results.append(record)
+            if entries:
+                self._append(entries)
+            return results
+
+    def delete_many(self, keys):
+        with self._locked():
+            self._sync()
+            deleted = [key for key in keys if self._remove(key) is not None]
+            if deleted:
+                # A null record line is the deletion
+                self._append([(key, None) for key in deleted])
+            return deleted
+
+    def stats(self):
+        with self._locked():
+            self._sync()
+            return dict(self.db['stats'])
+
+    def count(self):
+        with self._locked():
+            self._sync()
+            return len(self.db['activations'])
+
+    def revoke(self, keys, at, keep_after):
+        with self._locked():
+            self._sync()
+            revoked = self.db['revocations']
+            entries = [(key, max(at, revoked.get(key, 0) + 1)) for key in keys]
+            for key in [key for key, value in revoked.items() if value < keep_after]:
+                del revoked[key]
+            revoked.update(entries)
+            self._append(entries, 'rv')
+
+    def revocations(self, since, keys=None):
+        with self._locked():
+            self._sync()
+            revoked = self.db['revocations']
+            if keys is not None:
+                revoked = {key: revoked[key] for key in keys if key in revoked}
+            return {key: value for key, value in revoked.items() if value >= since}
+
+    def version(self):
+        with self._locked():
+            self._sync()
+            return self.db['version'], self.db['modified']
+
+    def _scan_snapshot(self):
+        # Every write bumps the version, which stands in for the file signature
+        with self._locked():
+            self._sync()
+            signature = (self.db['version'], self.db['modified'])
+            cached_signature, snapshot = self._scan_cache
+            if signature != cached_signature:
+                activations = dict(self.db['activations'])
+                snapshot = (sorted(activations), activations)
+                self._scan_cache = (signature, snapshot)
+            return snapshot
+
+    def changes(self, since):
+        with self._locked():
+            self._sync()
+            keys = changed_keys(self.db, since)
+            records = None
+            if keys is not None:
+                activations = self.db['activations']
+                records = [(key, activations[key].to_dict() if key in activations else None)
+                           for key in sorted(keys)]
+            return self.db['version'], self.db['modified'], records
+
+    def reconcile(self):
+        with self._locked():
+            self._sync()
+            actual = compute_stats(self.db['activations'].values())
+            drift = _drift(self.db['stats'], actual)
+            if drift:
+                # Counters are not journaled, so persist the fix via a snapshot
+                self.db['stats'] = actual
+                bump_version(self.db)
+                self._compact()
+        return drift
+
+
+class SqliteStore:
+    """One row per key in SQLite (WAL mode), primary key on the activation key
+
+    Every read-modify-write runs inside ``BEGIN IMMEDIATE`` so concurrent
+    workers are serialised by SQLite's write lock and wait on it (up to the
+    connection timeout) instead of failing with "database is locked".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS activations ('
+            ' key TEXT PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' activated TEXT,'
+            ' expiry TEXT,'
+            ' months INTEGER,'
+            ' registered_device TEXT,'
+            ' registered_path TEXT,'
+            ' registered_hash TEXT,'
+            ' first_use TEXT,'
+            ' resume TEXT'
+            ') WITHOUT ROWID'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS activations_status ON activations (status)')
+        conn.execute('CREATE INDEX IF NOT EXISTS activations_expiry ON activations (status, expiry)')
+        conn.execute('CREATE INDEX IF NOT EXISTS activations_resume ON activations (status, resume)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS revocations ('
+            ' key TEXT PRIMARY KEY,'
+            ' revoked_at INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS revocations_at ON revocations (revoked_at)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            ' name TEXT PRIMARY KEY,'
+            ' value INTEGER NOT NULL'
+            ')'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS changes ('
+            ' version INTEGER NOT NULL,'
+            ' key TEXT NOT NULL'
+            ')'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS changes_version ON changes (version)')
+        # Databases from before the change log only have deltas from here on
+        conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value)"
+            " SELECT 'changes_from', COALESCE(MAX(value), 0) FROM meta WHERE name = 'version'"
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS counters ('
+            ' name TEXT PRIMARY KEY,'
+            ' value INTEGER NOT NULL'
+            ')'
+        )
+        with self._transaction() as conn:
+            if conn.execute('SELECT COUNT(*) FROM counters').fetchone()[0] != len(empty_stats()):
+                # New database, or one created before the counters existed
+                conn.executemany(
+                    'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                    self._scan_stats(conn).items()
+                )
+
+    def _conn(self):
+        # One connection per thread, reopened after gunicorn forks a worker
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _record(row):
+        record = {field: row[field] for field in FIELDS}
+        if record['resume'] is None:
+            del record['resume']
+        return record
+
+    @staticmethod
+    def _row(key, record):
+        return (key,) + tuple(record.get(field) for field in FIELDS)
+
+    def _write(self, conn, key, record):
+        conn.execute(
+            'INSERT OR REPLACE INTO activations (key, %s) VALUES (?, %s)'
+            % (', '.join(FIELDS), ', '.join('?' * len(FIELDS))),
+            self._row(key, record)
+        )
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT * FROM activations WHERE key = ?', (key,)
+        ).fetchone()
+        return self._record(row) if row else None
+
+    GET_MANY_CHUNK = 500
+
+    def get_many(self, keys):
+        keys = list(keys)
+        conn = self._conn()
+        found = {}
+        # One read transaction, so every chunk sees the same commit
+        conn.execute('BEGIN')
+        try:
+            for start in range(0, len(keys), self.GET_MANY_CHUNK):
+                chunk = keys[start:start + self.GET_MANY_CHUNK]
+                for row in conn.execute('SELECT * FROM activations WHERE key IN (%s)'
+                                        % ','.join('?' * len(chunk)), chunk):
+                    found[row['key']] = self._record(row)
+        finally:
+            conn.execute('COMMIT')
+        return [found.get(key) for key in keys]
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        add_phase('lock_wait', time.perf_counter() - started)
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _bump(self, conn, old_status, new_status):
+        delta = apply_transition(empty_stats(), old_status, new_status)
+        for name, value in delta.items():
+            if value:
+                conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+
+    PRUNE_CHANGES_EVERY = 64
+
+    def _bump_version(self, conn, keys=()):
+        conn.execute(
+            "INSERT INTO meta (name, value) VALUES ('version', 1)"
+            ' ON CONFLICT (name) DO UPDATE SET value = value + 1'
+        )
+        version = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('modified', ?)",
+            (int(time.time() * 1000),)
+        )
+        conn.executemany('INSERT INTO changes (version, key) VALUES (?, ?)',
+                         [(version, key) for key in set(keys)])
+        if version % self.PRUNE_CHANGES_EVERY == 0 and version > CHANGE_LOG_SIZE:
+            oldest = version - CHANGE_LOG_SIZE
+            conn.execute('DELETE FROM changes WHERE version <= ?', (oldest,))
+            conn.execute("UPDATE meta SET value = MAX(value, ?) WHERE name = 'changes_from'", (oldest,))
+
+    def put(self, key, record):
+        self.put_many([(key, record)])
+
+    def modify(self, key, fn):
+        return self.modify_many([(key, fn)])[0]
+
+    def modify_many(self, ops):
+        with self._transaction() as conn:
+            results = []
+            changed = []
+            for key, fn in ops:
+                row = conn.execute(
+                    'SELECT * FROM activations WHERE key = ?', (key,)
+                ).fetchone()
+                record = None
+                if row is not None:
+                    record = self._record(row)
+                    if fn(record):
+                        self._write(conn, key, record)
+                        self._bump(conn, row['status'], record['status'])
+                        changed.append(key)
+                results.append(record)
+            if changed:
+                self._bump_version(conn, changed)
+            return results
+
+    def put_many(self, items):
+        with self._transaction() as conn:
+            for key, record in items:
+                old = conn.execute(
+                    'SELECT status FROM activations WHERE key = ?', (key,)
+                ).fetchone()
+                self._write(conn, key, record)
+                self._bump(conn, old and old['status'], record['status'])
+            self._bump_version(conn, [key for key, _ in items])
+
+    def insert_many(self, items):
+        with self._transaction() as conn:
+            inserted = []
+            for key, record in items:
+                exists = conn.execute(
+                    'SELECT 1 FROM activations WHERE key = ?', (key,)
+                ).fetchone()
+                if exists is None:
+                    self._write(conn, key, record)
+                    self._bump(conn, None, record['status'])
+                    inserted.append(key)
+            if inserted:
+                self._bump_version(conn, inserted)
+            return inserted
+
+    def delete_many(self, keys):
+        with self._transaction() as conn:
+            deleted = []
+            for key in keys:
+                row = conn.execute(
+                    'SELECT status FROM activations WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('DELETE FROM activations WHERE key = ?', (key,))
+                    self._bump(conn, row['status'], None)
+                    deleted.append(key)
+            if deleted:
+                self._bump_version(conn, deleted)
+            return deleted
+
+    def items(self):
+        for row in self._conn().execute('SELECT * FROM activations ORDER BY key'):
+            yield row['key'], self._record(row)
+
+    def scan(self, after=None, limit=None, status=None, prefix=None,
+             expires_after=None, expires_before=None, registered=None):
+        # Keyset pagination on the primary key: cost is O(log n + page)
+        where = []
+        params = []
+        if after is not None:
+            where.append('key > ?')
+            params.append(after)
+        if prefix:
+            where.append('key >= ? AND key < ?')
+            params += [prefix, prefix + '\U0010ffff']
+        if status is not None:
+            where.append('status = ?')
+            params.append(status)
+        if expires_after is not None or expires_before is not None:
+            where.append("expiry != 'permanent'")
+        if expires_after is not None:
+            where.append('expiry >= ?')
+            params.append(expires_after)
+        if expires_before is not None:
+            where.append('expiry <= ?')
+            params.append(expires_before)
+        if registered is not None:
+            where.append("COALESCE(registered_device, '') %s ''" % ('!=' if registered else '='))
+        sql = 'SELECT * FROM activations'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY key'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [(row['key'], self._record(row)) for row in self._conn().execute(sql, params)]
+
+    def due(self, now, limit):
+        rows = self._conn().execute(
+            "SELECT key FROM activations WHERE status = 'suspended' AND resume <= ?"
+            " UNION"
+            " SELECT key FROM activations WHERE status IN ('active', 'suspended')"
+            " AND expiry <= ? AND expiry != 'permanent'"
+            " LIMIT ?",
+            (now, now, limit)
+        ).fetchall()
+        return [row['key'] for row in rows]
+
+    def next_due(self):
+        # 'permanent' sorts after every ISO date, so each MIN() can use the
+        # (status, time) index directly and is filtered afterwards
+        times = self._conn().execute(
+            "SELECT MIN(resume) FROM activations WHERE status = 'suspended'"
+            " UNION ALL SELECT MIN(expiry) FROM activations WHERE status = 'active'"
+            " UNION ALL SELECT MIN(expiry) FROM activations WHERE status = 'suspended'"
+        ).fetchall()
+        times = [row[0] for row in times if row[0] and row[0] != 'permanent']
+        return min(times) if times else None
+
+    def stats(self):
+        stats = empty_stats()
+        stats.update(self._conn().execute('SELECT name, value FROM counters').fetchall())
+        return stats
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM activations').fetchone()[0]
+
+    def revoke(self, keys, at, keep_after):
+        with self._transaction() as conn:
+            entries = []
+            for key in keys:
+                row = conn.execute(
+                    'SELECT revoked_at FROM revocations WHERE key = ?', (key,)
+                ).fetchone()
+                entries.append((key, max(at, row[0] + 1 if row else 0)))
+            conn.execute('DELETE FROM revocations WHERE revoked_at < ?', (keep_after,))
+            conn.executemany(
+                'INSERT OR REPLACE INTO revocations (key, revoked_at) VALUES (?, ?)', entries
+            )
+
+    def revocations(self, since, keys=None):
+        conn = self._conn()
+        if keys is None:
+            return dict(conn.execute(
+                'SELECT key, revoked_at FROM revocations WHERE revoked_at >= ?', (since,)
+            ).fetchall())
+        revoked = {}
+        for key in keys:
+            row = conn.execute(
+                'SELECT revoked_at FROM revocations WHERE key = ? AND revoked_at >= ?', (key, since)
+            ).fetchone()
+            if row is not None:
+                revoked[key] = row[0]
+        return revoked
+
+    def version(self):
+        meta = dict(self._conn().execute('SELECT name, value FROM meta').fetchall())
+        return meta.get('version', 0), meta.get('modified', 0)
+
+    def changes(self, since):
+        conn = self._conn()
+        # One read transaction, so the records match the version returned
+        conn.execute('BEGIN')
+        try:
+            meta = dict(conn.execute('SELECT name, value FROM meta').fetchall())
+            version = meta.get('version', 0)
+            records = None
+            if meta.get('changes_from', 0) <= since <= version:
+                rows = conn.execute(
+                    'SELECT changed.key AS changed_key, activations.* FROM'
+                    ' (SELECT DISTINCT key FROM changes WHERE version > ?) AS changed'
+                    ' LEFT JOIN activations ON activations.key = changed.key'
+                    ' ORDER BY changed.key', (since,)
+                ).fetchall()
+                # Keys deleted since then have no row left: tombstones
+                records = [(row['changed_key'], self._record(row) if row['status'] is not None else None)
+                           for row in rows]
+        finally:
+            conn.execute('COMMIT')
+        return version, meta.get('modified', 0), records
+
+    def _scan_stats(self, conn):
+        counts = dict(conn.execute(
+            'SELECT status, COUNT(*) FROM activations GROUP BY status'
+        ).fetchall())
+        stats = empty_stats()
+        for status, count in counts.items():
+            stats['total_keys'] += count
+            stats[STATUS_COUNTERS.get(status, 'inactive_keys')] += count
+        return stats
+
+    def reconcile(self):
+        with self._transaction() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            actual = self._scan_stats(conn)
+            drift = _drift(counters, actual)
+            if drift:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                    actual.items()
+                )
+                self._bump_version(conn)
+        return drift
+
+
+def _drift(counters, actual):
+    drift = {}
+    for name, value in actual.items():
+        if counters.get(name) != value:
+            drift[name] = {'counter': counters.get(name), 'actual': value}
+    if drift:
+        logger.warning("stats counters drifted from a full scan: %s", drift)
+    return drift
+
+
+BACKENDS = {
+    'json': JsonStore,
+    'journal': JournaledJsonStore,
+    'sqlite': SqliteStore,
+}
+
+
+def open_store(backend, path):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown DB_BACKEND: {backend}")
+    return BACKENDS[backend](path)
+
+
+def store_from_env():
+    """Open the store configured by DB_BACKEND / DB_PATH
+
+    On the first boot of a non-JSON backend an existing database.json is
+    imported once.
+    """
+    backend = os.environ.get('DB_BACKEND', 'sqlite')
+    path = os.environ.get('DB_PATH', 'database.db' if backend == 'sqlite' else DB_FILE)
+    fresh = not os.path.exists(path)
+    store = open_store(backend, path)
+    if fresh and path != DB_FILE and os.path.exists(DB_FILE):
+        migrate_json(DB_FILE, store)
+    return store
+
+
+def migrate_json(json_path, store):
+    """Import a database.json (activations + stats) into another store"""
+    with open(json_path, 'rb') as f:
+        db = serializer.loads(f.read())
+    items = list(db.get('activations', {}).items())
+    for key, record in items:
+        try:
+            serializer.RECORD.validate(record)
+        except ValueError as e:
+            raise ValueError(f"{json_path}: key {key}: {e}") from None
+    store.put_many(items)
+    stats = store.stats()
+    if db.get('stats') and db['stats'] != stats:
+        print(f"⚠️ stats in {json_path} were stale: {db['stats']} -> {stats}")
+    return len(items)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python store.py database.json database.db")
+        sys.exit(1)
+    count = migrate_json(sys.argv[1], SqliteStore(sys.argv[2]))
+    print(f"✅ Imported {count} keys into {sys.argv[2]}")
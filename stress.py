@@ -0,0 +1,112 @@
+"""Multi-process stress run against the activation routes.
+
+Each process imports server.py on its own (like a gunicorn worker) and
+hammers a shared database, then the results are checked for lost updates:
+
+    python stress.py --backend sqlite --processes 8 --rounds 50
+    python stress.py --backend json --processes 8 --rounds 20
+
+Exits with status 1 if any update was lost or a key was bound twice.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+
+
+def _client(backend, path):
+    os.environ['DB_BACKEND'] = backend
+    os.environ['DB_PATH'] = path
+    os.environ['CACHE_SIZE'] = '0'
+    import server
+    return server.app.test_client()
+
+
+def _extend_worker(backend, path, rounds, queue):
+    client = _client(backend, path)
+    failures = 0
+    for _ in range(rounds):
+        response = client.post('/extend', json={'key': 'STRESS-EXTEND', 'months': 1})
+        if not response.get_json().get('success'):
+            failures += 1
+    queue.put(failures)
+
+
+def _register_worker(backend, path, worker_id, keys, queue):
+    client = _client(backend, path)
+    won = []
+    for key in keys:
+        response = client.post(f'/check/{key}', json={
+            'device_id': f'device-{worker_id}',
+            'file_path': f'/path/{worker_id}',
+            'file_hash': f'hash-{worker_id}'
+        })
+        if response.status_code == 200:
+            won.append(key)
+    queue.put((worker_id, won))
+
+
+def _run(target, args_list):
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=args + (queue,)) for args in args_list]
+    for process in processes:
+        process.start()
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'json', 'journal'])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--keys', type=int, default=20)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='stress-')
+    path = os.path.join(directory, 'database.db' if args.backend == 'sqlite' else 'database.json')
+    client = _client(args.backend, path)
+    import server
+
+    client.post('/activate', json={'key': 'STRESS-EXTEND', 'months': 1})
+    keys = [f'STRESS-BIND-{i}' for i in range(args.keys)]
+    for key in keys:
+        client.post('/activate', json={'key': key, 'months': 1})
+
+    ok = True
+
+    failures = sum(_run(_extend_worker, [
+        (args.backend, path, args.rounds) for _ in range(args.processes)
+    ]))
+    months = server.store.get('STRESS-EXTEND')['months']
+    expected = 1 + args.processes * args.rounds
+    print(f"extend: months={months} expected={expected} failed_requests={failures}")
+    if months != expected or failures:
+        ok = False
+
+    winners = _run(_register_worker, [
+        (args.backend, path, worker_id, keys) for worker_id in range(args.processes)
+    ])
+    for key in keys:
+        bound = [worker_id for worker_id, won in winners if key in won]
+        record = server.store.get(key)
+        owner = record['registered_device']
+        if len(bound) != 1 or owner != f'device-{bound[0]}':
+            print(f"register: {key} accepted by {bound}, bound to {owner}")
+            ok = False
+    print(f"register: {len(keys)} keys, {'each bound exactly once' if ok else 'FAILED'}")
+
+    stats = server.store.stats()
+    if stats['total_keys'] != len(keys) + 1:
+        print(f"stats: {stats}")
+        ok = False
+
+    print("✅ no lost updates" if ok else "❌ lost updates detected")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
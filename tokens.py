@@ -0,0 +1,97 @@
+"""Signing of the offline license tokens returned by /check.
+
+Configured from the environment:
+
+    LICENSE_SIGNING_KEY   base64 Ed25519 private key seed (32 bytes) -> EdDSA
+    LICENSE_HMAC_SECRET   shared secret -> HS256, if no signing key is set
+    LICENSE_TOKEN_TTL     token lifetime in seconds (default 6 hours)
+
+With neither key set /check never issues tokens. ``python tokens.py``
+prints a fresh signing key. The format and the client-side checks live in
+license_client.py.
+"""
+import hashlib
+import hmac
+import json
+import os
+from datetime import datetime
+
+from license_client import b64decode, b64encode, binding_digest, now_ms
+
+LICENSE_TOKEN_TTL = int(os.environ.get('LICENSE_TOKEN_TTL', 6 * 3600))
+
+
+def expiry_ms(expiry):
+    """License expiry (naive local ISO string) in epoch ms, None if permanent or unknown"""
+    if not expiry or expiry == 'permanent':
+        return None
+    try:
+        return int(datetime.fromisoformat(expiry).timestamp() * 1000)
+    except ValueError:
+        return None
+
+
+class TokenSigner:
+    def __init__(self, alg, key, ttl=LICENSE_TOKEN_TTL):
+        self.alg = alg
+        self.ttl = ttl
+        if alg == 'EdDSA':
+            # Only imported when EdDSA is configured: it is slow to load on a cold start
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+            self._private_key = Ed25519PrivateKey.from_private_bytes(key)
+            self.public_key = b64encode(self._private_key.public_key().public_bytes(
+                serialization.Encoding.Raw, serialization.PublicFormat.Raw))
+        else:
+            self._secret = key
+            self.public_key = None
+
+    def sign(self, claims):
+        payload = b64encode(json.dumps(claims, sort_keys=True, separators=(',', ':')).encode()).encode()
+        if self.alg == 'EdDSA':
+            signature = self._private_key.sign(payload)
+        else:
+            signature = hmac.new(self._secret, payload, hashlib.sha256).digest()
+        return payload.decode() + '.' + b64encode(signature)
+
+    def issue(self, key, expiry, device_id, file_path, file_hash, revocation=0):
+        """Token for an active key bound to device/path/file, capped at the license expiry
+
+        ``revocation`` is the key's revocation version read before the
+        record that showed it active; a later revocation publishes a higher one.
+        """
+        issued_at = now_ms()
+        expires_at = issued_at + self.ttl * 1000
+        license_end = expiry_ms(expiry)
+        if license_end is not None:
+            expires_at = min(expires_at, license_end)
+        return self.sign({
+            'alg': self.alg,
+            'key': key,
+            'status': 'active',
+            'expiry': expiry,
+            'issued_at': issued_at,
+            'rv': revocation,
+            'expires_at': expires_at,
+            'device': binding_digest(device_id),
+            'path': binding_digest(file_path),
+            'file': binding_digest(file_hash)
+        })
+
+
+def signer_from_env():
+    """TokenSigner for LICENSE_SIGNING_KEY / LICENSE_HMAC_SECRET, or None"""
+    signing_key = os.environ.get('LICENSE_SIGNING_KEY')
+    if signing_key:
+        try:
+            return TokenSigner('EdDSA', b64decode(signing_key))
+        except ImportError:
+            raise RuntimeError("LICENSE_SIGNING_KEY needs the cryptography package") from None
+    secret = os.environ.get('LICENSE_HMAC_SECRET')
+    if secret:
+        return TokenSigner('HS256', secret.encode())
+    return None
+
+
+if __name__ == '__main__':
+    print(b64encode(os.urandom(32)))